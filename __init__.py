@@ -2,6 +2,23 @@
 # -*- coding: utf-8 -*-
 __version__ = "0.2.1"
 __author__ = 'selfin'
+import sys
 
 from .ceph import Ceph, RBDFeatures, PoolNotFound
 __all__ = [Ceph, RBDFeatures]
+
+if sys.version_info >= (3, 7):
+    def __getattr__(name):
+        # asyncio is imported on first use of AsyncCeph, not by every `import pyceph`
+        if name == 'AsyncCeph':
+            from .asyncceph import AsyncCeph
+            globals()['AsyncCeph'] = AsyncCeph
+            return AsyncCeph
+        raise AttributeError("module %r has no attribute %r" % (__name__, name))
+else:
+    try:
+        from .asyncceph import AsyncCeph
+        __all__.append(AsyncCeph)
+    except ImportError:
+        # No asyncio in python 2
+        pass
@@ -1,2 +1,110 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
+# python -m pyceph backup rbd/vm-1 rbd/vm-2 -o /backup --bandwidth 200M --per-pool 2
+# python -m pyceph materialize full.raw 1.diff 2.diff -o image.raw
+from __future__ import print_function
+import argparse
+import json
+import logging
+import sys
+from time import time
+
+from .ceph import FORMAT
+from .scheduler import Scheduler, Job, Policy, DEFAULT_WORKERS, DEFAULT_SNAPSHOT_PREFIX
+
+_UNITS = {'': 1, 'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30, 'T': 1 << 40}
+
+
+def parse_rate(value):
+    """Bytes per second from 100M, 1.5G or plain number of bytes"""
+    value = value.strip().upper().rstrip('B').rstrip('I')
+    unit = value[-1:] if value[-1:] in _UNITS else ''
+    return int(float(value[:len(value) - len(unit)]) * _UNITS[unit])
+
+
+def parse_pool_rate(value):
+    pool, _, rate = value.partition('=')
+    if not rate:
+        raise argparse.ArgumentTypeError("expected pool=rate, got %s" % value)
+    return pool, parse_rate(rate)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m pyceph', description="pyceph command line")
+    commands = parser.add_subparsers(dest='command')
+    backup = commands.add_parser('backup', help="snapshot and export many images under shared limits")
+    backup.add_argument('images', nargs='*', help="pool/image to back up")
+    backup.add_argument('--jobs', default=None,
+                        help="JSON list of {pool, image, ...policy fields} overriding command line policy, "
+                             "deadline in seconds from now")
+    backup.add_argument('-o', '--output', default='.', help="directory of exports, <output>/<pool>/<image>/")
+    backup.add_argument('--mode', choices=('diff', 'full'), default='diff')
+    backup.add_argument('--keep', type=int, default=2, help="backup snapshots left in cluster")
+    backup.add_argument('--deadline', type=float, default=None, help="seconds from now the backups are due")
+    backup.add_argument('--no-sparse', dest='sparse', action='store_false', help="write zero blocks of full dumps")
+    backup.add_argument('--compress', default=None, help="codec of compressed exports: zlib, lz4, zstd")
+    backup.add_argument('--prefix', default=DEFAULT_SNAPSHOT_PREFIX, help="name prefix of backup snapshots")
+    backup.add_argument('--speed-limit', type=parse_rate, default=None, help="bytes per second of one export")
+    backup.add_argument('--bandwidth', type=parse_rate, default=None, help="bytes per second of all exports")
+    backup.add_argument('--pool-bandwidth', type=parse_pool_rate, action='append', default=[],
+                        help="pool=rate, bytes per second of exports of the pool")
+    backup.add_argument('--workers', type=int, default=DEFAULT_WORKERS, help="jobs running at once")
+    backup.add_argument('--per-pool', type=int, default=None, help="jobs of one pool running at once")
+    backup.add_argument('--per-host', type=float, default=None, help="load of one OSD host, in images")
+    backup.add_argument('--conffile', default='/etc/ceph/ceph.conf')
+    backup.add_argument('--cluster', default='ceph')
+    backup.add_argument('-v', '--verbose', action='store_true')
+    materialize = commands.add_parser('materialize', help="build full image file from a full dump and its diffs")
+    materialize.add_argument('base', help="full dump, raw or compressed")
+    materialize.add_argument('diffs', nargs='+', help="diffs since the dump, oldest first")
+    materialize.add_argument('-o', '--output', required=True, help="path of the image file")
+    materialize.add_argument('--base-snap', default=None, help="snapshot the full dump was made from")
+    args = parser.parse_args(argv)
+    if not args.command:
+        parser.error("command is required")
+    return args
+
+
+def build_jobs(args):
+    deadline = time() + args.deadline if args.deadline is not None else None
+    defaults = Policy(args.output, args.mode, args.keep, deadline, args.sparse, args.compress, args.speed_limit,
+                      args.prefix)
+    jobs = []
+    for spec in args.images:
+        pool, _, image = spec.rpartition('/')
+        jobs.append(Job(pool or 'rbd', image, defaults))
+    if args.jobs:
+        with open(args.jobs) as fh:
+            for item in json.load(fh):
+                item = dict(item)
+                pool = item.pop('pool', 'rbd')
+                image = item.pop('image')
+                if item.get('deadline') is not None:
+                    item['deadline'] = time() + item['deadline']
+                if 'speed_limit' in item and not isinstance(item['speed_limit'], (int, float)):
+                    item['speed_limit'] = parse_rate(item['speed_limit'])
+                jobs.append(Job(pool, image, defaults._replace(**item)))
+    return jobs
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.command == 'materialize':
+        from .export_diff import materialize
+        materialize(args.base, args.diffs, args.output, base_snap=args.base_snap, verbose=True)
+        return 0
+    logging.basicConfig(format=FORMAT, level=logging.INFO if args.verbose else logging.WARNING)
+    jobs = build_jobs(args)
+    if not jobs:
+        print("Nothing to back up", file=sys.stderr)
+        return 2
+    scheduler = Scheduler(args.conffile, args.cluster, workers=args.workers, per_pool=args.per_pool,
+                          per_host=args.per_host, bandwidth=args.bandwidth, pool_bandwidth=dict(args.pool_bandwidth))
+    results = scheduler.run(jobs)
+    for result in results:
+        print(json.dumps(result._asdict(), sort_keys=True))
+    return 0 if all(result.ok for result in results) else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
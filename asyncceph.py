@@ -0,0 +1,317 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+# asyncio counterpart of Ceph: image data moves on librbd aio completions, metadata calls run on a bounded executor
+import asyncio
+import errno
+import os
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from time import time
+
+from .ceph import Ceph, logger
+from .fileio import pwrite
+from .lazy import pyaio
+from .metrics import BYTES, OP_SECONDS, IN_FLIGHT
+from .queue import extents, FADVISE_FLAGS, DEFAULT_IN_FLIGHT
+
+DEFAULT_EXECUTOR_WORKERS = 16
+
+
+def _resolve(future, rv, result):
+    if future.done():
+        return
+    if rv < 0:
+        future.set_exception(IOError(-rv, os.strerror(-rv)))
+    else:
+        future.set_result(result)
+
+
+class AsyncCeph(object):
+    """
+    Ceph API for asyncio applications. Every method returns an awaitable.
+
+    >>> async with AsyncCeph('rbd') as ceph:
+    ...     await ceph.create_snapshot('vm-1-disk-1', 'daily')
+    ...     await ceph.create_dump('vm-1-disk-1', 'daily', '/backup/vm-1-disk-1')
+    """
+
+    def __init__(self, pool='rbd', conffile='/etc/ceph/ceph.conf', cluster='ceph', loop=None,
+                 executor_workers=DEFAULT_EXECUTOR_WORKERS, ceph=None):
+        """
+        :param pool: Ceph cluster pool
+        :type pool: str
+        :param conffile: Path to ceph.conf file
+        :type conffile: str
+        :param cluster: Ceph cluster name
+        :type cluster: str
+        :param loop: event loop (defaults to the loop running when the object is first used)
+        :type loop: asyncio.AbstractEventLoop
+        :param executor_workers: number of threads for calls librbd has no completions for
+        :type executor_workers: int
+        :param ceph: existing Ceph object to use instead of borrowing the shared connection
+        :type ceph: Ceph
+        """
+        self._loop = loop
+        self.ceph = ceph if ceph is not None else Ceph(pool, conffile, cluster, shared=True)
+        self._own_ceph = ceph is None
+        self._executor = ThreadPoolExecutor(executor_workers)
+
+    @property
+    def loop(self):
+        if self._loop is None:
+            # get_event_loop() outside of a running loop is deprecated
+            get_loop = getattr(asyncio, 'get_running_loop', asyncio.get_event_loop)
+            self._loop = get_loop()
+        return self._loop
+
+    def _call(self, method, *args, **kwargs):
+        return self.loop.run_in_executor(self._executor, partial(method, *args, **kwargs))
+
+    def get_images_list(self, with_ext_info=False):
+        return self._call(self.ceph.get_images_list, with_ext_info)
+
+    def get_image_stat(self, image_name):
+        return self._call(self.ceph.get_image_stat, image_name)
+
+    def is_image_exists(self, image_name):
+        return self._call(self.ceph.is_image_exists, image_name)
+
+    def list_snapshots(self, image_name):
+        return self._call(self.ceph.list_snapshots, image_name)
+
+    def is_snapshot_exists(self, image_name, snap_name):
+        return self._call(self.ceph.is_snapshot_exists, image_name, snap_name)
+
+    def create_snapshot(self, image_name, snap_name):
+        return self._call(self.ceph.create_snapshot, image_name, snap_name)
+
+    def remove_snapshot(self, image_name, snap_name, force=False):
+        return self._call(self.ceph.remove_snapshot, image_name, snap_name, force)
+
+    def protect(self, image_name, snap_name):
+        return self._call(self.ceph.protect, image_name, snap_name)
+
+    def unprotect(self, image_name, snap_name):
+        return self._call(self.ceph.unprotect, image_name, snap_name)
+
+    def read(self, image, offset, length, flags=FADVISE_FLAGS):
+        """
+        Read from opened image with aio_read
+        :param image: opened image
+        :type image: rbd.Image
+        :return: future of read data
+        :rtype: asyncio.Future
+        """
+        future = self.loop.create_future()
+        started = time()
+
+        def oncomplete(completion, data):
+            rv = completion.get_return_value()
+            OP_SECONDS.observe(time() - started, 'aio_read')
+            IN_FLIGHT.dec(1, 'aio_read')
+            if rv >= 0:
+                BYTES.inc(rv, 'read')
+            self.loop.call_soon_threadsafe(_resolve, future, rv, data)
+
+        IN_FLIGHT.inc(1, 'aio_read')
+        image.aio_read(offset, length, oncomplete, flags)
+        return future
+
+    def write(self, image, offset, data, flags=0):
+        """
+        Write to opened image with aio_write
+        :param image: opened image
+        :type image: rbd.Image
+        :return: future of number of written bytes
+        :rtype: asyncio.Future
+        """
+        future = self.loop.create_future()
+        started = time()
+
+        def oncomplete(completion):
+            rv = completion.get_return_value()
+            OP_SECONDS.observe(time() - started, 'aio_write')
+            IN_FLIGHT.dec(1, 'aio_write')
+            if rv >= 0:
+                BYTES.inc(len(data), 'written')
+            self.loop.call_soon_threadsafe(_resolve, future, rv, len(data))
+
+        IN_FLIGHT.inc(1, 'aio_write')
+        image.aio_write(data, offset, oncomplete, flags)
+        return future
+
+    def write_file(self, fd, offset, data):
+        """
+        Write to local file with pyaio, on an executor thread if pyaio is not installed
+        :param fd: file descriptor
+        :type fd: int
+        :return: future of number of written bytes
+        :rtype: asyncio.Future
+        """
+        try:
+            aio_write = pyaio.aio_write
+        except ImportError:
+            return self.loop.run_in_executor(self._executor, pwrite, fd, data, offset)
+        future = self.loop.create_future()
+        started = time()
+
+        def oncomplete(rt, err):
+            OP_SECONDS.observe(time() - started, 'write')
+            IN_FLIGHT.dec(1, 'file_write')
+            rv = rt
+            if err:
+                rv = -err
+            elif rt < len(data):
+                # Short write
+                rv = -errno.EIO
+            self.loop.call_soon_threadsafe(_resolve, future, rv, len(data))
+
+        IN_FLIGHT.inc(1, 'file_write')
+        aio_write(fd, data, offset, oncomplete)
+        return future
+
+    def create_dump(self, image_name, snap_name, fn, bs=None, in_flight=DEFAULT_IN_FLIGHT, cb=None):
+        """
+        Export snapshot to file, keeping up to :in_flight blocks being read or written
+        :param image_name: name of image in cluster
+        :type image_name: str
+        :param snap_name: name of already existed snapshot
+        :type snap_name: str
+        :param fn: path of result file
+        :type fn: str
+        :param bs: block size of single read (defaults to object size)
+        :type bs: int
+        :param in_flight: maximum number of blocks in flight
+        :type in_flight: int
+        :param cb: progress callback, called with (current, total) bytes
+        :type cb: callable
+        :return: future of status of the operation
+        :rtype: asyncio.Future
+        """
+        return _Dump(self, image_name, snap_name, fn, bs, in_flight, cb).start()
+
+    def close(self):
+        future = self._call(self.ceph.__exit__, None, None, None) if self._own_ceph else self.loop.create_future()
+        if not self._own_ceph:
+            future.set_result(None)
+        future.add_done_callback(lambda f: self._executor.shutdown(wait=False))
+        return future
+
+    def __aenter__(self):
+        future = self.loop.create_future()
+        future.set_result(self)
+        return future
+
+    def __aexit__(self, exc_type, exc_val, exc_tb):
+        return self.close()
+
+
+class _Dump(object):
+    """
+    Snapshot export as a chain of callbacks: every finished write starts the next aio_read.
+    Blocks are written to the file with pyaio completions, through executor threads if pyaio is not installed
+    """
+
+    def __init__(self, aceph, image_name, snap_name, fn, bs, in_flight, cb):
+        self.aceph = aceph
+        self.image_name = image_name
+        self.snap_name = snap_name
+        self.fn = fn
+        self.bs = bs
+        self.in_flight = max(1, int(in_flight))
+        self.cb = cb
+        self.future = aceph.loop.create_future()
+        self.image = None
+        self.fd = None
+        self._borrowed = None
+        self.blocks = None
+        self.total = 0
+        self.done = 0
+        self.pending = 0
+        self.error = None
+
+    def start(self):
+        opening = self.aceph._call(self._open)
+        opening.add_done_callback(self._opened)
+        return self.future
+
+    def _open(self):
+        ceph = self.aceph.ceph
+        if not ceph.is_snapshot_exists(self.image_name, self.snap_name):
+            logger.warn("No snapshot %s for image %s exists in cluster", self.snap_name, self.image_name)
+            return False
+        self._borrowed = ceph.images.open(self.image_name, self.snap_name)
+        self.image = self._borrowed.__enter__()
+        self.total = self.image.size()
+        self.bs = self.bs or 1 << self.image.stat()['order']
+        self.fd = os.open(self.fn, os.O_CREAT | os.O_WRONLY | os.O_TRUNC)
+        os.ftruncate(self.fd, self.total)
+        return True
+
+    def _opened(self, f):
+        if f.exception() is not None:
+            self.error = f.exception()
+            return self._finish()
+        if not f.result():
+            return self._finish(False)
+        self.blocks = extents(self.total, self.bs)
+        for _ in range(self.in_flight):
+            self._next()
+        if not self.pending:
+            self._finish()
+
+    def _next(self):
+        if self.error is not None or self.future.done():
+            return
+        try:
+            offset, length = next(self.blocks)
+        except StopIteration:
+            return
+        self.pending += 1
+        try:
+            read = self.aceph.read(self.image, offset, length)
+        except Exception as e:
+            return self._failed(e)
+        read.add_done_callback(partial(self._read_done, offset))
+
+    def _read_done(self, offset, f):
+        if f.exception() is not None:
+            return self._failed(f.exception())
+        data = f.result()
+        try:
+            write = self.aceph.write_file(self.fd, offset, data)
+        except Exception as e:
+            return self._failed(e)
+        write.add_done_callback(partial(self._written, len(data)))
+
+    def _written(self, length, f):
+        if f.exception() is not None:
+            return self._failed(f.exception())
+        BYTES.inc(length, 'written')
+        self.pending -= 1
+        self.done += length
+        if self.cb:
+            self.cb(self.done, self.total)
+        self._next()
+        if not self.pending:
+            self._finish()
+
+    def _failed(self, error):
+        self.pending -= 1
+        if self.error is None:
+            self.error = error
+        if not self.pending:
+            self._finish()
+
+    def _finish(self, result=True):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+        if self._borrowed is not None:
+            self._borrowed.__exit__(None, None, None)
+            self._borrowed = None
+        if self.error is not None:
+            logger.error("Error while exporting %s@%s: %s", self.image_name, self.snap_name, self.error)
+            result = False
+        if not self.future.done():
+            self.future.set_result(result)
@@ -0,0 +1,124 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+# Block size and reader count tuning for native exports
+from __future__ import division
+from itertools import chain
+from time import time
+
+from .ceph import logger
+from .queue import ParallelReader, extents, block_alignment, FADVISE_FLAGS, DEFAULT_READERS, DEFAULT_MAX_MEMORY
+
+DEFAULT_SAMPLE = 64 << 20  # bytes exported with every tried setting
+BLOCK_MULTIPLIERS = (1, 2, 4, 8)
+READER_COUNTS = (2, 4, 8, 16)
+
+
+class AutoTuner(object):
+    """
+    Export reader tuning block size and number of readers on the first part of the export.
+
+    Every tried setting exports the next :sample bytes and its end-to-end throughput is measured.
+    Block sizes are multiples of the object (or full stripe) size, first the block size is picked
+    with default readers, then the reader count with the picked block size. The rest of the image
+    is read with the best setting. Blocks are yielded in order, the same way as ParallelReader does.
+
+    >>> tuner = AutoTuner(image)
+    >>> for offset, data in tuner.read([(0, image.size())]):
+    ...     writer.write(offset, data)
+    >>> tuner.bs, tuner.readers, tuner.rate
+    """
+
+    def __init__(self, image, max_memory=DEFAULT_MAX_MEMORY, sample=DEFAULT_SAMPLE, flags=FADVISE_FLAGS,
+                 block_sizes=None, reader_counts=READER_COUNTS, readers=DEFAULT_READERS):
+        """
+        :param image: opened rbd image (or snapshot)
+        :type image: rbd.Image
+        :param max_memory: maximum bytes of blocks read ahead of the consumer
+        :type max_memory: int
+        :param sample: bytes read with every tried setting
+        :type sample: int
+        :param flags: fadvise flags passed to image.read
+        :type flags: int
+        :param block_sizes: block sizes to try (defaults to multiples of object or stripe size)
+        :type block_sizes: list
+        :param reader_counts: reader counts to try
+        :type reader_counts: list
+        :param readers: reader count used while block size is tuned
+        :type readers: int
+        """
+        self.image = image
+        self.max_memory = max_memory
+        self.sample = sample
+        self.flags = flags
+        alignment = block_alignment(image)
+        if block_sizes is None:
+            block_sizes = [alignment * m for m in BLOCK_MULTIPLIERS]
+        # Keep at least two blocks per reader in memory
+        self.block_sizes = [bs for bs in block_sizes if bs * readers * 2 <= max_memory] or [alignment]
+        self.reader_counts = reader_counts
+        self.bs = self.block_sizes[0]
+        self.readers = readers
+        self.rate = 0.0
+        self.trials = []
+        self._regions = []
+
+    def _take(self, amount, bs):
+        """Take next regions worth at least :amount bytes, ending at a multiple of :bs"""
+        taken = []
+        while self._regions and amount > 0:
+            offset, length = self._regions[0]
+            end = min(offset + length, -(-(offset + amount) // bs) * bs)
+            taken.append((offset, end - offset))
+            amount -= end - offset
+            if end < offset + length:
+                self._regions[0] = (end, offset + length - end)
+            else:
+                self._regions.pop(0)
+        return taken
+
+    def _blocks(self, regions, bs):
+        return chain.from_iterable(extents(offset + length, bs, offset) for offset, length in regions)
+
+    def _trial(self, bs, readers):
+        regions = self._take(max(self.sample, bs * readers * 2), bs)
+        if not regions:
+            return
+        engine = ParallelReader(self.image, self._blocks(regions, bs), bs, readers=readers,
+                                max_memory=self.max_memory, flags=self.flags)
+        started = time()
+        size = 0
+        for block in engine:
+            size += len(block[1])
+            yield block
+        elapsed = max(time() - started, 1e-6)
+        rate = size / elapsed / 1024 ** 2
+        latency = engine.read_seconds / engine.reads if engine.reads else 0.0
+        self.trials.append((bs, readers, rate, latency))
+        logger.debug("Tried bs=%d readers=%d: %.1f MB/s, %.1f ms per read", bs, readers, rate, latency * 1000)
+        if rate > self.rate:
+            self.bs, self.readers, self.rate = bs, readers, rate
+
+    def read(self, regions):
+        """
+        Read regions of the image, tuning on the way
+        :param regions: sorted (offset, length) ranges to read
+        :type regions: list
+        :return: generator of (offset, data)
+        :rtype: generator
+        """
+        self._regions = list(regions)
+        default_readers = self.readers
+        for bs in self.block_sizes:
+            for block in self._trial(bs, default_readers):
+                yield block
+        for readers in self.reader_counts:
+            if readers == default_readers or self.bs * readers * 2 > self.max_memory:
+                continue
+            for block in self._trial(self.bs, readers):
+                yield block
+        logger.info("Tuned export: bs=%d readers=%d (%.1f MB/s)", self.bs, self.readers, self.rate)
+        if self._regions:
+            regions, self._regions = self._regions, []
+            for block in ParallelReader(self.image, self._blocks(regions, self.bs), self.bs, readers=self.readers,
+                                        max_memory=self.max_memory, flags=self.flags):
+                yield block
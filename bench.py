@@ -0,0 +1,608 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+# Benchmarks of export, import and diff paths against a cluster or the in-memory fake backend
+from __future__ import division, print_function
+import argparse
+import json
+import os
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+from collections import OrderedDict
+from contextlib import contextmanager
+from threading import Lock
+from time import time
+
+SNAP_BASE = 'bench-base'
+SNAP_TOP = 'bench-top'
+SNAP_TOP2 = 'bench-top2'
+IMPORT_IMAGE = 'bench-import'
+PERCENTILES = (50, 90, 99)
+# Native modules `import pyceph` must not load, they are imported by the first cluster operation
+HEAVY_MODULES = ('rbd', 'rados', 'pyaio')
+IMPORT_SCRIPT = '''
+import json, sys
+from time import time
+started = time()
+import %s
+print(json.dumps([time() - started, [name for name in %r if sys.modules.get(name) is not None]]))
+'''
+
+
+def _noop(*args):
+    pass
+
+
+class OpStats(object):
+    """Latencies of operations by name"""
+
+    def __init__(self):
+        self._ops = {}
+        self._lock = Lock()
+
+    def add(self, name, seconds):
+        with self._lock:
+            self._ops.setdefault(name, []).append(seconds)
+
+    def reset(self):
+        with self._lock:
+            self._ops = {}
+
+    def summary(self):
+        """
+        :return: op name -> count, percentiles and maximum in milliseconds
+        :rtype: dict
+        """
+        result = {}
+        with self._lock:
+            ops = dict((name, sorted(values)) for name, values in self._ops.items())
+        for name, values in ops.items():
+            summary = OrderedDict([('count', len(values))])
+            for p in PERCENTILES:
+                summary['p%d_ms' % p] = round(values[min(len(values) - 1, len(values) * p // 100)] * 1000, 3)
+            summary['max_ms'] = round(values[-1] * 1000, 3)
+            result[name] = summary
+        return result
+
+
+class TimedImage(object):
+    """Proxy of rbd.Image recording latency of data operations"""
+
+    def __init__(self, image, stats):
+        self._image = image
+        self._stats = stats
+
+    def __getattr__(self, name):
+        return getattr(self._image, name)
+
+    def _timed(self, name, method, *args, **kwargs):
+        started = time()
+        try:
+            return method(*args, **kwargs)
+        finally:
+            self._stats.add(name, time() - started)
+
+    def read(self, *args, **kwargs):
+        return self._timed('read', self._image.read, *args, **kwargs)
+
+    def write(self, *args, **kwargs):
+        return self._timed('write', self._image.write, *args, **kwargs)
+
+    def discard(self, *args, **kwargs):
+        return self._timed('discard', self._image.discard, *args, **kwargs)
+
+    def diff_iterate(self, *args, **kwargs):
+        return self._timed('diff_iterate', self._image.diff_iterate, *args, **kwargs)
+
+    def aio_read(self, offset, length, oncomplete, *args):
+        started = time()
+
+        def done(completion, data):
+            self._stats.add('aio_read', time() - started)
+            return oncomplete(completion, data)
+        return self._image.aio_read(offset, length, done, *args)
+
+    def aio_write(self, data, offset, oncomplete, *args):
+        started = time()
+
+        def done(completion):
+            self._stats.add('aio_write', time() - started)
+            return oncomplete(completion)
+        return self._image.aio_write(data, offset, done, *args)
+
+
+def _rss():
+    """Current resident set size in bytes"""
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * resource.getpagesize()
+    except (IOError, OSError):
+        return None
+
+
+def _usage():
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    cpu = own.ru_utime + own.ru_stime + children.ru_utime + children.ru_stime
+    # ru_maxrss is in kilobytes on Linux
+    return cpu, max(own.ru_maxrss, children.ru_maxrss) * 1024
+
+
+class Bench(object):
+    """
+    Benchmark fixture: image with three snapshots, its base export and diffs between snapshots.
+    Images are populated only once on a real cluster and reused by later runs
+    """
+
+    def __init__(self, ceph, image, size, order=22, sparseness=0.0, change=0.1, readers=None, workdir=None,
+                 pool='rbd', cli=False, seed=0):
+        """
+        :param ceph: connected Ceph object
+        :type ceph: ceph.Ceph
+        :param image: name of benchmark image
+        :type image: str
+        :param size: image size in bytes
+        :type size: int
+        :param order: object size order of created image
+        :type order: int
+        :param sparseness: share of objects never written
+        :type sparseness: float
+        :param change: share of objects changed between snapshots
+        :type change: float
+        :param readers: number of readers of the parallel export
+        :type readers: int
+        :param workdir: directory of exported files (temporary by default)
+        :type workdir: str
+        :param pool: pool of benchmark image
+        :type pool: str
+        :param cli: run the cases calling rbd executable as well
+        :type cli: bool
+        :param seed: seed of the random layout
+        :type seed: int
+        """
+        from .queue import DEFAULT_READERS
+
+        self.ceph = ceph
+        self.image = image
+        self.size = size
+        self.order = order
+        self.sparseness = sparseness
+        self.change = change
+        self.readers = readers or DEFAULT_READERS
+        self.pool = pool
+        self.cli = cli
+        self.random = random.Random(seed)
+        self.own_workdir = workdir is None
+        self.workdir = workdir or tempfile.mkdtemp(prefix='pyceph-bench-')
+        if not os.path.isdir(self.workdir):
+            os.makedirs(self.workdir)
+        self.stats = OpStats()
+        self.measured = None
+
+    def path(self, name):
+        return os.path.join(self.workdir, name)
+
+    def _write_snapshots(self):
+        from .ceph import RBDFeatures
+
+        self.ceph.rbd.create(self.ceph.ioctx, self.image, self.size, order=self.order, old_format=False,
+                             features=RBDFeatures.default_features())
+        obj = 1 << self.order
+        count = (self.size + obj - 1) // obj
+        with self.ceph.images.open(self.image) as image:
+            for index in range(count):
+                if self.random.random() >= self.sparseness:
+                    image.write(os.urandom(min(obj, self.size - index * obj)), index * obj)
+            for snap in (SNAP_BASE, SNAP_TOP):
+                self.ceph.create_snapshot(self.image, snap)
+                for index in self.random.sample(range(count), max(1, int(count * self.change))):
+                    offset = index * obj
+                    length = min(obj, self.size - offset)
+                    if self.random.random() < 0.25:
+                        image.discard(offset, length)
+                    else:
+                        start = self.random.randrange(0, length, 4096)
+                        image.write(os.urandom(min(64 << 10, length - start)), offset + start)
+            self.ceph.create_snapshot(self.image, SNAP_TOP2)
+
+    def setup(self):
+        """Populate image if missing, export base snapshot and diffs between snapshots"""
+        if not self.ceph.is_snapshot_exists(self.image, SNAP_TOP2):
+            if self.ceph.is_image_exists(self.image):
+                raise ValueError("Image %s exists, but is not a benchmark image" % self.image)
+            self._write_snapshots()
+        if not self.ceph.create_dump_native(self.image, SNAP_BASE, self.path('base.raw'), cb=_noop, sparse=True):
+            raise IOError("Failed to export %s@%s" % (self.image, SNAP_BASE))
+        for name, from_snap, snap in (('top.diff', SNAP_BASE, SNAP_TOP), ('top2.diff', SNAP_TOP, SNAP_TOP2)):
+            with open(self.path(name), 'wb') as ofh:
+                if not self.ceph.create_diff_native(self.image, snap, ofh, from_snap=from_snap):
+                    raise IOError("Failed to export diff of %s@%s" % (self.image, snap))
+        # Handles opened so far are not timed
+        self.ceph.images.close()
+        self.ceph.images.wrapper = lambda image: TimedImage(image, self.stats)
+
+    def cleanup(self, remove_image=False):
+        self.ceph.images.close()
+        if self.own_workdir:
+            shutil.rmtree(self.workdir, ignore_errors=True)
+        if remove_image:
+            for snap in (SNAP_BASE, SNAP_TOP, SNAP_TOP2):
+                self.ceph.remove_snapshot(self.image, snap, force=True)
+            self.ceph.images.invalidate(self.image, all_snapshots=True)
+            self.ceph.rbd.remove(self.ceph.ioctx, self.image)
+
+    @contextmanager
+    def measure(self, length):
+        """Measure wall and CPU time and memory of the block processing :length bytes"""
+        self.stats.reset()
+        rss = _rss()
+        cpu, peak_rss = _usage()
+        started = time()
+        yield
+        seconds = time() - started
+        cpu_after, peak_rss_after = _usage()
+        self.measured = OrderedDict([
+            ('bytes', length),
+            ('seconds', seconds),
+            ('cpu_seconds', round(cpu_after - cpu, 6)),
+            ('rss_start', rss),
+            ('peak_rss', peak_rss_after),
+            ('peak_rss_grew', peak_rss_after > peak_rss),
+            ('ops', self.stats.summary()),
+        ])
+
+    def run(self, name):
+        """
+        Run benchmark case
+        :param name: name from CASES
+        :type name: str
+        :return: measurements, None if the case does not apply to this setup
+        :rtype: dict
+        """
+        self.measured = None
+        CASES[name](self)
+        if self.measured is None:
+            return None
+        measured = self.measured
+        seconds = measured.pop('seconds')
+        result = OrderedDict([('case', name), ('bytes', measured.pop('bytes')), ('seconds', round(seconds, 6))])
+        result['mb_per_s'] = round(result['bytes'] / max(seconds, 1e-9) / 1024 ** 2, 3)
+        result.update(measured)
+        return result
+
+
+def _export(bench, **kwargs):
+    path = bench.path('export.raw')
+    with bench.measure(bench.size):
+        ok = bench.ceph.create_dump_native(bench.image, SNAP_TOP, path, cb=_noop, **kwargs)
+    os.unlink(path)
+    if not ok:
+        raise IOError("Export of %s@%s failed" % (bench.image, SNAP_TOP))
+
+
+def case_export_popen(bench):
+    if not bench.cli:
+        return
+    with bench.measure(bench.size):
+        ok = bench.ceph.create_dump(bench.image, SNAP_TOP, bench.workdir, pool=bench.pool)
+    os.unlink(bench.path(SNAP_TOP))
+    if not ok:
+        raise IOError("rbd export of %s@%s failed" % (bench.image, SNAP_TOP))
+
+
+def case_export_native(bench):
+    _export(bench, readers=1)
+
+
+def case_export_parallel(bench):
+    _export(bench, readers=bench.readers)
+
+
+def case_export_auto(bench):
+    _export(bench, readers=bench.readers, bs='auto')
+
+
+def case_export_sparse(bench):
+    _export(bench, readers=bench.readers, sparse=True)
+
+
+def case_export_aio(bench):
+    from .lazy import pyaio
+
+    try:
+        pyaio.aio_write
+    except ImportError:
+        return
+    _export(bench, readers=bench.readers, aio=True)
+
+
+def case_export_diff(bench):
+    path = bench.path('export.diff')
+    with open(path, 'wb') as ofh:
+        with bench.measure(bench.size):
+            ok = bench.ceph.create_diff_native(bench.image, SNAP_TOP, ofh, from_snap=SNAP_BASE,
+                                               readers=bench.readers)
+    bench.measured['bytes'] = os.path.getsize(path)
+    os.unlink(path)
+    if not ok:
+        raise IOError("Diff export of %s@%s failed" % (bench.image, SNAP_TOP))
+
+
+def case_export_diff_rbd(bench):
+    from .export_diff import export_diff
+
+    if not bench.cli:
+        return
+    path = bench.path('export.diff')
+    with bench.measure(0):
+        if export_diff(bench.pool, bench.image, SNAP_TOP, path, basis=SNAP_BASE).wait():
+            raise IOError("rbd export-diff of %s@%s failed" % (bench.image, SNAP_TOP))
+    bench.measured['bytes'] = os.path.getsize(path)
+    os.unlink(path)
+
+
+def case_apply_diff(bench):
+    from .export_diff import apply_diff
+
+    path = bench.path('apply.raw')
+    shutil.copyfile(bench.path('base.raw'), path)
+    with open(bench.path('top.diff'), 'rb') as ifh:
+        with open(path, 'r+b') as ofh:
+            with bench.measure(os.path.getsize(bench.path('top.diff'))):
+                apply_diff(ifh, ofh, verbose=False)
+    os.unlink(path)
+
+
+def case_merge_diff(bench):
+    from .export_diff import merge_diff_native
+
+    sources = [bench.path('top.diff'), bench.path('top2.diff')]
+    path = bench.path('merged.diff')
+    ifhs = [open(source, 'rb') for source in sources]
+    try:
+        with open(path, 'wb') as ofh:
+            with bench.measure(sum(os.path.getsize(source) for source in sources)):
+                merge_diff_native(ifhs, ofh)
+    finally:
+        for ifh in ifhs:
+            ifh.close()
+    os.unlink(path)
+
+
+def case_merge_diff_rbd(bench):
+    from .export_diff import merge_diff
+
+    if not bench.cli:
+        return
+    sources = [bench.path('top.diff'), bench.path('top2.diff')]
+    path = bench.path('merged.diff')
+    with bench.measure(sum(os.path.getsize(source) for source in sources)):
+        if merge_diff(bench.pool, sources[0], sources[1], path).wait():
+            raise IOError("rbd merge-diff failed")
+    os.unlink(path)
+
+
+def case_index_build(bench):
+    from .diff_index import build_index
+
+    diff = bench.path('top.diff')
+    with bench.measure(os.path.getsize(diff)):
+        index = build_index(diff)
+    os.unlink(index)
+
+
+def case_index_read(bench, reads=1000, length=64 << 10):
+    from .diff_index import build_index, DiffReader
+
+    diff = bench.path('top.diff')
+    index = build_index(diff)
+    offsets = [bench.random.randrange(0, max(1, bench.size - length)) for _ in range(reads)]
+    with DiffReader(diff, index) as reader:
+        with bench.measure(reads * length):
+            for offset in offsets:
+                started = time()
+                reader.read(offset, length)
+                bench.stats.add('diff_read', time() - started)
+    os.unlink(index)
+
+
+def case_import(bench):
+    path = bench.path('base.raw')
+    with bench.measure(os.path.getsize(path)):
+        ok = bench.ceph.import_image(path, IMPORT_IMAGE, cb=_noop)
+    bench.ceph.images.invalidate(IMPORT_IMAGE)
+    bench.ceph.rbd.remove(bench.ceph.ioctx, IMPORT_IMAGE)
+    if not ok:
+        raise IOError("Import of %s failed" % path)
+
+
+CASES = OrderedDict([
+    ('export_popen', case_export_popen),
+    ('export_native', case_export_native),
+    ('export_parallel', case_export_parallel),
+    ('export_auto', case_export_auto),
+    ('export_sparse', case_export_sparse),
+    ('export_aio', case_export_aio),
+    ('export_diff', case_export_diff),
+    ('export_diff_rbd', case_export_diff_rbd),
+    ('apply_diff', case_apply_diff),
+    ('merge_diff', case_merge_diff),
+    ('merge_diff_rbd', case_merge_diff_rbd),
+    ('index_build', case_index_build),
+    ('index_read', case_index_read),
+    ('import', case_import),
+])
+
+
+def compare(results, baseline, tolerance):
+    """
+    Find cases slower than in baseline report
+    :param results: results of this run
+    :type results: list
+    :param baseline: results of the baseline run
+    :type baseline: list
+    :param tolerance: allowed relative slowdown
+    :type tolerance: float
+    :return: (case, baseline MB/s, current MB/s) of regressed cases
+    :rtype: list
+    """
+    before = dict((result['case'], result['mb_per_s']) for result in baseline)
+    regressions = []
+    for result in results:
+        rate = before.get(result['case'])
+        if rate and result['mb_per_s'] < rate * (1 - tolerance):
+            regressions.append((result['case'], rate, result['mb_per_s']))
+    return regressions
+
+
+def measure_import(repeats=5):
+    """
+    Time `import pyceph` in fresh interpreters
+    :param repeats: number of interpreters started, the fastest one counts
+    :type repeats: int
+    :return: import time in ms and heavy modules the import loaded
+    :rtype: OrderedDict
+    """
+    package = __package__ or 'pyceph'
+    env = dict(os.environ)
+    parent = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env['PYTHONPATH'] = os.pathsep.join(path for path in (parent, env.get('PYTHONPATH')) if path)
+    timings = []
+    loaded = set()
+    for _ in range(max(1, repeats)):
+        output = subprocess.check_output([sys.executable, '-c', IMPORT_SCRIPT % (package, HEAVY_MODULES)], env=env)
+        seconds, modules = json.loads(output.decode('utf-8').strip().splitlines()[-1])
+        timings.append(seconds)
+        loaded.update(modules)
+    return OrderedDict([
+        ('ms', round(min(timings) * 1000, 2)),
+        ('max_ms', round(max(timings) * 1000, 2)),
+        ('repeats', len(timings)),
+        ('heavy_modules', sorted(loaded)),
+    ])
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark pyceph export, import and diff paths")
+    parser.add_argument('--backend', choices=('fake', 'ceph'), default='fake')
+    parser.add_argument('--pool', default='rbd')
+    parser.add_argument('--conffile', default='/etc/ceph/ceph.conf')
+    parser.add_argument('--cluster', default='ceph')
+    parser.add_argument('--image', default='pyceph-bench')
+    parser.add_argument('--size', type=int, default=256, help="image size in MiB")
+    parser.add_argument('--order', type=int, default=22)
+    parser.add_argument('--sparseness', type=float, default=0.0, help="share of objects never written")
+    parser.add_argument('--change', type=float, default=0.1, help="share of objects changed between snapshots")
+    parser.add_argument('--latency', type=float, default=0.001, help="fake backend: seconds per operation")
+    parser.add_argument('--bandwidth', type=float, default=0, help="fake backend: MiB per second, 0 is unlimited")
+    parser.add_argument('--readers', type=int, default=None)
+    parser.add_argument('--workdir', default=None)
+    parser.add_argument('--cases', default=','.join(CASES), help="comma separated list of cases")
+    parser.add_argument('--isolate', action='store_true', help="run every case in its own process")
+    parser.add_argument('--cleanup', action='store_true', help="remove benchmark image from cluster afterwards")
+    parser.add_argument('--output', default=None, help="JSON report path, stdout by default")
+    parser.add_argument('--baseline', default=None, help="JSON report to compare MB/s with")
+    parser.add_argument('--tolerance', type=float, default=0.1, help="allowed slowdown against baseline")
+    parser.add_argument('--import-budget', type=float, default=None,
+                        help="measure `import pyceph` and fail above this many ms or if it loads native modules")
+    parser.add_argument('--import-repeats', type=int, default=5)
+    args = parser.parse_args(argv)
+    args.cases = [case for case in args.cases.split(',') if case]
+    for case in args.cases:
+        if case not in CASES:
+            parser.error("unknown case %s" % case)
+    return args
+
+
+def run(args):
+    """
+    Run benchmark cases in this process
+    :return: results of cases which apply to this setup
+    :rtype: list
+    """
+    if args.backend == 'fake':
+        from . import fakerbd
+        cluster = fakerbd.install(fakerbd.Cluster(pools=(args.pool,)))
+    from .ceph import Ceph, which
+
+    with Ceph(args.pool, args.conffile, args.cluster) as ceph:
+        bench = Bench(ceph, args.image, args.size << 20, order=args.order, sparseness=args.sparseness,
+                      change=args.change, readers=args.readers, workdir=args.workdir, pool=args.pool,
+                      cli=args.backend == 'ceph' and bool(which('rbd')))
+        try:
+            bench.setup()
+            if args.backend == 'fake':
+                cluster.link = fakerbd.Link(args.latency, args.bandwidth * 1024 ** 2 or None)
+            results = []
+            for case in args.cases:
+                result = bench.run(case)
+                if result is not None:
+                    results.append(result)
+            return results
+        finally:
+            bench.cleanup(remove_image=args.cleanup)
+
+
+def run_isolated(args, argv):
+    """Run every case in a child process, so CPU time and peak RSS are its own"""
+    base = []
+    skip = False
+    for arg in argv:
+        if skip:
+            skip = False
+        elif arg.split('=', 1)[0] in ('--cases', '--output', '--baseline', '--import-budget', '--import-repeats'):
+            skip = '=' not in arg
+        elif arg != '--isolate':
+            base.append(arg)
+    results = []
+    for case in args.cases:
+        cmd = [sys.executable, '-m', __package__ + '.bench'] + base + ['--cases', case]
+        report = json.loads(subprocess.check_output(cmd).decode('utf-8'))
+        results.extend(report['results'])
+    return results
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    args = parse_args(argv)
+    # `--cases ''` checks only the import budget
+    startup = measure_import(args.import_repeats) if args.import_budget is not None else None
+    results = run_isolated(args, argv) if args.isolate else run(args) if args.cases else []
+    report = OrderedDict([
+        ('backend', args.backend),
+        ('python', sys.version.split()[0]),
+        ('params', OrderedDict((key, getattr(args, key)) for key in (
+            'pool', 'image', 'size', 'order', 'sparseness', 'change', 'latency', 'bandwidth', 'readers'))),
+        ('results', results),
+    ])
+    if startup:
+        report['import'] = startup
+    text = json.dumps(report, indent=2)
+    if args.output and args.output != '-':
+        with open(args.output, 'w') as out:
+            out.write(text + '\n')
+    else:
+        print(text)
+    status = 0
+    if startup:
+        if startup['ms'] > args.import_budget:
+            sys.stderr.write("Import takes %.1f ms, budget is %.1f ms\n" % (startup['ms'], args.import_budget))
+            status = 1
+        if startup['heavy_modules']:
+            sys.stderr.write("Import loads %s\n" % ', '.join(startup['heavy_modules']))
+            status = 1
+    if args.baseline:
+        with open(args.baseline) as baseline:
+            regressions = compare(results, json.load(baseline)['results'], args.tolerance)
+        for case, before, now in regressions:
+            sys.stderr.write("Regression in %s: %.1f MB/s -> %.1f MB/s\n" % (case, before, now))
+        if regressions:
+            status = 1
+    return status
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,258 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+# Caches of cluster state used by Ceph objects
+from collections import OrderedDict, namedtuple
+from contextlib import contextmanager
+from threading import Lock
+from time import time
+
+from .lazy import rbd
+from .metrics import OP_SECONDS, CACHED_IMAGES
+
+DEFAULT_IMAGE_CACHE_SIZE = 32
+DEFAULT_IMAGE_IDLE_TIMEOUT = 60
+DEFAULT_SNAPSHOT_TTL = 30
+
+
+class _CachedImage(object):
+    __slots__ = ('image', 'used', 'pins', 'evicted')
+
+    def __init__(self, image):
+        self.image = image
+        self.used = time()
+        self.pins = 0
+        self.evicted = False
+
+
+class ImageCache(object):
+    """
+    LRU cache of open image handles keyed by (image name, snapshot name).
+    Handles in use are pinned and never closed under the user, they are closed when released
+    if were evicted or invalidated meanwhile.
+
+    >>> with cache.open('vm-1-disk-1') as image:
+    ...     image.stat()
+    """
+
+    def __init__(self, ioctx, max_size=DEFAULT_IMAGE_CACHE_SIZE, idle_timeout=DEFAULT_IMAGE_IDLE_TIMEOUT,
+                 wrapper=None):
+        """
+        :param ioctx: pool ioctx images are opened in
+        :type ioctx: rados.Ioctx
+        :param max_size: maximum number of open handles
+        :type max_size: int
+        :param idle_timeout: close handles unused for this number of seconds
+        :type idle_timeout: int
+        :param wrapper: called with every newly opened image, the returned object is cached instead
+        :type wrapper: callable
+        """
+        self.ioctx = ioctx
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.wrapper = wrapper
+        self._entries = OrderedDict()
+        self._lock = Lock()
+
+    def _detach(self, entry, closing):
+        """Mark removed :entry evicted, it is appended to :closing if nobody holds it. Called under lock"""
+        entry.evicted = True
+        if not entry.pins:
+            closing.append(entry)
+
+    @staticmethod
+    def _close(closing):
+        """Close detached handles, outside of the lock as every close is a cluster round trip"""
+        for entry in closing:
+            entry.image.close()
+            CACHED_IMAGES.dec()
+
+    def _evict(self, closing):
+        now = time()
+        for key, entry in list(self._entries.items()):
+            if entry.pins:
+                continue
+            if len(self._entries) > self.max_size or now - entry.used > self.idle_timeout:
+                del self._entries[key]
+                self._detach(entry, closing)
+
+    def _acquire(self, key):
+        closing = []
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self._entries[key] = entry
+                entry.pins += 1
+                entry.used = time()
+                # Handles idle past the timeout are closed on hits too
+                self._evict(closing)
+        if entry is not None:
+            self._close(closing)
+            return entry
+        started = time()
+        image = rbd.Image(self.ioctx, key[0], snapshot=key[1])
+        OP_SECONDS.observe(time() - started, 'open')
+        if self.wrapper is not None:
+            image = self.wrapper(image)
+        duplicate = None
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                # Opened concurrently by another thread
+                duplicate = image
+            else:
+                entry = self._entries[key] = _CachedImage(image)
+                CACHED_IMAGES.inc()
+            entry.pins += 1
+            entry.used = time()
+            self._evict(closing)
+        if duplicate is not None:
+            duplicate.close()
+        self._close(closing)
+        return entry
+
+    def _release(self, entry):
+        closing = []
+        with self._lock:
+            entry.pins -= 1
+            if entry.pins:
+                return
+            if entry.evicted:
+                closing.append(entry)
+            else:
+                entry.used = time()
+                # Handles pinned while the cache grew past max_size are trimmed once free
+                self._evict(closing)
+        self._close(closing)
+
+    @contextmanager
+    def open(self, image_name, snapshot=None):
+        """
+        Borrow image handle, opening it if not cached
+        :param image_name: name of image in cluster
+        :type image_name: str
+        :param snapshot: name of snapshot to open image at
+        :type snapshot: str
+        :rtype: rbd.Image
+        """
+        entry = self._acquire((image_name, snapshot))
+        try:
+            yield entry.image
+        finally:
+            self._release(entry)
+
+    def invalidate(self, image_name, snapshot=None, all_snapshots=False):
+        """
+        Close cached handles of image
+        :param image_name: name of image in cluster
+        :type image_name: str
+        :param snapshot: only handle opened at this snapshot
+        :type snapshot: str
+        :param all_snapshots: every handle of the image, head and snapshots
+        :type all_snapshots: bool
+        """
+        closing = []
+        with self._lock:
+            for key in list(self._entries):
+                if key[0] == image_name and (all_snapshots or key[1] == snapshot):
+                    self._detach(self._entries.pop(key), closing)
+        self._close(closing)
+
+    def prune(self):
+        """Close idle handles"""
+        closing = []
+        with self._lock:
+            self._evict(closing)
+        self._close(closing)
+
+    def close(self):
+        """Close all handles"""
+        closing = []
+        with self._lock:
+            entries = list(self._entries.values())
+            self._entries.clear()
+            for entry in entries:
+                self._detach(entry, closing)
+        self._close(closing)
+
+    def __len__(self):
+        return len(self._entries)
+
+
+SnapshotInfo = namedtuple('SnapshotInfo', ['id', 'size', 'protected'])
+
+
+class SnapshotIndex(object):
+    """
+    Per image snapshot metadata keyed by exact snapshot name.
+    Image entry is filled by a single listing, kept up to date by the callers changing snapshots
+    and expires after :ttl seconds to catch up with changes made by others
+    """
+
+    def __init__(self, ttl=DEFAULT_SNAPSHOT_TTL):
+        """
+        :param ttl: seconds an image listing is trusted
+        :type ttl: int
+        """
+        self.ttl = ttl
+        self._images = {}
+        self._lock = Lock()
+
+    def get(self, image_name):
+        """
+        Cached snapshots of image
+        :param image_name: name of image in cluster
+        :type image_name: str
+        :return: snapshot name -> SnapshotInfo, None if not cached or expired
+        :rtype: dict
+        """
+        with self._lock:
+            cached = self._images.get(image_name)
+            if cached is None:
+                return None
+            if time() > cached[0]:
+                del self._images[image_name]
+                return None
+            return cached[1]
+
+    def load(self, image_name, image):
+        """
+        List snapshots of opened image and cache them
+        :param image_name: name of image in cluster
+        :type image_name: str
+        :param image: opened image
+        :type image: rbd.Image
+        :return: snapshot name -> SnapshotInfo
+        :rtype: dict
+        """
+        snapshots = {}
+        for snap in image.list_snaps():
+            snapshots[snap['name']] = SnapshotInfo(snap['id'], snap['size'], image.is_protected_snap(snap['name']))
+        with self._lock:
+            self._images[image_name] = (time() + self.ttl, snapshots)
+        return snapshots
+
+    def add(self, image_name, snap_name, info):
+        with self._lock:
+            cached = self._images.get(image_name)
+            if cached is not None:
+                cached[1][snap_name] = info
+
+    def update(self, image_name, snap_name, **fields):
+        with self._lock:
+            cached = self._images.get(image_name)
+            if cached is not None and snap_name in cached[1]:
+                cached[1][snap_name] = cached[1][snap_name]._replace(**fields)
+
+    def remove(self, image_name, snap_name):
+        with self._lock:
+            cached = self._images.get(image_name)
+            if cached is not None:
+                cached[1].pop(snap_name, None)
+
+    def invalidate(self, image_name=None):
+        """Forget one image or everything"""
+        with self._lock:
+            if image_name is None:
+                self._images.clear()
+            else:
+                self._images.pop(image_name, None)
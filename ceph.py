@@ -4,18 +4,29 @@
 from __future__ import division
 
 __author__ = 'selfin'
-import rbd
-from subprocess import check_output, CalledProcessError, STDOUT
-from rados import Rados
-from rados import ObjectNotFound
 import logging
 import os
-import pyaio
+import sys
+from collections import namedtuple
+from time import time
+
+from .lazy import rbd, rados
+from .metrics import tracked, BYTES, OP_SECONDS
+from .cache import ImageCache, SnapshotIndex, SnapshotInfo, DEFAULT_IMAGE_CACHE_SIZE, DEFAULT_IMAGE_IDLE_TIMEOUT, \
+    DEFAULT_SNAPSHOT_TTL
+from .queue import DEFAULT_READERS, DEFAULT_MAX_MEMORY, DEFAULT_IN_FLIGHT, DEFAULT_AIO_MEMORY
+from .manifest import DEFAULT_HASH_WORKERS
+from .compress import DEFAULT_COMPRESS_WORKERS
+
+try:
+    text_type = unicode
+except NameError:  # python 3
+    text_type = str
 
 logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+# Applications choose their own logging setup, FORMAT is what `python -m pyceph` uses
 FORMAT = "[%(filename)s:%(lineno)s - %(funcName)20s() ] %(message)s"
-logging.basicConfig(format=FORMAT)
-logger.setLevel(logging.DEBUG)
 
 
 class PoolNotFound(Exception):
@@ -37,9 +48,51 @@ class RBDFeatures(object):
 
     @staticmethod
     def parse_features(features):
-        bytes_map = {v: k for k, v in RBDFeatures.__dict__.iteritems() if k.startswith("RBD")}
+        bytes_map = {v: k for k, v in RBDFeatures.__dict__.items() if k.startswith("RBD")}
+
+        return ",".join([name for byte, name in bytes_map.items() if byte & features])
+
+
+IMAGE_INFO_FIELDS = ('stat', 'features')
+DEFAULT_INFO_WORKERS = 16
+
+DEFAULT_BULK_WORKERS = 16
+
+ImageInfo = namedtuple('ImageInfo', ['name', 'stat', 'features', 'error'])
+SnapshotResult = namedtuple('SnapshotResult', ['image', 'snapshot', 'ok', 'error'])
+
+
+def sizeof_fmt(num, suffix='B'):
+    for unit in ['', 'Ki', 'Mi', 'Gi', 'Ti', 'Pi', 'Ei', 'Zi']:
+        if abs(num) < 1024.0:
+            return "%3.1f%s%s" % (num, unit, suffix)
+        num /= 1024.0
+    return "%.1f%s%s" % (num, 'Yi', suffix)
+
+
+def print_progress(cur, total):
+    progress = cur / total * 100 if total else 100
+    if not progress == 100:
+        sys.stdout.write('\rProgress: %d%%(%s/%s)...' % (progress, sizeof_fmt(cur), sizeof_fmt(total)))
+    else:
+        sys.stdout.write("\r" + " " * 50 + "\rProgress: %d%%...done.\n" % progress)
+    sys.stdout.flush()
+
 
-        return ",".join([name for byte, name in bytes_map.iteritems() if byte & features])
+def make_bucket(speed_limit=None, parent=None):
+    """
+    Rate limiter of single operation
+    :param speed_limit: bytes per second allowed to the operation
+    :type speed_limit: int
+    :param parent: shared limiter the operation takes part in
+    :type parent: tokenbucket.TokenBucket
+    :return: limiter chained to :parent, :parent itself without own limit
+    :rtype: tokenbucket.TokenBucket
+    """
+    from .tokenbucket import TokenBucket
+    if speed_limit:
+        return TokenBucket(int(speed_limit), int(speed_limit), parent=parent)
+    return parent
 
 
 def which(program):
@@ -80,13 +133,13 @@ class Ceph(object):
             new_args = []
             new_kwargs = {}
             for arg in args:
-                if isinstance(arg, unicode):
+                if isinstance(arg, text_type):
                     new_args.append(str(arg))
                 else:
                     new_args.append(arg)
 
-            for k, v in kwargs.iteritems():
-                if isinstance(v, unicode):
+            for k, v in kwargs.items():
+                if isinstance(v, text_type):
                     new_kwargs[k] = str(v)
                 else:
                     new_kwargs[k] = v
@@ -96,33 +149,61 @@ class Ceph(object):
         return inner
 
     @convert_to_str
-    def __init__(self, pool='rbd', conffile='/etc/ceph/ceph.conf', cluster='ceph'):
+    def __init__(self, pool='rbd', conffile='/etc/ceph/ceph.conf', cluster='ceph', shared=False,
+                 image_cache_size=DEFAULT_IMAGE_CACHE_SIZE, image_idle_timeout=DEFAULT_IMAGE_IDLE_TIMEOUT,
+                 snapshot_ttl=DEFAULT_SNAPSHOT_TTL):
         """
         Init
         :param pool: Ceph cluster pool
         :type pool: str
         :param conffile: Path to ceph.conf file
         :type conffile: str
+        :param cluster: Ceph cluster name
+        :type cluster: str
+        :param shared: borrow connection and ioctx from process-wide pool instead of connecting
+        :type shared: bool
+        :param image_cache_size: maximum number of open image handles kept by this object
+        :type image_cache_size: int
+        :param image_idle_timeout: close image handles unused for this number of seconds
+        :type image_idle_timeout: int
+        :param snapshot_ttl: seconds a cached snapshot listing of image is trusted
+        :type snapshot_ttl: int
         """
         self.pool = str(pool)
-        self.cluster = Rados(conffile=conffile, clustername=cluster)
+        self.shared = shared
+        self.snapshots = SnapshotIndex(snapshot_ttl)
+        if shared:
+            from .connection import connections
+            connection = connections.get(conffile, cluster)
+            self.cluster = connection.cluster
+            self.ioctx = connection.ioctx(self.pool)
+            self.rbd = rbd.RBD()
+            self.images = ImageCache(self.ioctx, image_cache_size, image_idle_timeout)
+            return
+        self.cluster = rados.Rados(conffile=conffile, clustername=cluster)
         try:
+            started = time()
             self.cluster.connect()
+            OP_SECONDS.observe(time() - started, 'connect')
             self.ioctx = self.cluster.open_ioctx(self.pool)
             self.rbd = rbd.RBD()
-        except ObjectNotFound:
+        except rados.ObjectNotFound:
             raise PoolNotFound("No pool %s found" % self.pool)
+        self.images = ImageCache(self.ioctx, image_cache_size, image_idle_timeout)
 
     def __enter__(self):
         return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
-        self.cluster.shutdown()
+        self.images.close()
+        if not self.shared:
+            self.cluster.shutdown()
 
     @convert_to_str
     def get_image_stat(self, image_name):
         if self.is_image_exists(image_name):
-            return rbd.Image(self.ioctx, image_name).stat()
+            with self.images.open(image_name) as image:
+                return image.stat()
         return None
 
     def get_images_list(self, with_ext_info=False):
@@ -137,15 +218,55 @@ class Ceph(object):
         try:
             result = self.rbd.list(self.ioctx)
             if with_ext_info:
-                for image_name in result:
-                    with rbd.Image(self.ioctx, image_name) as image:
-                        stat = image.stat()
-                        ext_result[image_name] = stat
-                        ext_result[image_name].update({"features": RBDFeatures.parse_features(image.features())})
+                for info in self.iter_images_info(result):
+                    if info.error is not None:
+                        raise info.error
+                    ext_result[info.name] = info.stat
+                    ext_result[info.name].update({"features": info.features})
             return result if not ext_result else ext_result
         except rbd.Error as e:
             raise e
 
+    def iter_images_info(self, images=None, fields=IMAGE_INFO_FIELDS, workers=DEFAULT_INFO_WORKERS):
+        """
+        Fetch metadata of images with a pool of workers, yielding each image as soon as it is done.
+        Errors of single images are returned in :error field of the result instead of being raised
+        :param images: names of images, all images of the pool if not specified
+        :type images: list
+        :param fields: which of 'stat' and 'features' to fetch, others are None in result
+        :type fields: tuple
+        :param workers: number of concurrent workers
+        :type workers: int
+        :return: generator of ImageInfo(name, stat, features, error) in completion order
+        :rtype: generator
+        """
+        from multiprocessing.pool import ThreadPool
+
+        unknown = set(fields) - set(IMAGE_INFO_FIELDS)
+        if unknown:
+            raise ValueError("Unknown fields: %s" % ", ".join(sorted(unknown)))
+        if images is None:
+            images = self.rbd.list(self.ioctx)
+
+        def fetch(image_name):
+            try:
+                with self.images.open(image_name) as image:
+                    stat = image.stat() if 'stat' in fields else None
+                    features = RBDFeatures.parse_features(image.features()) if 'features' in fields else None
+                return ImageInfo(image_name, stat, features, None)
+            except (rbd.Error, IOError, OSError) as e:
+                return ImageInfo(image_name, None, None, e)
+
+        pool = ThreadPool(max(1, min(workers, len(images))) if images else 1)
+        try:
+            for info in pool.imap_unordered(fetch, images):
+                yield info
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
+
+    @tracked('create_snapshot')
     @convert_to_str
     def create_snapshot(self, image_name, snap_name):
         """
@@ -158,21 +279,125 @@ class Ceph(object):
         :rtype: bool
         """
 
-        with rbd.Image(self.ioctx, image_name) as image:
+        with self.images.open(image_name) as image:
+            return self._create_snap(image, image_name, snap_name)
+
+    def _create_snap(self, image, image_name, snap_name):
+        try:
+            image.create_snap(snap_name)
+            if hasattr(image, 'snap_get_id'):
+                self.snapshots.add(image_name, snap_name,
+                                   SnapshotInfo(image.snap_get_id(snap_name), image.size(), False))
+            else:
+                self.snapshots.invalidate(image_name)
+            return True
+        except rbd.ImageExists:
+            logger.debug("Handled exception", exc_info=True)
+            logger.warn("Image %s exists in cluster!", snap_name)
+            return False
+
+    def create_snapshots(self, snapshots, workers=DEFAULT_BULK_WORKERS, together=False):
+        """
+        Create many snapshots with a pool of workers
+        In :together mode all images are opened first and snapshots are created only after that,
+        so the time skew across the set is only the time of the create calls themselves
+        :param snapshots: (image name, snapshot name) pairs
+        :type snapshots: list
+        :param workers: number of concurrent workers
+        :type workers: int
+        :param together: open all images before creating any snapshot
+        :type together: bool
+        :return: SnapshotResult(image, snapshot, ok, error) for each pair, in order
+        :rtype: list
+        """
+        from multiprocessing.pool import ThreadPool
+        from time import time
+
+        snapshots = [(str(image_name), str(snap_name)) for image_name, snap_name in snapshots]
+        if not snapshots:
+            return []
+        pool = ThreadPool(max(1, min(workers, len(snapshots))))
+        borrowed = {}
+        try:
+            if together:
+                def borrow(image_name):
+                    try:
+                        handle = self.images.open(image_name)
+                        return image_name, handle, handle.__enter__()
+                    except (rbd.Error, IOError, OSError) as e:
+                        return image_name, None, e
+
+                for image_name, handle, image in pool.map(borrow, set(name for name, _ in snapshots)):
+                    borrowed[image_name] = (handle, image)
+
+            def create(pair):
+                image_name, snap_name = pair
+                try:
+                    if together:
+                        handle, image = borrowed[image_name]
+                        if handle is None:
+                            raise image
+                        return SnapshotResult(image_name, snap_name, self._create_snap(image, image_name, snap_name),
+                                              None)
+                    return SnapshotResult(image_name, snap_name, self.create_snapshot(image_name, snap_name), None)
+                except (rbd.Error, IOError, OSError) as e:
+                    return SnapshotResult(image_name, snap_name, False, e)
+
+            started = time()
+            results = pool.map(create, snapshots)
+            logger.info("Created %d of %d snapshots in %.3fs", sum(1 for r in results if r.ok), len(results),
+                        time() - started)
+            return results
+        finally:
+            pool.close()
+            pool.join()
+            for handle, image in borrowed.values():
+                if handle is not None:
+                    handle.__exit__(None, None, None)
+
+    def remove_snapshots(self, snapshots, force=False, workers=DEFAULT_BULK_WORKERS):
+        """
+        Remove many snapshots with a pool of workers
+        :param snapshots: (image name, snapshot name) pairs
+        :type snapshots: list
+        :param force: remove protected snapshots too
+        :type force: bool
+        :param workers: number of concurrent workers
+        :type workers: int
+        :return: SnapshotResult(image, snapshot, ok, error) for each pair, in order
+        :rtype: list
+        """
+        from multiprocessing.pool import ThreadPool
+
+        snapshots = [(str(image_name), str(snap_name)) for image_name, snap_name in snapshots]
+        if not snapshots:
+            return []
+
+        def remove(pair):
+            image_name, snap_name = pair
             try:
-                image.create_snap(snap_name)
-                return True
-            except rbd.ImageExists:
-                logger.exception()
-                logger.warn("Image %s exists in cluster!", snap_name)
-                return False
+                return SnapshotResult(image_name, snap_name, self._remove_snapshot(image_name, snap_name, force), None)
+            except (rbd.Error, IOError, OSError) as e:
+                return SnapshotResult(image_name, snap_name, False, e)
 
+        pool = ThreadPool(max(1, min(workers, len(snapshots))))
+        try:
+            return pool.map(remove, snapshots)
+        finally:
+            pool.close()
+            pool.join()
+
+    @tracked('export')
     @convert_to_str
-    def create_dump(self, image_name, snap_name, directory, pool="rbd", speed_limit=None):
+    def create_dump(self, image_name, snap_name, directory, pool="rbd", speed_limit=None, bucket=None, resume=False):
         """
-        Create dump of cluster image in filesystem
+        Create dump of cluster image in filesystem.
+        With :resume progress is journaled next to the result file and an interrupted dump
+        of the same snapshot is continued by the native reader, `rbd export` can't start in the middle
         :param speed_limit: limit writing speed to provided value(MB)
         :type speed_limit: int
+        :param bucket: shared rate limiter (bytes per second) the export takes part in
+        :type bucket: tokenbucket.TokenBucket
         :param image_name: name of image in cluster
         :type image_name: str
         :param snap_name: name of already existed snapshot
@@ -181,37 +406,54 @@ class Ceph(object):
         :type directory: str
         :param pool: pool in rbd (defaults to "rbd")
         :type pool: str
+        :param resume: continue interrupted dump
+        :type resume: bool
         :return: status of the operation
         :rtype: bool
         """
+        from subprocess import check_output, CalledProcessError, STDOUT
+        from .journal import ExportJournal
+
         if speed_limit == 0:
             speed_limit = None
-
-        def gen_cmd():
-            if speed_limit and which('pv'):
-                return "rbd export {pool}/{image}@{snap} - | pv -L {speed_limit}m > {path}"
-            elif speed_limit and not which('pv'):
-                logger.warn("Limiting write speed only possible with use of \"pv\", "
-                            "but pv executable is not found in your PATH")
-            return "rbd export {pool}/{image}@{snap} {path}"
+        bucket = make_bucket(speed_limit * 1024 ** 2 if speed_limit else None, bucket)
 
         if not pool and self.pool:
             pool = self.pool
+        computed_path = os.path.join(directory, snap_name)
+        journal = None
+        if resume:
+            # Snapshot could be recreated under the same name since the interrupted run,
+            # cached handles would still read the removed one
+            self.snapshots.invalidate(image_name)
+            self.images.invalidate(image_name, snap_name)
+            if not self.is_snapshot_exists(image_name, snap_name):
+                logger.warn("No snapshot %s for image %s exists in cluster", snap_name, image_name)
+                return False
+            info = self._snapshots(image_name)[snap_name]
+            journal = ExportJournal(computed_path, info.id, info.size)
+            if journal.read():
+                return self.create_dump_native(image_name, snap_name, computed_path, bucket=bucket, resume=True)
 
-        with rbd.Image(self.ioctx, image_name) as image:
+        with self.images.open(image_name) as image:
             try:
                 if not image.is_protected_snap(snap_name):
                     image.protect_snap(snap_name)
+                    self.snapshots.update(image_name, snap_name, protected=True)
             except (IOError, rbd.ImageNotFound):
                 logger.exception("Error while checking image existance")
                 return False
 
-            computed_path = os.path.join(directory, snap_name)
-            data = gen_cmd().format(
-                pool=pool, image=image_name, snap=snap_name, path=computed_path, speed_limit=speed_limit
-            )
             try:
-                check_output(data, stderr=STDOUT, shell=True)
+                if bucket or journal:
+                    self._export_limited(pool, image_name, snap_name, computed_path, bucket, journal=journal)
+                    if journal:
+                        journal.complete()
+                else:
+                    data = "rbd export {pool}/{image}@{snap} {path}".format(
+                        pool=pool, image=image_name, snap=snap_name, path=computed_path
+                    )
+                    check_output(data, stderr=STDOUT, shell=True)
             except CalledProcessError:
                 logger.exception("RBD call error")
                 return False
@@ -219,44 +461,136 @@ class Ceph(object):
                 try:
                     if image.is_protected_snap(snap_name):
                         image.unprotect_snap(snap_name)
+                        self.snapshots.update(image_name, snap_name, protected=False)
                 except (rbd.ImageNotFound, IOError):
                     logger.exception("Error while unprotecting snapshot")
             return True
 
+    @staticmethod
+    def _export_limited(pool, image_name, snap_name, path, bucket=None, chunk_size=1 << 20, journal=None):
+        """
+        Stream `rbd export` output to file at the rate of :bucket, zero chunks are left as holes.
+        Progress is recorded in :journal, if given
+        """
+        from subprocess import Popen, PIPE, CalledProcessError
+        from .queue import is_zero
+
+        cmd = ['rbd', 'export', '%s/%s@%s' % (pool, image_name, snap_name), '-']
+        proc = Popen(cmd, stdout=PIPE)
+        try:
+            with open(path, 'wb', 0) as out:
+                if journal:
+                    # Output of image size from the start, as a resumed journal expects
+                    out.truncate(journal.size)
+                    journal.fd = out.fileno()
+                    journal.open(resume=False)
+                position = 0
+                try:
+                    while True:
+                        chunk = proc.stdout.read(chunk_size)
+                        if not chunk:
+                            break
+                        if bucket:
+                            bucket.acquire(len(chunk))
+                        BYTES.inc(len(chunk), 'read')
+                        if is_zero(chunk):
+                            out.seek(len(chunk), os.SEEK_CUR)
+                            BYTES.inc(len(chunk), 'skipped')
+                        else:
+                            out.write(chunk)
+                            BYTES.inc(len(chunk), 'written')
+                        position += len(chunk)
+                        if journal:
+                            journal.advance(position)
+                    out.truncate()
+                finally:
+                    if journal:
+                        journal.close()
+        finally:
+            if proc.poll() is None:
+                proc.kill()
+            proc.stdout.close()
+        if proc.wait():
+            raise CalledProcessError(proc.returncode, ' '.join(cmd))
+
     # noinspection PyPep8Naming
+    @tracked('export')
     @convert_to_str
-    def create_dump_native(self, image_name, snap_name, fn, speed_limit=None, cb=None, bs=None):
-        # TODO: Implement threaded ring-buffer or look for an aio PR https://github.com/ceph/ceph/pull/9292
-        CEPH_OSD_OP_FLAG_FADVISE_SEQUENTIAL = 0x8
-        CEPH_OSD_OP_FLAG_FADVISE_NOCACHE = 0x40
-        fadvice_flags = CEPH_OSD_OP_FLAG_FADVISE_SEQUENTIAL | CEPH_OSD_OP_FLAG_FADVISE_NOCACHE
-        import sys
-        from time import sleep
-        from tokenbucket import TokenBucket
-
-        def sizeof_fmt(num, suffix='B'):
-            for unit in ['', 'Ki', 'Mi', 'Gi', 'Ti', 'Pi', 'Ei', 'Zi']:
-                if abs(num) < 1024.0:
-                    return "%3.1f%s%s" % (num, unit, suffix)
-                num /= 1024.0
-            return "%.1f%s%s" % (num, 'Yi', suffix)
-
-        def print_progress(cur, total):
-            progress = cur / total * 100
-            if not progress == 100:
-                sys.stdout.write('\rProgress: %d%%(%s/%s)...' % (progress, sizeof_fmt(cur), sizeof_fmt(total)))
-            else:
-                sys.stdout.write("\r" + " " * 50 + "\rProgress: %d%%...done.\n" % progress)
-            sys.stdout.flush()
+    def create_dump_native(self, image_name, snap_name, fn, speed_limit=None, cb=None, bs=None,
+                           readers=DEFAULT_READERS, max_memory=DEFAULT_MAX_MEMORY, sparse=False, bucket=None,
+                           tune_cb=None, resume=False, manifest=None, hash_workers=DEFAULT_HASH_WORKERS,
+                           compress=None, compress_workers=DEFAULT_COMPRESS_WORKERS, aio=False, direct=False,
+                           aio_memory=DEFAULT_AIO_MEMORY):
+        """
+        Export snapshot to file with concurrent readers and positional writes.
+        In :sparse mode only allocated extents are read and zero blocks are left as holes in result file.
+        With :bs 'auto' block size and number of readers are tuned on the first part of the export.
+        With :resume progress is journaled next to the result file and an interrupted export
+        of the same snapshot and image size continues where it stopped.
+        With :manifest digests of exported blocks are computed on :hash_workers threads during the export
+        and stored to :manifest, see manifest.verify.
+        With :compress the result is a compressed container (see compress.CompressedReader) written by
+        :compress_workers threads, it can not be resumed.
+        With :aio raw result is written by pyaio with at most :aio_memory bytes in flight (see queue.AioWriter),
+        preallocated unless :sparse and fdatasync'ed periodically; :direct also bypasses page cache with O_DIRECT
+        :param image_name: name of image in cluster
+        :type image_name: str
+        :param snap_name: name of already existed snapshot
+        :type snap_name: str
+        :param fn: path of result file
+        :type fn: str
+        :param speed_limit: limit reading speed to provided value(bytes per second)
+        :type speed_limit: int
+        :param cb: progress callback, called with (current, total) bytes
+        :type cb: callable
+        :param bs: block size of single read (defaults to object size times stripe count), or 'auto'
+        :type bs: int or str
+        :param readers: number of concurrent readers
+        :type readers: int
+        :param max_memory: maximum bytes of blocks read ahead of the writer
+        :type max_memory: int
+        :param sparse: skip unallocated extents and zero blocks
+        :type sparse: bool
+        :param bucket: shared rate limiter (bytes per second) the export takes part in
+        :type bucket: tokenbucket.TokenBucket
+        :param tune_cb: called with (bs, readers, MB/s) chosen by 'auto' tuning
+        :type tune_cb: callable
+        :param resume: continue interrupted export
+        :type resume: bool
+        :param manifest: path of block manifest to write
+        :type manifest: str
+        :param hash_workers: number of hashing threads
+        :type hash_workers: int
+        :param compress: codec name of compressed result, e.g. 'zlib'
+        :type compress: str
+        :param compress_workers: number of compressing threads
+        :type compress_workers: int
+        :param aio: write with pyaio
+        :type aio: bool
+        :param direct: write with pyaio and O_DIRECT
+        :type direct: bool
+        :param aio_memory: maximum bytes of aio writes in flight
+        :type aio_memory: int
+        :return: status of the operation
+        :rtype: bool
+        """
+        from .compress import CompressedImageWriter, open_image
+        from .journal import ExportJournal
+        from .manifest import BlockHasher, write_manifest
+        from .queue import ParallelReader, Writer, AioWriter, extents, allocated_regions, default_block_size, \
+            is_zero, FADVISE_FLAGS
 
-        if cb and callable(cb):
-            print_progress = cb
+        progress = cb if cb and callable(cb) else print_progress
 
-        if speed_limit:
-            limit = int(speed_limit)  # 1024 ** 2 * 10  # 1mbps
-            bucket = TokenBucket(limit, limit)
-        else:
-            bucket = None
+        bucket = make_bucket(speed_limit, bucket)
+        if resume and compress:
+            logger.warn("Compressed export of %s@%s can not be resumed", image_name, snap_name)
+            return False
+        if resume:
+            # Snapshot could be recreated under the same name since the interrupted run,
+            # cached handles would still read the removed one
+            self.snapshots.invalidate(image_name)
+            self.images.invalidate(image_name, snap_name)
         if not self.is_image_exists(image_name):
             logger.warn("No image %s exists in cluster", image_name)
             return False
@@ -273,50 +607,384 @@ class Ceph(object):
         def bufcache_seq(fd, offs, length):
             return libc.posix_fadvise(fd, ctypes.c_uint64(offs), ctypes.c_uint64(length), POSIX_FADV_SEQUENTIAL)
 
-        fd = os.open(fn, os.O_CREAT | os.O_WRONLY)
-
-        def aio_callback(rt, _errno):
-            if rt < 0:
-                import errno
-                logger.critical("Got error: %d", errno.errorcode[_errno])
-
-        with rbd.Image(self.ioctx, image_name, snapshot=snap_name) as image:
-            bufcache_seq(fd, 0, 0)
-            if not bs:
-                bs = int(1 << image.stat()['order'] * image.stripe_count())
+        with self.images.open(image_name, snap_name) as image:
+            tuner = None
+            if bs == 'auto':
+                from .autotune import AutoTuner
+                tuner = AutoTuner(image, max_memory=max_memory, flags=FADVISE_FLAGS, readers=readers)
+            elif not bs:
+                bs = default_block_size(image)
             total = image.stat()['size']
-            cur = 0
-            while cur < total:
-                bs = min(bs, total - cur)
-                if bucket:
-                    if bucket.consume(bs):
+            aio = (aio or direct) and not compress
+            if compress:
+                writer = CompressedImageWriter(fn, codec=compress, workers=compress_workers)
+            elif aio:
+                writer = AioWriter(fn, max_memory=aio_memory, direct=direct)
+                bufcache_seq(writer.fd, 0, 0)
+            else:
+                writer = Writer(fn)
+                bufcache_seq(writer.fd, 0, 0)
+            with writer:
+                journal = None
+                start = 0
+                if resume:
+                    journal = ExportJournal(fn, self._snapshots(image_name)[snap_name].id, total, writer.fd,
+                                            sync=writer.sync if aio else None)
+                    start = journal.open()
+                    if start:
+                        logger.info("Resuming export of %s@%s at %s", image_name, snap_name, sizeof_fmt(start))
+                cur = start
+                hasher = None
+                if manifest:
+                    hasher = BlockHasher(total, default_block_size(image) if bs == 'auto' else bs,
+                                         workers=hash_workers)
+                try:
+                    if hasher and start:
+                        # Already exported part is hashed from the result file
+                        source = open_image(fn)
                         try:
-                            data = image.read(cur, bs, fadvice_flags)
-                            pyaio.aio_write(fd, data, cur, aio_callback)
-                        except rbd.InvalidArgument as e:
-                            # @TODO: there should be a unit-test of max(bs, total - cur), but for now we sure that I'm
-                            # good at math
-                            logger.critical("It doesn't happen!")
-                            raise e
+                            for offset, length in extents(start, hasher.bs):
+                                data = source.read(offset, length)
+                                if is_zero(data):
+                                    hasher.zero(offset, length)
+                                else:
+                                    hasher.add(offset, data)
+                        finally:
+                            source.close()
+                    if not compress:
+                        if not start:
+                            # Start from an empty file of image size, so neither a tail of an older larger file
+                            # is left nor a skipped block keeps old data
+                            writer.truncate(0)
+                        writer.truncate(total)
+                    if aio and not sparse:
+                        writer.allocate(total)
+                    if sparse:
+                        regions = [(max(offset, start), offset + length - max(offset, start))
+                                   for offset, length in allocated_regions(image, total) if offset + length > start]
+                        BYTES.inc(total - start - sum(length for offset, length in regions), 'skipped')
+                    else:
+                        regions = [(start, total - start)] if start < total else []
+                    if tuner:
+                        engine = tuner.read(regions)
+                    else:
+                        blocks = (block for offset, length in regions for block in extents(offset + length, bs, offset))
+                        engine = ParallelReader(image, blocks, bs, readers=readers, max_memory=max_memory,
+                                                flags=FADVISE_FLAGS)
+                    for offset, data in engine:
+                        if bucket:
+                            bucket.acquire(len(data))
+                        zero = is_zero(data)
+                        if not (sparse and zero):
+                            writer.write(offset, data)
+                        else:
+                            BYTES.inc(len(data), 'skipped')
+                        if hasher:
+                            if zero:
+                                hasher.zero(offset, len(data))
+                            else:
+                                hasher.add(offset, data)
+                        cur = offset + len(data)
+                        if journal:
+                            journal.advance(cur)
+                        progress(cur, total)
+                    if compress:
+                        # Skipped tail of sparse export
+                        writer.truncate(total)
+                    if aio:
+                        # Failed writes are reported before the export counts as done
+                        writer.sync()
+                    if cur < total:
+                        progress(total, total)
+                    if hasher:
+                        # Blocks skipped in sparse mode are holes of the result file
+                        write_manifest(manifest, hasher.finish(holes=sparse))
+                    if journal:
+                        journal.complete()
+                except (rbd.Error, OSError, IOError):
+                    logger.exception("Error while exporting %s@%s", image_name, snap_name)
+                    if compress:
+                        # Container without index is not mistaken for a complete export
+                        writer.abort()
+                    return False
+                finally:
+                    if hasher:
+                        hasher.close()
+                    if journal:
+                        # Keeps the journal of unfinished export
+                        journal.close()
+            if tuner and tune_cb:
+                tune_cb(tuner.bs, tuner.readers, tuner.rate)
+            return True
+
+    @tracked('export_diff')
+    @convert_to_str
+    def create_diff_native(self, image_name, snap_name, ofh, from_snap=None, speed_limit=None, cb=None, bs=None,
+                           readers=DEFAULT_READERS, max_memory=DEFAULT_MAX_MEMORY, bucket=None, manifest=None,
+                           hash_workers=DEFAULT_HASH_WORKERS, compress=None, compress_workers=DEFAULT_COMPRESS_WORKERS):
+        """
+        Write `rbd export-diff` compatible diff of snapshot without calling rbd executable.
+        With :manifest digests of changed extents are stored to :manifest, see verify_snapshot.
+        With :compress the diff is written into compressed container, readable by compress.CompressedReader
+        :param image_name: name of image in cluster
+        :type image_name: str
+        :param snap_name: name of already existed snapshot
+        :type snap_name: str
+        :param ofh: output file-like object
+        :type ofh: file
+        :param from_snap: name of the older snapshot, full diff if not specified
+        :type from_snap: str
+        :param speed_limit: limit reading speed to provided value(bytes per second)
+        :type speed_limit: int
+        :param cb: progress callback, called with (current, total) changed bytes
+        :type cb: callable
+        :param bs: maximum length of single data record
+        :type bs: int
+        :param readers: number of concurrent readers
+        :type readers: int
+        :param max_memory: maximum bytes of blocks read ahead of the writer
+        :type max_memory: int
+        :param bucket: shared rate limiter (bytes per second) the export takes part in
+        :type bucket: tokenbucket.TokenBucket
+        :param manifest: path of block manifest to write
+        :type manifest: str
+        :param hash_workers: number of hashing threads
+        :type hash_workers: int
+        :param compress: codec name of compressed result, e.g. 'zlib'
+        :type compress: str
+        :param compress_workers: number of compressing threads
+        :type compress_workers: int
+        :return: status of the operation
+        :rtype: bool
+        """
+        from .compress import CompressedWriter
+        from .export_diff import export_diff_native
+        from .manifest import BlockHasher, write_manifest
 
-                        cur += bs
-                        print_progress(cur, total)
+        for snap in (snap_name, from_snap):
+            if snap and not self.is_snapshot_exists(image_name, snap):
+                logger.warn("No snapshot %s for image %s exists in cluster", snap, image_name)
+                return False
+        bucket = make_bucket(speed_limit, bucket)
 
-                    else:
-                        sleep(1)
-                else:
-                    try:
+        with self.images.open(image_name, snap_name) as image:
+            hasher = None
+            if manifest:
+                hasher = BlockHasher(image.size(), bs or 1 << image.stat()['order'], workers=hash_workers)
+            out = CompressedWriter(ofh, codec=compress, workers=compress_workers) if compress else ofh
+            try:
+                export_diff_native(image, out, from_snap=from_snap, to_snap=snap_name, bs=bs, readers=readers,
+                                   max_memory=max_memory, bucket=bucket, cb=cb, hasher=hasher)
+                if compress:
+                    out.close()
+                if hasher:
+                    write_manifest(manifest, hasher.finish())
+            except (rbd.Error, IOError, OSError):
+                logger.exception("Error while exporting diff of %s@%s", image_name, snap_name)
+                return False
+            finally:
+                if compress:
+                    out.abort()
+                if hasher:
+                    hasher.close()
+            return True
+
+    @convert_to_str
+    def verify_snapshot(self, image_name, snap_name, manifest, workers=DEFAULT_HASH_WORKERS):
+        """
+        Compare snapshot against manifest written by create_dump_native or create_diff_native
+        :param image_name: name of image in cluster
+        :type image_name: str
+        :param snap_name: name of already existed snapshot
+        :type snap_name: str
+        :param manifest: path of manifest file
+        :type manifest: str
+        :param workers: number of concurrent readers
+        :type workers: int
+        :return: mismatched (offset, length) ranges, None if snapshot could not be read
+        :rtype: list
+        """
+        from .manifest import verify
+
+        if not self.is_snapshot_exists(image_name, snap_name):
+            logger.warn("No snapshot %s for image %s exists in cluster", snap_name, image_name)
+            return None
+        with self.images.open(image_name, snap_name) as image:
+            try:
+                return verify(manifest, image, workers)
+            except (rbd.Error, IOError, OSError):
+                logger.exception("Error while verifying %s@%s", image_name, snap_name)
+                return None
+
+    @tracked('backup')
+    @convert_to_str
+    def backup_snapshot(self, repository, image_name, snap_name, name=None, from_snap=None, parent=None,
+                        speed_limit=None, cb=None, readers=DEFAULT_READERS, max_memory=DEFAULT_MAX_MEMORY,
+                        bucket=None, hash_workers=DEFAULT_HASH_WORKERS):
+        """
+        Stream snapshot into deduplicating repository with concurrent readers and hashing threads.
+        Only allocated extents are read, with :from_snap only extents changed since it and the rest
+        of chunks is taken from :parent snapshot of the repository
+        :param repository: opened repository
+        :type repository: repository.Repository
+        :param image_name: name of image in cluster
+        :type image_name: str
+        :param snap_name: name of already existed snapshot
+        :type snap_name: str
+        :param name: name of snapshot in repository (defaults to image@snapshot)
+        :type name: str
+        :param from_snap: name of the older snapshot already in repository
+        :type from_snap: str
+        :param parent: name of :from_snap in repository (defaults to image@from_snap)
+        :type parent: str
+        :param speed_limit: limit reading speed to provided value(bytes per second)
+        :type speed_limit: int
+        :param cb: progress callback, called with (current, total) bytes to read
+        :type cb: callable
+        :param readers: number of concurrent readers
+        :type readers: int
+        :param max_memory: maximum bytes of blocks read ahead of the hashing
+        :type max_memory: int
+        :param bucket: shared rate limiter (bytes per second) the backup takes part in
+        :type bucket: tokenbucket.TokenBucket
+        :param hash_workers: number of hashing threads
+        :type hash_workers: int
+        :return: status of the operation
+        :rtype: bool
+        """
+        from .queue import ParallelReader, diff_extents, allocated_regions, extents, FADVISE_FLAGS
 
-                        data = image.read(cur, bs, fadvice_flags)
-                        pyaio.aio_write(fd, data, cur, aio_callback)
+        name = name or '%s@%s' % (image_name, snap_name)
+        if from_snap and not parent:
+            parent = '%s@%s' % (image_name, from_snap)
+        for snap in (snap_name, from_snap):
+            if snap and not self.is_snapshot_exists(image_name, snap):
+                logger.warn("No snapshot %s for image %s exists in cluster", snap, image_name)
+                return False
+        if parent and parent not in repository.snapshots():
+            logger.warn("No snapshot %s in repository %s", parent, repository.path)
+            return False
+        progress = cb if cb and callable(cb) else print_progress
+        bucket = make_bucket(speed_limit, bucket)
 
-                    except rbd.InvalidArgument:
-                        print("cur, total: %d, %d" % (cur, total))
-                        break
-                    cur += bs
-                    print_progress(cur, total)
+        with self.images.open(image_name, snap_name) as image:
+            total = image.size()
+            writer = None
+            cur = 0
+            try:
+                writer = repository.writer(name, total, parent if from_snap else None, workers=hash_workers)
+                if from_snap:
+                    regions = []
+                    for offset, length, exists in diff_extents(image, total, from_snap):
+                        length = min(offset + length, total) - offset
+                        if exists:
+                            regions.append((offset, length))
+                        elif length > 0:
+                            writer.zero(offset, length)
+                else:
+                    regions = allocated_regions(image, total)
+                changed = sum(length for offset, length in regions)
+                BYTES.inc(total - changed, 'skipped')
+                bs = repository.chunk_size
+                blocks = (block for offset, length in regions for block in extents(offset + length, bs, offset))
+                for offset, data in ParallelReader(image, blocks, bs, readers=readers, max_memory=max_memory,
+                                                   flags=FADVISE_FLAGS):
+                    if bucket:
+                        bucket.acquire(len(data))
+                    writer.write(offset, data)
+                    cur += len(data)
+                    progress(cur, changed)
+                writer.commit()
+            except (rbd.Error, IOError, OSError):
+                logger.exception("Error while backing up %s@%s", image_name, snap_name)
+                return False
+            finally:
+                if writer:
+                    writer.close()
+            logger.info("Backed up %s@%s as %s: %s read, %s new", image_name, snap_name, name,
+                        sizeof_fmt(cur), sizeof_fmt(writer.stored))
             return True
 
+    @tracked('import')
+    @convert_to_str
+    def import_image(self, fn, image_name, speed_limit=None, cb=None, bs=None, max_in_flight=DEFAULT_IN_FLIGHT,
+                     order=None, features=None, bucket=None):
+        """
+        Upload local raw image file (or compressed container of create_dump_native) to cluster image
+        with concurrent aio writes. Image is created if missing or resized to the file size. Holes and
+        zero blocks of the file are not sent: they are skipped for new image and discarded for existing one
+        :param fn: path of raw or compressed image file
+        :type fn: str
+        :param image_name: name of image in cluster
+        :type image_name: str
+        :param speed_limit: limit writing speed to provided value(bytes per second)
+        :type speed_limit: int
+        :param cb: progress callback, called with (current, total) bytes
+        :type cb: callable
+        :param bs: block size of single write (defaults to object size)
+        :type bs: int
+        :param max_in_flight: maximum number of concurrent writes
+        :type max_in_flight: int
+        :param order: object size order of created image
+        :type order: int
+        :param features: features of created image (defaults to RBDFeatures.default_features())
+        :type features: int
+        :param bucket: shared rate limiter (bytes per second) the import takes part in
+        :type bucket: tokenbucket.TokenBucket
+        :return: status of the operation
+        :rtype: bool
+        """
+        from .compress import open_image
+        from .queue import ImageWriter, extents, is_zero
+
+        progress = cb if cb and callable(cb) else print_progress
+        bucket = make_bucket(speed_limit, bucket)
+
+        source = open_image(fn)
+        try:
+            total = source.size
+            existed = self.is_image_exists(image_name)
+            if not existed:
+                if features is None:
+                    features = RBDFeatures.default_features()
+                self.rbd.create(self.ioctx, image_name, total, order=order, old_format=False, features=features)
+            with self.images.open(image_name) as image:
+                if existed and image.size() != total:
+                    image.resize(total)
+                if not bs:
+                    bs = 1 << image.stat()['order']
+                writer = ImageWriter(image, max_in_flight=max_in_flight)
+                cur = 0
+                for region_offset, region_length in source.data_extents():
+                    BYTES.inc(region_offset - cur, 'skipped')
+                    if existed and region_offset > cur:
+                        image.discard(cur, region_offset - cur)
+                    for offset, length in extents(region_offset + region_length, bs, region_offset):
+                        data = source.read(offset, length)
+                        if is_zero(data):
+                            BYTES.inc(length, 'skipped')
+                            if existed:
+                                image.discard(offset, length)
+                        else:
+                            if bucket:
+                                bucket.acquire(length)
+                            writer.write(offset, data)
+                        cur = offset + length
+                        if cur < total:
+                            progress(cur, total)
+                BYTES.inc(total - cur, 'skipped')
+                if existed and cur < total:
+                    image.discard(cur, total - cur)
+                writer.wait()
+                progress(total, total)
+                return True
+        except (rbd.Error, IOError, OSError):
+            logger.exception("Error while importing %s to %s", fn, image_name)
+            return False
+        finally:
+            source.close()
+
+    @tracked('remove_snapshot')
     @convert_to_str
     def remove_snapshot(self, image_name, snap_name, force=False):
         """
@@ -332,21 +1000,23 @@ class Ceph(object):
         :rtype: bool
         """
 
-        with rbd.Image(self.ioctx, image_name) as image:
-            try:
-                if image.is_protected_snap(snap_name):
-                    if force:
-                        image.unprotect_snap(snap_name)
-                        self.remove_snapshot(image_name, snap_name, force=False)
-                        return True
-                    else:
-                        return False
-                else:
-                    image.remove_snap(snap_name)
-                    return True
-            except (IOError, rbd.ImageNotFound, rbd.ImageBusy):
-                logger.debug("Handled exception", exc_info=True)
-                return False
+        try:
+            return self._remove_snapshot(image_name, snap_name, force)
+        except (IOError, rbd.ImageNotFound, rbd.ImageBusy):
+            logger.debug("Handled exception", exc_info=True)
+            return False
+
+    def _remove_snapshot(self, image_name, snap_name, force):
+        with self.images.open(image_name) as image:
+            if image.is_protected_snap(snap_name):
+                if not force:
+                    return False
+                image.unprotect_snap(snap_name)
+                self.snapshots.update(image_name, snap_name, protected=False)
+            image.remove_snap(snap_name)
+            self.images.invalidate(image_name, snap_name)
+            self.snapshots.remove(image_name, snap_name)
+            return True
 
     @convert_to_str
     def list_snapshots(self, image_name):
@@ -357,41 +1027,57 @@ class Ceph(object):
         :return: List of snapshots
         :rtype: list
         """
-        if self.is_image_exists(image_name):
-            with rbd.Image(self.ioctx, str(image_name)) as image:
-                return image.list_snaps() or []
-        else:
+        try:
+            snapshots = self._snapshots(str(image_name))
+        except rbd.ImageNotFound:
             return []
+        return sorted(({'id': info.id, 'size': info.size, 'name': name} for name, info in snapshots.items()),
+                      key=lambda snap: snap['id'])
 
     @convert_to_str
     def is_image_exists(self, image_name):
         try:
-            rbd.Image(self.ioctx, image_name)
-            return True
+            with self.images.open(image_name):
+                return True
         except rbd.ImageNotFound:
             return False
 
+    def _snapshots(self, image_name):
+        """
+        Snapshots of image from the index, listed from cluster if not cached
+        :rtype: dict
+        """
+        snapshots = self.snapshots.get(image_name)
+        if snapshots is None:
+            with self.images.open(image_name) as image:
+                snapshots = self.snapshots.load(image_name, image)
+        return snapshots
+
+    @tracked('protect')
     @convert_to_str
     def protect(self, image_name, snap_name):
-        if self.is_image_exists(image_name) and self.is_snapshot_exists(image_name, snap_name):
-            with rbd.Image(self.ioctx, image_name) as image:
+        if self.is_snapshot_exists(image_name, snap_name):
+            with self.images.open(image_name) as image:
                 if not image.features() & RBDFeatures.RBD_FEATURE_LAYERING:
                     logger.warn("Image %s doesn't support protection! Please consider enabling layering.", image_name)
                     return False
                 if not image.is_protected_snap(snap_name):
                     image.protect_snap(snap_name)
+                    self.snapshots.update(image_name, snap_name, protected=True)
                     return True
                 else:
                     logger.info("Snapshot %s@%s is already protected", image_name, snap_name)
                     return False
         return False
 
+    @tracked('unprotect')
     @convert_to_str
     def unprotect(self, image_name, snap_name):
-        if self.is_image_exists(image_name) and self.is_snapshot_exists(image_name, snap_name):
-            with rbd.Image(self.ioctx, image_name) as image:
+        if self.is_snapshot_exists(image_name, snap_name):
+            with self.images.open(image_name) as image:
                 if image.is_protected_snap(snap_name):
                     image.unprotect_snap(snap_name)
+                    self.snapshots.update(image_name, snap_name, protected=False)
                     return True
                 else:
                     logger.info("Snapshot %s@%s is already unprotected", image_name, snap_name)
@@ -409,15 +1095,7 @@ class Ceph(object):
         :return: True if snapshot exists, otherwise False
         :rtype: bool
         """
-        if self.is_image_exists(image_name):
-            with rbd.Image(self.ioctx, image_name) as image:
-                try:
-                    for snap in image.list_snaps():
-                        if snap_name in snap['name']:
-                            return True
-
-                    return False
-                except (IOError, rbd.ImageNotFound):
-                    logger.exception()
-                    return False
-        return False
+        try:
+            return snap_name in self._snapshots(image_name)
+        except (IOError, rbd.ImageNotFound):
+            return False
@@ -1,5 +1,6 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
+from __future__ import print_function
 from ceph import Ceph
 
 from functools import wraps
@@ -12,14 +13,14 @@ def timing(f):
         ts = time()
         result = f(*args, **kw)
         te = time()
-        print 'func:%r args:[%r, %r] took: %2.4f sec' % (f.__name__, args, kw, te - ts)
+        print('func:%r args:[%r, %r] took: %2.4f sec' % (f.__name__, args, kw, te - ts))
         return result
 
     return wrap
 
 
 def check_prerequisites(image, snapshot):
-    c = Ceph()
+    c = Ceph(shared=True)
     if c.is_image_exists(image_name=image):
         if snapshot and c.is_snapshot_exists(image, snapshot):
             return c
@@ -27,9 +28,9 @@ def check_prerequisites(image, snapshot):
 
 
 @timing
-def export_image_native(image, out_file, snapshot=None):
+def export_image_native(image, out_file, snapshot=None, bs='auto'):
     with check_prerequisites(image, snapshot) as c:
-        return c.create_dump_native(image, snapshot, out_file, bs=4*2**20)
+        return c.create_dump_native(image, snapshot, out_file, bs=bs)
 
 
 @timing
@@ -64,13 +65,13 @@ if __name__ == '__main__':
         return _spec(pool=pool, image=image, snap=snap)
 
     spec = parse_spec(args.image_spec)
-    print spec
+    print(spec)
     try:
-        print "popen func."
+        print("popen func.")
         export_image_popen(spec.image, args.output, spec.snap)
         os.unlink(os.path.join(args.output, spec.snap))
 
-        print "native func."
+        print("native func.")
         export_image_native(spec.image, os.path.join(args.output, spec.snap), snapshot=spec.snap)
         os.unlink(os.path.join(args.output, spec.snap))
     except KeyboardInterrupt:
@@ -0,0 +1,470 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+# Seekable container of blocks compressed in parallel, for exports and diffs
+from __future__ import division
+import bisect
+import io
+import os
+import struct
+import zlib
+from collections import deque
+from threading import Lock
+
+from .fileio import pread, data_extents
+from .metrics import BYTES
+from .queue import is_zero
+
+COMPRESSED_MAGIC = b'pyceph compressed v1\n'
+FOOTER_MAGIC = b'pyceph index\n'
+DEFAULT_CODEC = 'zlib'
+DEFAULT_BLOCK_SIZE = 1 << 20
+DEFAULT_COMPRESS_WORKERS = 4
+_HEADER = struct.Struct('<8sI')  # codec, block size
+_ENTRY = struct.Struct('<cQQQ')  # kind, position of block, stored length, raw length
+_FOOTER = struct.Struct('<QQ')  # position of index, number of entries
+# Kinds of blocks: compressed, stored as is (did not shrink), zeroes (nothing stored)
+COMPRESSED, RAW, ZERO = b'c', b'r', b'z'
+
+
+def _zlib_codec(level=6):
+    return (lambda data: zlib.compress(data, level)), zlib.decompress
+
+
+def _lz4_codec(level=0):
+    import lz4.frame
+    return (lambda data: lz4.frame.compress(data, compression_level=level)), lz4.frame.decompress
+
+
+def _zstd_codec(level=3):
+    import zstandard
+    return (lambda data: zstandard.ZstdCompressor(level=level).compress(data)), \
+        (lambda data: zstandard.ZstdDecompressor().decompress(data))
+
+
+CODECS = {
+    'zlib': _zlib_codec,
+    'lz4': _lz4_codec,
+    'zstd': _zstd_codec,
+}
+
+
+def available_codecs():
+    """:return: names of codecs which modules can be imported"""
+    result = []
+    for name, factory in sorted(CODECS.items()):
+        try:
+            factory()
+        except ImportError:
+            continue
+        result.append(name)
+    return result
+
+
+def get_codec(name, level=None):
+    """
+    :param name: codec name, one of CODECS
+    :type name: str
+    :param level: compression level, codec default if not specified
+    :type level: int
+    :return: compress and decompress functions
+    :rtype: tuple
+    """
+    if name not in CODECS:
+        raise ValueError('Unknown codec: %s' % name)
+    return CODECS[name]() if level is None else CODECS[name](level)
+
+
+def is_compressed(path):
+    """Check if file at :path is a compressed container"""
+    with open(path, 'rb') as fh:
+        return fh.read(len(COMPRESSED_MAGIC)) == COMPRESSED_MAGIC
+
+
+class CompressedWriter(object):
+    """
+    Sequential file-like writer of compressed container.
+
+    Written stream is cut into :bs blocks compressed by a thread pool (zlib, lz4 and zstd release
+    the GIL) and written in order as they complete; at most :max_pending blocks wait for a worker.
+    Zero blocks are stored as markers only. The index of blocks is appended on close.
+
+    >>> with CompressedWriter(open(fn, 'wb')) as out:
+    ...     export_diff_native(image, out)
+    """
+
+    def __init__(self, fh, codec=DEFAULT_CODEC, level=None, bs=DEFAULT_BLOCK_SIZE, workers=DEFAULT_COMPRESS_WORKERS,
+                 max_pending=None):
+        """
+        :param fh: output file object opened for binary writing
+        :type fh: file
+        :param codec: name of codec
+        :type codec: str
+        :param level: compression level
+        :type level: int
+        :param bs: size of uncompressed blocks
+        :type bs: int
+        :param workers: number of compressing threads
+        :type workers: int
+        :param max_pending: maximum number of blocks being compressed (twice the workers by default)
+        :type max_pending: int
+        """
+        self.fh = fh
+        self.codec = codec
+        self.bs = bs
+        self._compress = get_codec(codec, level)[0]
+        from multiprocessing.pool import ThreadPool
+        self._pool = ThreadPool(workers)
+        self._max_pending = max_pending or workers * 2
+        self._pending = deque()
+        self._buf = bytearray()
+        self.entries = []
+        self.size = 0  # bytes of the stream accepted so far
+        self.position = len(COMPRESSED_MAGIC) + _HEADER.size
+        fh.write(COMPRESSED_MAGIC)
+        fh.write(_HEADER.pack(codec.encode('ascii'), bs))
+
+    def _pack(self, data):
+        if is_zero(data):
+            return ZERO, b''
+        compressed = self._compress(data)
+        if len(compressed) >= len(data):
+            return RAW, data
+        return COMPRESSED, compressed
+
+    def _submit(self, data):
+        self._pending.append((len(data), self._pool.apply_async(self._pack, (data,))))
+        while self._pending and (len(self._pending) > self._max_pending or self._pending[0][1].ready()):
+            self._drain_one()
+
+    def _drain_one(self):
+        length, result = self._pending.popleft()
+        kind, stored = result.get()
+        if kind != ZERO:
+            self.fh.write(stored)
+        self.entries.append((kind, self.position, len(stored), length))
+        self.position += len(stored)
+        BYTES.inc(length - len(stored), 'compressed')
+
+    def write(self, data):
+        """Append :data to the stream"""
+        view = memoryview(data)
+        if not self._buf and len(view) >= self.bs:
+            # Whole blocks are not copied through the buffer
+            whole = len(view) - len(view) % self.bs
+            for start in range(0, whole, self.bs):
+                self._submit(view[start:start + self.bs].tobytes())
+            view = view[whole:]
+        while len(view):
+            n = min(len(view), self.bs - len(self._buf))
+            self._buf += view[:n].tobytes()
+            view = view[n:]
+            if len(self._buf) == self.bs:
+                self._submit(bytes(self._buf))
+                self._buf = bytearray()
+        self.size += len(data)
+        return len(data)
+
+    def zero(self, length):
+        """Append :length zero bytes without building them"""
+        while length > 0:
+            if self._buf or length < self.bs:
+                n = min(length, self.bs - len(self._buf))
+                self.write(b'\0' * n)
+            else:
+                # Runs of whole zero blocks become a single marker
+                n = length - length % self.bs
+                self._flush_pending()
+                self.entries.append((ZERO, self.position, 0, n))
+                self.size += n
+            length -= n
+
+    def _flush_pending(self):
+        while self._pending:
+            self._drain_one()
+
+    def tell(self):
+        return self.size
+
+    def flush(self):
+        pass
+
+    def close(self):
+        """Compress the rest of the stream and write the index"""
+        if self.fh is None:
+            return
+        try:
+            if self._buf:
+                self._submit(bytes(self._buf))
+                self._buf = bytearray()
+            self._flush_pending()
+            index_position = self.position
+            for kind, position, stored, length in self.entries:
+                self.fh.write(_ENTRY.pack(kind, position, stored, length))
+            self.fh.write(_FOOTER.pack(index_position, len(self.entries)))
+            self.fh.write(FOOTER_MAGIC)
+            self.fh.flush()
+        finally:
+            self._pool.close()
+            self._pool.join()
+            self.fh = None
+
+    def abort(self):
+        """Stop without writing the index, the output is left unreadable"""
+        if self.fh is not None:
+            self._pool.terminate()
+            self._pool.join()
+            self.fh = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is not None:
+            self.abort()
+        self.close()
+
+
+class CompressedImageWriter(object):
+    """
+    Drop-in for queue.Writer writing exported image into compressed container.
+    Blocks must come in image order, gaps between them are stored as zeros.
+    """
+
+    def __init__(self, fn, **kwargs):
+        self.fd = None
+        self.fh = open(fn, 'wb')
+        self.out = CompressedWriter(self.fh, **kwargs)
+
+    def write(self, offset, data):
+        if offset < self.out.size:
+            raise IOError('Compressed output is written in order, got offset %d below %d' % (offset, self.out.size))
+        if offset > self.out.size:
+            self.out.zero(offset - self.out.size)
+        self.out.write(data)
+        BYTES.inc(len(data), 'written')
+
+    def truncate(self, size):
+        if size > self.out.size:
+            self.out.zero(size - self.out.size)
+
+    def abort(self):
+        self.out.abort()
+
+    def close(self):
+        try:
+            self.out.close()
+        finally:
+            self.fh.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is not None:
+            self.abort()
+        self.close()
+
+
+class CompressedReader(io.RawIOBase):
+    """
+    Seekable file-like reader of compressed container, decompresses only the blocks it reads.
+    Sequential reading decompresses the next :read_ahead blocks on a thread pool, so the container
+    can be fed straight to apply_diff, scan_diff or import_image.
+    """
+
+    def __init__(self, path, workers=DEFAULT_COMPRESS_WORKERS, read_ahead=None):
+        """
+        :param path: path of compressed container
+        :type path: str
+        :param workers: number of decompressing threads
+        :type workers: int
+        :param read_ahead: number of blocks decompressed ahead of sequential reads (twice the workers by default)
+        :type read_ahead: int
+        """
+        super(CompressedReader, self).__init__()
+        self.fd = os.open(path, os.O_RDONLY)
+        head = self._read(0, len(COMPRESSED_MAGIC) + _HEADER.size)
+        if not head.startswith(COMPRESSED_MAGIC):
+            raise IOError('Missing compressed container magic string')
+        codec, self.bs = _HEADER.unpack_from(head, len(COMPRESSED_MAGIC))
+        self.codec = codec.rstrip(b'\0').decode('ascii')
+        self._decompress = get_codec(self.codec)[1]
+        end = os.fstat(self.fd).st_size
+        tail = self._read(end - _FOOTER.size - len(FOOTER_MAGIC), _FOOTER.size + len(FOOTER_MAGIC))
+        if not tail.endswith(FOOTER_MAGIC):
+            raise IOError('Compressed container has no index, it was not closed')
+        index_position, count = _FOOTER.unpack_from(tail)
+        data = self._read(index_position, count * _ENTRY.size)
+        self.entries = []
+        self.offsets = []  # uncompressed offsets of blocks
+        self.size = 0
+        for i in range(count):
+            entry = _ENTRY.unpack_from(data, i * _ENTRY.size)
+            self.entries.append(entry)
+            self.offsets.append(self.size)
+            self.size += entry[3]
+        from multiprocessing.pool import ThreadPool
+        self._pool = ThreadPool(workers)
+        self._read_ahead = read_ahead or workers * 2
+        self._blocks = {}  # block number -> AsyncResult
+        self._lock = Lock()
+        self._pos = 0
+
+    def _read(self, offset, length):
+        return pread(self.fd, length, offset)
+
+    def _load(self, number):
+        kind, position, stored, length = self.entries[number]
+        if kind == ZERO:
+            return None
+        data = self._read(position, stored)
+        return self._decompress(data) if kind == COMPRESSED else data
+
+    def _block(self, number):
+        """Uncompressed data of block :number (None for zeros), scheduling decompression of the next blocks"""
+        with self._lock:
+            for ahead in range(number, min(number + self._read_ahead, len(self.entries))):
+                if ahead not in self._blocks:
+                    self._blocks[ahead] = self._pool.apply_async(self._load, (ahead,))
+            result = self._blocks[number]
+            for stale in [n for n in self._blocks if n < number or n >= number + self._read_ahead]:
+                del self._blocks[stale]
+        return result.get()
+
+    def pread(self, offset, length):
+        """
+        :return: up to :length bytes of uncompressed stream at :offset
+        :rtype: bytes
+        """
+        parts = []
+        end = min(offset + length, self.size)
+        number = bisect.bisect_right(self.offsets, offset) - 1
+        while offset < end:
+            start = self.offsets[number]
+            n = min(end, start + self.entries[number][3]) - offset
+            data = self._block(number)
+            parts.append(b'\0' * n if data is None else data[offset - start:offset - start + n])
+            offset += n
+            number += 1
+        return b''.join(parts)
+
+    def data_extents(self):
+        """
+        Regions of the stream not stored as zero markers
+        :return: generator of (offset, length)
+        :rtype: generator
+        """
+        region = None
+        for start, (kind, position, stored, length) in zip(self.offsets, self.entries):
+            if kind == ZERO:
+                if region:
+                    yield region
+                region = None
+            elif region:
+                region = (region[0], region[1] + length)
+            else:
+                region = (start, length)
+        if region:
+            yield region
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def readinto(self, b):
+        data = self.pread(self._pos, len(b))
+        b[:len(data)] = data
+        self._pos += len(data)
+        return len(data)
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            offset += self._pos
+        elif whence == os.SEEK_END:
+            offset += self.size
+        self._pos = max(0, offset)
+        return self._pos
+
+    def tell(self):
+        return self._pos
+
+    def close(self):
+        if self.fd is not None:
+            self._pool.close()
+            self._pool.join()
+            os.close(self.fd)
+            self.fd = None
+        super(CompressedReader, self).close()
+
+
+class RawImageFile(object):
+    """Positional reads of raw image file, usable from many threads"""
+
+    def __init__(self, path):
+        self.fd = os.open(path, os.O_RDONLY)
+        self.size = os.fstat(self.fd).st_size
+
+    def read(self, offset, length):
+        return pread(self.fd, length, offset)
+
+    def data_extents(self):
+        return data_extents(self.fd, self.size)
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+class CompressedImageFile(RawImageFile):
+    """Positional reads of image exported into compressed container"""
+
+    def __init__(self, path, workers=DEFAULT_COMPRESS_WORKERS):
+        self.reader = CompressedReader(path, workers=workers)
+        self.size = self.reader.size
+
+    def read(self, offset, length):
+        return self.reader.pread(offset, length)
+
+    def data_extents(self):
+        return self.reader.data_extents()
+
+    def close(self):
+        self.reader.close()
+
+
+def open_image(path, workers=DEFAULT_COMPRESS_WORKERS):
+    """
+    Open raw or compressed image file for positional reads
+    :param path: path of file
+    :type path: str
+    :param workers: number of decompressing threads for compressed container
+    :type workers: int
+    :return: object with size, read(offset, length), data_extents() and close()
+    :rtype: RawImageFile or CompressedImageFile
+    """
+    if is_compressed(path):
+        return CompressedImageFile(path, workers=workers)
+    return RawImageFile(path)
+
+
+def open_input(path, workers=DEFAULT_COMPRESS_WORKERS):
+    """
+    Open raw or compressed file for reading
+    :param path: path of file
+    :type path: str
+    :param workers: number of decompressing threads for compressed container
+    :type workers: int
+    :rtype: file or CompressedReader
+    """
+    if is_compressed(path):
+        return CompressedReader(path, workers=workers)
+    return open(path, 'rb')
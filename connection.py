@@ -0,0 +1,96 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+# Process-wide pool of cluster connections shared by Ceph objects
+import atexit
+from threading import Lock
+from time import time
+
+from .ceph import PoolNotFound, logger
+from .lazy import rados
+from .metrics import OP_SECONDS
+
+
+class ClusterConnection(object):
+    """
+    Connected Rados handle with lazily opened and cached ioctx per pool
+    """
+
+    def __init__(self, conffile, cluster):
+        """
+        :param conffile: Path to ceph.conf file
+        :type conffile: str
+        :param cluster: Ceph cluster name
+        :type cluster: str
+        """
+        self.cluster = rados.Rados(conffile=conffile, clustername=cluster)
+        started = time()
+        self.cluster.connect()
+        OP_SECONDS.observe(time() - started, 'connect')
+        self._ioctxs = {}
+        self._lock = Lock()
+
+    def ioctx(self, pool):
+        """
+        Get ioctx of pool, opening it on first use
+        :param pool: Ceph cluster pool
+        :type pool: str
+        :rtype: rados.Ioctx
+        """
+        ioctx = self._ioctxs.get(pool)
+        if ioctx is not None:
+            return ioctx
+        with self._lock:
+            if pool not in self._ioctxs:
+                try:
+                    self._ioctxs[pool] = self.cluster.open_ioctx(pool)
+                except rados.ObjectNotFound:
+                    raise PoolNotFound("No pool %s found" % pool)
+            return self._ioctxs[pool]
+
+    def shutdown(self):
+        with self._lock:
+            for ioctx in self._ioctxs.values():
+                ioctx.close()
+            self._ioctxs.clear()
+            self.cluster.shutdown()
+
+
+class ConnectionManager(object):
+    """
+    Connections keyed by (conffile, cluster name), each one is connected once and reused by every borrower
+    """
+
+    def __init__(self):
+        self._connections = {}
+        self._lock = Lock()
+
+    def get(self, conffile='/etc/ceph/ceph.conf', cluster='ceph'):
+        """
+        Get shared connection, connecting on first use
+        :param conffile: Path to ceph.conf file
+        :type conffile: str
+        :param cluster: Ceph cluster name
+        :type cluster: str
+        :rtype: ClusterConnection
+        """
+        key = (conffile, cluster)
+        with self._lock:
+            if key not in self._connections:
+                logger.debug("Connecting to cluster %s (%s)", cluster, conffile)
+                self._connections[key] = ClusterConnection(conffile, cluster)
+            return self._connections[key]
+
+    def shutdown(self):
+        """Close all ioctxs and shutdown all connections"""
+        with self._lock:
+            connections = list(self._connections.values())
+            self._connections.clear()
+        for connection in connections:
+            try:
+                connection.shutdown()
+            except Exception:
+                logger.debug("Handled exception", exc_info=True)
+
+
+connections = ConnectionManager()
+atexit.register(connections.shutdown)
@@ -0,0 +1,172 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+# Sidecar extent index of .diff files and random access reader on top of it
+import bisect
+import mmap
+import os
+import struct
+
+from .export_diff import ExtentMap, scan_diff
+
+INDEX_MAGIC = b'rbd diff index v2\n'
+INDEX_SUFFIX = '.idx'
+_NO_VALUE = (1 << 64) - 1
+# image size, diff file size, inode and mtime (ns) of diff file, number of records
+_INDEX_HEADER = struct.Struct('<QQQQQ')
+_INDEX_RECORD = struct.Struct('<QQQ')  # offset, length, payload position in diff
+
+
+def _diff_stamp(st):
+    """Size, inode and mtime in ns of diff file, an index made for other values is stale"""
+    mtime = getattr(st, 'st_mtime_ns', None)
+    if mtime is None:
+        # python 2
+        mtime = int(st.st_mtime * 1e9)
+    return st.st_size, st.st_ino, mtime
+
+
+def build_index(diff_path, index_path=None):
+    """
+    Scan diff record headers and store extent -> file offset map next to the diff
+    :param diff_path: path of .diff file
+    :type diff_path: str
+    :param index_path: path of index file (defaults to diff path with .idx suffix)
+    :type index_path: str
+    :return: path of index file
+    :rtype: str
+    """
+    index_path = index_path or diff_path + INDEX_SUFFIX
+    with open(diff_path, 'rb') as ifh:
+        info = scan_diff(ifh)
+        stamp = _diff_stamp(os.fstat(ifh.fileno()))
+    extent_map = ExtentMap()
+    extent_map.add_diff(0, info)
+    tmp_path = index_path + '.tmp'
+    with open(tmp_path, 'wb') as ofh:
+        ofh.write(INDEX_MAGIC)
+        header = (_NO_VALUE if info.size is None else info.size,) + stamp + (len(extent_map),)
+        ofh.write(_INDEX_HEADER.pack(*header))
+        for offset, length, source, position in extent_map:
+            ofh.write(_INDEX_RECORD.pack(offset, length, _NO_VALUE if position is None else position))
+    os.rename(tmp_path, index_path)
+    return index_path
+
+
+class _Offsets(object):
+    """Sequence of extent offsets read straight from the mapped index, used for bisect"""
+
+    def __init__(self, index):
+        self.index = index
+
+    def __len__(self):
+        return self.index.count
+
+    def __getitem__(self, i):
+        return self.index.record(i)[0]
+
+
+class DiffReader(object):
+    """
+    Random access to the logical image content stored in a .diff file.
+    Both diff and its index are memory-mapped, extent lookup is a binary search over the index.
+    Ranges not present in the diff are read from :parent (another reader of an older diff or a base image)
+    or returned as zeroes.
+
+    >>> with DiffReader('vm-1.diff', parent=DiffReader('vm-1.full.diff')) as r:
+    ...     data = r.read(offset, 4096)
+    """
+    HEADER_OFFSET = len(INDEX_MAGIC)
+    RECORDS_OFFSET = HEADER_OFFSET + _INDEX_HEADER.size
+
+    def __init__(self, diff_path, index_path=None, parent=None):
+        """
+        :param diff_path: path of .diff file
+        :type diff_path: str
+        :param index_path: path of index file, built if missing or stale
+        :type index_path: str
+        :param parent: object with read(offset, length) serving ranges missing in the diff
+        :type parent: object
+        """
+        self.parent = parent
+        index_path = index_path or diff_path + INDEX_SUFFIX
+        self._diff_fh = open(diff_path, 'rb')
+        stamp = _diff_stamp(os.fstat(self._diff_fh.fileno()))
+        diff_size = stamp[0]
+        if not self._index_valid(index_path, stamp):
+            build_index(diff_path, index_path)
+        self._index_fh = open(index_path, 'rb')
+        self._index = mmap.mmap(self._index_fh.fileno(), 0, access=mmap.ACCESS_READ)
+        self._diff = mmap.mmap(self._diff_fh.fileno(), 0, access=mmap.ACCESS_READ) if diff_size else b''
+        size, _, _, _, self.count = _INDEX_HEADER.unpack_from(self._index, self.HEADER_OFFSET)
+        self.size = None if size == _NO_VALUE else size
+        self._offsets = _Offsets(self)
+
+    @staticmethod
+    def _index_valid(index_path, stamp):
+        try:
+            with open(index_path, 'rb') as fh:
+                if fh.read(len(INDEX_MAGIC)) != INDEX_MAGIC:
+                    return False
+                # Same length is not enough, a diff can be rewritten with different layout
+                return _INDEX_HEADER.unpack(fh.read(_INDEX_HEADER.size))[1:4] == stamp
+        except (IOError, OSError, struct.error):
+            return False
+
+    def record(self, i):
+        return _INDEX_RECORD.unpack_from(self._index, self.RECORDS_OFFSET + i * _INDEX_RECORD.size)
+
+    def _fill(self, out, start, offset, length):
+        """Fill part of :out for ranges not stored in the diff"""
+        if self.parent is not None:
+            data = self.parent.read(offset, length)
+            out[start:start + len(data)] = data
+
+    def read(self, offset, length):
+        """
+        Read :length bytes of the image at :offset
+        :param offset: image offset
+        :type offset: int
+        :param length: number of bytes
+        :type length: int
+        :return: image data, shorter than :length at the end of image
+        :rtype: bytearray
+        """
+        if self.size is not None:
+            length = max(0, min(length, self.size - offset))
+        out = bytearray(length)
+        end = offset + length
+        cur = offset
+        i = max(0, bisect.bisect_right(self._offsets, offset) - 1)
+        while cur < end and i < self.count:
+            ext_offset, ext_length, position = self.record(i)
+            ext_end = ext_offset + ext_length
+            if ext_end <= cur:
+                i += 1
+                continue
+            if ext_offset >= end:
+                break
+            if ext_offset > cur:
+                self._fill(out, cur - offset, cur, ext_offset - cur)
+                cur = ext_offset
+            n = min(end, ext_end) - cur
+            if position != _NO_VALUE:
+                start = position + cur - ext_offset
+                out[cur - offset:cur - offset + n] = self._diff[start:start + n]
+            cur += n
+            i += 1
+        if cur < end:
+            self._fill(out, cur - offset, cur, end - cur)
+        return out
+
+    def close(self):
+        self._index.close()
+        self._index_fh.close()
+        if self._diff:
+            self._diff.close()
+        self._diff_fh.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
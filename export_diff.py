@@ -1,10 +1,20 @@
 #!/usr/bin/python
 # -*- coding: utf-8 -*-
 BLOCKSIZE = 256 << 10
-DIFF_MAGIC = 'rbd diff v1\n'
+DIFF_MAGIC = b'rbd diff v1\n'
 import struct
+from collections import namedtuple
 from ctypes import *
 import os
+from time import time
+
+from .fileio import pwrite, clone_file, copy_file_range
+from .metrics import BYTES, OP_SECONDS
+from .queue import ParallelReader, diff_extents, extents, is_zero, DEFAULT_READERS, DEFAULT_MAX_MEMORY
+
+_NAME_RECORD = struct.Struct('<cI')
+_SIZE_RECORD = struct.Struct('<cQ')
+_EXTENT_RECORD = struct.Struct('<cQQ')
 
 _libc = CDLL('libc.so.6', use_errno=True)
 
@@ -33,9 +43,95 @@ def read_items(fh, fmt):
         return items
 
 
-def apply_diff(ifh, ofh, verbose=True):
+def _readinto(fh, view):
+    """Fill whole :view from :fh"""
+    filled = 0
+    while filled < len(view):
+        n = fh.readinto(view[filled:])
+        if not n:
+            raise IOError('Unexpected end of diff')
+        filled += n
+
+
+class _DiffTarget(object):
     """
+    Output side of apply_diff.
+    Adjacent data records are collected into one buffer and written with a single pwrite,
+    adjacent zero records are merged and punched in batches.
+    """
+    MAX_PENDING_HOLES = 1024
+
+    def __init__(self, ofh, buf):
+        self.ofh = ofh
+        ofh.flush()
+        try:
+            self.fd = ofh.fileno()
+        except (AttributeError, IOError, ValueError):
+            self.fd = None
+        self.buf = buf
+        self.view = memoryview(buf)
+        self.start = 0
+        self.fill = 0
+        self.holes = []
+        self.holes_end = 0
+
+    def write_area(self, offset):
+        """Return writable part of buffer continuing data at :offset"""
+        if self.fill and (self.start + self.fill != offset or self.fill == len(self.buf)):
+            self.flush_data()
+        if offset < self.holes_end:
+            self.flush_holes()
+        if not self.fill:
+            self.start = offset
+        return self.view[self.fill:]
+
+    def written(self, length):
+        self.fill += length
+
+    def zero(self, offset, length):
+        if self.fill and offset < self.start + self.fill and self.start < offset + length:
+            self.flush_data()
+        if self.holes and self.holes[-1][0] + self.holes[-1][1] == offset:
+            self.holes[-1][1] += length
+        else:
+            self.holes.append([offset, length])
+            if len(self.holes) > self.MAX_PENDING_HOLES:
+                self.flush_holes()
+        self.holes_end = max(self.holes_end, offset + length)
+
+    def flush_data(self):
+        if not self.fill:
+            return
+        started = time()
+        if self.fd is not None:
+            pwrite(self.fd, self.buf, self.start, self.fill)
+        else:
+            self.ofh.seek(self.start)
+            self.ofh.write(self.view[:self.fill].tobytes())
+        OP_SECONDS.observe(time() - started, 'write')
+        BYTES.inc(self.fill, 'written')
+        self.fill = 0
+
+    def flush_holes(self):
+        for offset, length in self.holes:
+            punch(self.ofh, offset, length)
+            BYTES.inc(length, 'skipped')
+        self.holes = []
+        self.holes_end = 0
+
+    def truncate(self, size):
+        self.flush()
+        self.ofh.truncate(size)
 
+    def flush(self):
+        self.flush_data()
+        self.flush_holes()
+
+
+def apply_diff(ifh, ofh, verbose=True):
+    """
+    Apply diff to file: record headers are parsed with precompiled structs into a reusable buffer,
+    data is read straight into the output buffer and written with pwrite, zero records are punched in batches
     :param ifh: Input file (.diff)
     :type ifh: file
     :param ofh: Output file
@@ -51,39 +147,473 @@ def apply_diff(ifh, ofh, verbose=True):
     buf = ifh.read(len(DIFF_MAGIC))
     if buf != DIFF_MAGIC:
         raise IOError('Missing diff magic string')
+    header = bytearray(_EXTENT_RECORD.size)
+    header_view = memoryview(header)
+    target = _DiffTarget(ofh, bytearray(BLOCKSIZE))
     # Read each record
     while True:
-        type = read_items(ifh, 'c')
-        if type in ('f', 't'):
+        _readinto(ifh, header_view[:1])
+        type = bytes(header[:1])
+        if type in (b'f', b't'):
             # Source/dest snapshot name => ignore
-            size = read_items(ifh, '<I')
+            _readinto(ifh, header_view[1:_NAME_RECORD.size])
+            size = _NAME_RECORD.unpack_from(header)[1]
             ifh.read(size)
-        elif type == 's':
+        elif type == b's':
             # Image size
-            total_size = read_items(ifh, '<Q')
-            ofh.truncate(total_size)
-        elif type == 'w':
+            _readinto(ifh, header_view[1:_SIZE_RECORD.size])
+            total_size = _SIZE_RECORD.unpack_from(header)[1]
+            target.truncate(total_size)
+        elif type == b'w':
             # Data
-            offset, length = read_items(ifh, '<QQ')
+            _readinto(ifh, header_view[1:])
+            offset, length = _EXTENT_RECORD.unpack_from(header)[1:]
             total_changed += length
-            ofh.seek(offset)
             while length > 0:
-                buf = ifh.read(min(length, BLOCKSIZE))
-                ofh.write(buf)
-                length -= len(buf)
-        elif type == 'z':
+                area = target.write_area(offset)
+                n = min(length, len(area))
+                _readinto(ifh, area[:n])
+                target.written(n)
+                offset += n
+                length -= n
+        elif type == b'z':
             # Zero data
-            offset, length = read_items(ifh, '<QQ')
+            _readinto(ifh, header_view[1:])
+            offset, length = _EXTENT_RECORD.unpack_from(header)[1:]
             total_changed += length
-            punch(ofh, offset, length)
-        elif type == 'e':
-            if ifh.read(1) != '':
+            target.zero(offset, length)
+        elif type == b'e':
+            if ifh.read(1):
                 raise IOError("Expected EOF, didn't find it")
             break
         else:
             raise ValueError('Unknown record type: %s' % type)
+    target.flush()
+    if verbose:
+        print('%d bytes written, %d total' % (total_changed, total_size))
+
+
+def export_diff_native(image, ofh, from_snap=None, to_snap=None, bs=None, readers=DEFAULT_READERS,
+                       max_memory=DEFAULT_MAX_MEMORY, whole_object=False, bucket=None, cb=None, hasher=None):
+    """
+    Write changes of image since :from_snap to :ofh in the same format as `rbd export-diff`
+    :param image: image opened at the newer snapshot
+    :type image: rbd.Image
+    :param ofh: output file-like object, only write() is used
+    :type ofh: file
+    :param from_snap: name of the older snapshot, full image diff if not specified
+    :type from_snap: str
+    :param to_snap: name of snapshot :image is opened at, stored in the diff header
+    :type to_snap: str
+    :param bs: maximum length of single data record (defaults to object size)
+    :type bs: int
+    :param readers: number of concurrent readers
+    :type readers: int
+    :param max_memory: maximum bytes of blocks read ahead of the writer
+    :type max_memory: int
+    :param whole_object: diff whole objects (fast with fast-diff, but larger result)
+    :type whole_object: bool
+    :param bucket: rate limiter for read data
+    :type bucket: tokenbucket.TokenBucket
+    :param cb: progress callback, called with (current, total) changed bytes
+    :type cb: callable
+    :param hasher: digests of written and zeroed records are added to it
+    :type hasher: manifest.BlockHasher
+    :return: number of changed bytes
+    :rtype: int
+    """
+    total = image.size()
+    if not bs:
+        bs = 1 << image.stat()['order']
+    ofh.write(DIFF_MAGIC)
+    for tag, name in ((b'f', from_snap), (b't', to_snap)):
+        if name:
+            if not isinstance(name, bytes):
+                name = name.encode('utf-8')
+            ofh.write(_NAME_RECORD.pack(tag, len(name)))
+            ofh.write(name)
+    ofh.write(_SIZE_RECORD.pack(b's', total))
+
+    records = []
+    for offset, length, exists in diff_extents(image, total, from_snap, whole_object):
+        end = min(offset + length, total)
+        if exists:
+            records.extend((extent[0], extent[1], True) for extent in extents(end, bs, offset))
+        elif end > offset:
+            records.append((offset, end - offset, False))
+    changed = sum(record[1] for record in records)
+
+    engine = iter(ParallelReader(image, ((offset, length) for offset, length, exists in records if exists), bs,
+                                 readers=readers, max_memory=max_memory))
+    cur = 0
+    try:
+        for offset, length, exists in records:
+            if exists:
+                offset, data = next(engine)
+                if bucket:
+                    bucket.acquire(len(data))
+                if is_zero(data):
+                    BYTES.inc(len(data), 'skipped')
+                    exists = False
+                else:
+                    ofh.write(_EXTENT_RECORD.pack(b'w', offset, length))
+                    ofh.write(data)
+                    if hasher:
+                        hasher.add(offset, data)
+            if not exists:
+                ofh.write(_EXTENT_RECORD.pack(b'z', offset, length))
+                if hasher:
+                    hasher.zero(offset, length)
+            cur += length
+            if cb:
+                cb(cur, changed)
+    finally:
+        engine.close()
+    ofh.write(b'e')
+    return changed
+
+DiffInfo = namedtuple('DiffInfo', ['from_snap', 'to_snap', 'size', 'extents'])
+
+
+def scan_diff(ifh):
+    """
+    Read record headers of diff, seeking over data payloads instead of reading them
+    :param ifh: seekable input file (.diff)
+    :type ifh: file
+    :return: snapshot names, image size and list of (offset, length, payload position) records,
+             payload position is None for zero records
+    :rtype: DiffInfo
+    """
+    from_snap = to_snap = None
+    size = None
+    records = []
+    if ifh.read(len(DIFF_MAGIC)) != DIFF_MAGIC:
+        raise IOError('Missing diff magic string')
+    header = bytearray(_EXTENT_RECORD.size)
+    header_view = memoryview(header)
+    while True:
+        _readinto(ifh, header_view[:1])
+        type = bytes(header[:1])
+        if type in (b'f', b't'):
+            _readinto(ifh, header_view[1:_NAME_RECORD.size])
+            name = ifh.read(_NAME_RECORD.unpack_from(header)[1])
+            if type == b'f':
+                from_snap = name
+            else:
+                to_snap = name
+        elif type == b's':
+            _readinto(ifh, header_view[1:_SIZE_RECORD.size])
+            size = _SIZE_RECORD.unpack_from(header)[1]
+        elif type in (b'w', b'z'):
+            _readinto(ifh, header_view[1:])
+            offset, length = _EXTENT_RECORD.unpack_from(header)[1:]
+            if type == b'w':
+                records.append((offset, length, ifh.tell()))
+                ifh.seek(length, os.SEEK_CUR)
+            else:
+                records.append((offset, length, None))
+        elif type == b'e':
+            break
+        else:
+            raise ValueError('Unknown record type: %s' % type)
+    return DiffInfo(from_snap, to_snap, size, records)
+
+
+def check_chain(previous, info):
+    """
+    Check that diff :info continues diff :previous, like `rbd merge-diff` does
+    :param previous: scanned older diff, None for the first one
+    :type previous: DiffInfo
+    :param info: scanned newer diff
+    :type info: DiffInfo
+    :raises ValueError: if the FROM snapshot of :info is not the TO snapshot of :previous
+    """
+    if previous is None or previous.to_snap is None or info.from_snap is None:
+        return
+    if info.from_snap != previous.to_snap:
+        raise ValueError('Diffs are not consecutive: %r follows %r' % (info.from_snap, previous.to_snap))
+
+
+class ExtentMap(object):
+    """
+    Sorted non-overlapping extents of an image with the latest source of their data.
+    Each extent is (offset, length, source, position): data of the extent is :length bytes at :position of
+    :source, extents with :position None are zeroes. Later overlays win over earlier ones.
+    """
+
+    def __init__(self):
+        self.extents = []
+
+    @staticmethod
+    def _runs(extents):
+        """Split extents into runs of sorted non-overlapping extents, keeping their order"""
+        run = []
+        for extent in extents:
+            if run and extent[0] < run[-1][0] + run[-1][1]:
+                yield run
+                run = []
+            run.append(extent)
+        if run:
+            yield run
+
+    def overlay(self, extents):
+        """
+        Put :extents on top of the map
+        :param extents: list of (offset, length, source, position)
+        :type extents: list
+        """
+        for top in self._runs(e for e in extents if e[1]):
+            kept = []
+            j = 0
+            for offset, length, source, position in self.extents:
+                end = offset + length
+                while j < len(top) and top[j][0] + top[j][1] <= offset:
+                    j += 1
+                cur = offset
+                k = j
+                while k < len(top) and top[k][0] < end:
+                    if top[k][0] > cur:
+                        kept.append(self._piece(offset, source, position, cur, top[k][0]))
+                    cur = max(cur, top[k][0] + top[k][1])
+                    k += 1
+                if cur < end:
+                    kept.append(self._piece(offset, source, position, cur, end))
+            kept.extend(top)
+            kept.sort()
+            self.extents = kept
+
+    @staticmethod
+    def _piece(offset, source, position, start, end):
+        if position is not None:
+            position += start - offset
+        return start, end - start, source, position
+
+    def truncate(self, size):
+        """Drop everything after :size"""
+        kept = []
+        for offset, length, source, position in self.extents:
+            if offset >= size:
+                break
+            kept.append((offset, min(length, size - offset), source, position))
+        self.extents = kept
+
+    def add_diff(self, source, info, prev_size=None):
+        """
+        Apply scanned diff on top of the map
+        :param source: anything identifying the diff file
+        :param info: result of scan_diff
+        :type info: DiffInfo
+        :param prev_size: image size before this diff
+        :type prev_size: int
+        """
+        if info.size is not None and prev_size is not None:
+            if info.size < prev_size:
+                self.truncate(info.size)
+            elif info.size > prev_size:
+                # Shrunk and grown again image is zero past the old end
+                self.overlay([(prev_size, info.size - prev_size, None, None)])
+        self.overlay([(offset, length, source if position is not None else None, position)
+                      for offset, length, position in info.extents])
+        if info.size is not None:
+            self.truncate(info.size)
+
+    def __iter__(self):
+        return iter(self.extents)
+
+    def __len__(self):
+        return len(self.extents)
+
+
+def copy_range(ifh, ofh, position, length, buf=None):
+    """Copy :length bytes at :position of :ifh to current position of :ofh"""
+    if buf is None:
+        buf = bytearray(BLOCKSIZE)
+    view = memoryview(buf)
+    ifh.seek(position)
+    while length > 0:
+        n = min(length, len(buf))
+        _readinto(ifh, view[:n])
+        ofh.write(view[:n].tobytes() if n < len(buf) else buf)
+        length -= n
+
+
+def merge_diff_native(ifhs, ofh):
+    """
+    Merge ordered list of diffs (oldest first) into one diff.
+    Record headers of all diffs are scanned first, then the data of every extent which survived
+    newer diffs is copied once from the newest diff holding it.
+    ValueError is raised if a diff does not start at the snapshot the previous one ends at
+    :param ifhs: seekable input files (.diff)
+    :type ifhs: list
+    :param ofh: output file-like object, only write() is used
+    :type ofh: file
+    :return: number of changed bytes in merged diff
+    :rtype: int
+    """
+    if not ifhs:
+        raise ValueError('Nothing to merge')
+    extent_map = ExtentMap()
+    from_snap = to_snap = size = None
+    previous = None
+    for index, ifh in enumerate(ifhs):
+        info = scan_diff(ifh)
+        check_chain(previous, info)
+        previous = info
+        if not index:
+            from_snap = info.from_snap
+        extent_map.add_diff(index, info, size)
+        to_snap = info.to_snap
+        if info.size is not None:
+            size = info.size
+
+    ofh.write(DIFF_MAGIC)
+    for tag, name in ((b'f', from_snap), (b't', to_snap)):
+        if name:
+            ofh.write(_NAME_RECORD.pack(tag, len(name)))
+            ofh.write(name)
+    if size is not None:
+        ofh.write(_SIZE_RECORD.pack(b's', size))
+
+    buf = bytearray(BLOCKSIZE)
+    changed = 0
+    extents = list(extent_map)
+    i = 0
+    while i < len(extents):
+        # Adjacent extents of the same kind go to a single record
+        offset, length, source, position = extents[i]
+        j = i + 1
+        end = offset + length
+        while j < len(extents) and extents[j][0] == end and (extents[j][3] is None) == (position is None):
+            end += extents[j][1]
+            j += 1
+        if position is None:
+            ofh.write(_EXTENT_RECORD.pack(b'z', offset, end - offset))
+        else:
+            ofh.write(_EXTENT_RECORD.pack(b'w', offset, end - offset))
+            for offset, length, source, position in extents[i:j]:
+                copy_range(ifhs[source], ofh, position, length, buf)
+        changed += end - extents[i][0]
+        i = j
+    ofh.write(b'e')
+    return changed
+
+
+def _uncovered(ranges, extents, size):
+    """Parts of sorted (offset, length) :ranges below :size not covered by sorted :extents"""
+    extents = iter(extents)
+    extent = next(extents, None)
+    for offset, length in ranges:
+        end = min(offset + length, size)
+        while offset < end:
+            while extent is not None and extent[0] + extent[1] <= offset:
+                extent = next(extents, None)
+            if extent is None or extent[0] >= end:
+                yield offset, end - offset
+                break
+            if extent[0] > offset:
+                yield offset, extent[0] - offset
+            offset = extent[0] + extent[1]
+
+
+def _copy_image(source, position, ofh, offset, length, keep_holes):
+    """
+    Copy :length bytes at :position of opened image file :source to :offset of :ofh.
+    Raw files are copied in kernel, data of compressed ones is decompressed and zero blocks
+    are skipped (:keep_holes) or punched
+    :return: number of written bytes
+    :rtype: int
+    """
+    from .compress import CompressedImageFile
+
+    fd = ofh.fileno()
+    if not isinstance(source, CompressedImageFile):
+        if copy_file_range(source.fd, position, fd, offset, length) != length:
+            raise IOError('Unexpected end of %s' % getattr(source, 'path', 'file'))
+        return length
+    written = 0
+    for block_offset, block_length in extents(length, BLOCKSIZE):
+        data = source.read(position + block_offset, block_length)
+        if len(data) != block_length:
+            raise IOError('Unexpected end of compressed file')
+        if is_zero(data):
+            if not keep_holes:
+                punch(ofh, offset + block_offset, block_length)
+            BYTES.inc(block_length, 'skipped')
+        else:
+            pwrite(fd, data, offset + block_offset)
+            written += block_length
+    return written
+
+
+def materialize(base, diffs, target, base_snap=None, verbose=False):
+    """
+    Build full image of the newest snapshot from full dump :base and chain of diffs without applying them one by one.
+    Record headers of all diffs are scanned into one ExtentMap first. The base is cloned into :target (reflink)
+    where the filesystem allows it, otherwise only its data not overwritten by the chain is copied. Then every
+    surviving extent is written once from the newest diff holding it and zeroed ones are punched, so the I/O
+    is proportional to the changed data, not to the chain length. Raw and compressed inputs are accepted.
+    ValueError is raised if a diff does not start at the snapshot the previous one (or :base_snap) ends at
+    :param base: path of full image dump
+    :type base: str
+    :param diffs: paths of diffs, oldest first, the first one starting at the snapshot of :base
+    :type diffs: list
+    :param target: path of the result file, overwritten
+    :type target: str
+    :param base_snap: name of the snapshot :base was dumped from, checked against the first diff
+    :type base_snap: str
+    :param verbose: print summary
+    :type verbose: bool
+    :return: number of bytes written to :target, cloned blocks excluded
+    :rtype: int
+    """
+    from .compress import open_image, open_input, CompressedImageFile
+
+    sources = []
+    base_image = open_image(base)
+    try:
+        extent_map = ExtentMap()
+        size = base_image.size
+        if base_snap is not None and not isinstance(base_snap, bytes):
+            # Names in diffs are raw bytes
+            base_snap = base_snap.encode('utf-8')
+        previous = DiffInfo(None, base_snap, None, None)
+        for index, path in enumerate(diffs):
+            ifh = open_input(path)
+            try:
+                info = scan_diff(ifh)
+            finally:
+                ifh.close()
+            check_chain(previous, info)
+            previous = info
+            extent_map.add_diff(index, info, size)
+            if info.size is not None:
+                size = info.size
+            sources.append(open_image(path))
+
+        written = 0
+        with open(target, 'wb') as ofh:
+            cloned = not isinstance(base_image, CompressedImageFile) and clone_file(base_image.fd, ofh.fileno())
+            ofh.truncate(size)
+            if not cloned:
+                # Target is one hole now, only base data which survived the chain is copied into it
+                for offset, length in _uncovered(base_image.data_extents(), extent_map, min(size, base_image.size)):
+                    written += _copy_image(base_image, offset, ofh, offset, length, True)
+            for offset, length, source, position in extent_map:
+                if position is not None:
+                    written += _copy_image(sources[source], position, ofh, offset, length, not cloned)
+                    continue
+                if cloned and offset < base_image.size:
+                    punch(ofh, offset, min(length, base_image.size - offset))
+                BYTES.inc(length, 'skipped')
+        BYTES.inc(written, 'written')
+    finally:
+        base_image.close()
+        for source in sources:
+            source.close()
     if verbose:
-        print '%d bytes written, %d total' % (total_changed, total_size)
+        print('%d bytes written%s, %d total' % (written, ', base cloned' if cloned else '', size))
+    return written
+
 
 import subprocess
 from .ceph import logger
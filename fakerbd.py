@@ -0,0 +1,466 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+# In-memory stand-in for the rados and rbd modules with simulated latency and bandwidth
+from __future__ import division
+import errno
+import json
+import sys
+import zlib
+from collections import OrderedDict
+from threading import Event, Lock, Thread
+from time import time, sleep
+from types import ModuleType
+
+
+class Error(Exception):
+    pass
+
+
+class ObjectNotFound(Error):
+    pass
+
+
+class ImageNotFound(Error):
+    pass
+
+
+class ImageExists(Error):
+    pass
+
+
+class ImageBusy(Error):
+    pass
+
+
+class InvalidArgument(Error):
+    pass
+
+
+class ReadOnlyImage(Error):
+    pass
+
+
+class Link(object):
+    """
+    Network between client and cluster: every operation takes :latency seconds
+    and its payload is sent over a link of :bandwidth bytes per second shared by all operations
+    """
+
+    def __init__(self, latency=0.0, bandwidth=None):
+        """
+        :param latency: seconds added to every operation
+        :type latency: float
+        :param bandwidth: bytes per second of the link, unlimited if not specified
+        :type bandwidth: int
+        """
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self._busy = 0.0
+        self._lock = Lock()
+
+    def transfer(self, length=0):
+        done = time()
+        if self.bandwidth and length:
+            with self._lock:
+                self._busy = max(done, self._busy) + length / self.bandwidth
+                done = self._busy
+        delay = done + self.latency - time()
+        if delay > 0:
+            sleep(delay)
+
+
+class Cluster(object):
+    """State of the simulated cluster: pools of images and the link to them"""
+
+    def __init__(self, pools=('rbd',), latency=0.0, bandwidth=None, hosts=3, osds_per_host=2):
+        """
+        :param pools: names of existing pools
+        :type pools: list
+        :param latency: seconds added to every operation
+        :type latency: float
+        :param bandwidth: bytes per second shared by all operations
+        :type bandwidth: int
+        :param hosts: number of OSD hosts reported by mon commands
+        :type hosts: int
+        :param osds_per_host: number of OSDs of every host
+        :type osds_per_host: int
+        """
+        self.pools = dict((pool, {}) for pool in pools)
+        self.link = Link(latency, bandwidth)
+        self.hosts = hosts
+        self.osds_per_host = osds_per_host
+
+    def primary_osd(self, pool, name):
+        """Stable pseudo-random placement of object"""
+        key = ('%s/%s' % (pool, name)).encode('utf-8')
+        return zlib.crc32(key) % (self.hosts * self.osds_per_host)
+
+
+_cluster = Cluster()
+
+
+class _Snapshot(object):
+    __slots__ = ('id', 'size', 'objects', 'protected')
+
+    def __init__(self, snap_id, size, objects):
+        self.id = snap_id
+        self.size = size
+        self.objects = objects
+        self.protected = False
+
+
+class _ImageData(object):
+    """
+    Image content as a map of object number -> bytearray, unallocated objects are missing.
+    Snapshots share objects with the head, which copies them before writing
+    """
+
+    def __init__(self, size, order, features, stripe_unit, stripe_count):
+        self.size = size
+        self.order = order
+        self.features = features
+        self.stripe_unit = stripe_unit or 1 << order
+        self.stripe_count = stripe_count or 1
+        self.objects = {}
+        self.shared = set()
+        self.snaps = OrderedDict()
+        self.next_snap_id = 1
+        self.lock = Lock()
+
+    @property
+    def object_size(self):
+        return 1 << self.order
+
+    def own(self, index):
+        """Object of head ready to be modified in place"""
+        current = self.objects.get(index)
+        if current is None or index in self.shared:
+            current = bytearray(self.object_size) if current is None else bytearray(current)
+            self.objects[index] = current
+            self.shared.discard(index)
+        return current
+
+    def drop(self, index):
+        self.objects.pop(index, None)
+        self.shared.discard(index)
+
+
+class Rados(object):
+    def __init__(self, rados_id=None, name=None, clustername=None, conf_defaults=None, conffile=None, conf=None,
+                 flags=0):
+        self.cluster = _cluster
+        self.state = 'configuring'
+
+    def connect(self, timeout=0):
+        self.cluster.link.transfer()
+        self.state = 'connected'
+
+    def shutdown(self):
+        self.state = 'shutdown'
+
+    def list_pools(self):
+        return sorted(self.cluster.pools)
+
+    def pool_exists(self, pool):
+        return pool in self.cluster.pools
+
+    def create_pool(self, pool):
+        self.cluster.pools.setdefault(pool, {})
+
+    def open_ioctx(self, pool):
+        if pool not in self.cluster.pools:
+            raise ObjectNotFound("error opening pool '%s'" % pool)
+        return Ioctx(self.cluster, pool)
+
+    def mon_command(self, cmd, inbuf, timeout=0, target=None):
+        """Supports `osd map` and `osd find`, other commands fail with EINVAL"""
+        self.cluster.link.transfer()
+        command = json.loads(cmd)
+        if command.get('prefix') == 'osd map':
+            osd = self.cluster.primary_osd(command['pool'], command['object'])
+            result = {'pool': command['pool'], 'objname': command['object'], 'up': [osd], 'up_primary': osd,
+                      'acting': [osd], 'acting_primary': osd}
+        elif command.get('prefix') == 'osd find':
+            host = 'host%d' % (int(command['id']) // self.cluster.osds_per_host)
+            result = {'osd': int(command['id']), 'host': host, 'crush_location': {'host': host, 'root': 'default'}}
+        else:
+            return -errno.EINVAL, b'', 'command not known'
+        return 0, json.dumps(result).encode('utf-8'), ''
+
+
+class Ioctx(object):
+    def __init__(self, cluster, name):
+        self.cluster = cluster
+        self.name = name
+        self.images = cluster.pools[name]
+
+    def close(self):
+        pass
+
+
+class RBD(object):
+    def list(self, ioctx):
+        ioctx.cluster.link.transfer()
+        return sorted(ioctx.images)
+
+    def create(self, ioctx, name, size, order=None, old_format=True, features=None, stripe_unit=None,
+               stripe_count=None, data_pool=None):
+        ioctx.cluster.link.transfer()
+        if name in ioctx.images:
+            raise ImageExists("image %s already exists" % name)
+        ioctx.images[name] = _ImageData(size, order or 22, features or 0, stripe_unit, stripe_count)
+
+    def remove(self, ioctx, name):
+        ioctx.cluster.link.transfer()
+        data = ioctx.images.get(name)
+        if data is None:
+            raise ImageNotFound("image %s not found" % name)
+        if data.snaps:
+            raise ImageBusy("image %s has snapshots" % name)
+        del ioctx.images[name]
+
+
+class Completion(object):
+    def __init__(self):
+        self.rv = 0
+        self._done = Event()
+
+    def get_return_value(self):
+        return self.rv
+
+    def is_complete(self):
+        return self._done.is_set()
+
+    def wait_for_complete_and_cb(self):
+        self._done.wait()
+
+
+class Image(object):
+    def __init__(self, ioctx, name, snapshot=None, read_only=False):
+        self._link = ioctx.cluster.link
+        self._link.transfer()
+        self._data = ioctx.images.get(name)
+        if self._data is None:
+            raise ImageNotFound("image %s not found" % name)
+        if snapshot is not None and snapshot not in self._data.snaps:
+            raise ImageNotFound("snapshot %s not found" % snapshot)
+        self.name = name
+        self._snapshot = snapshot
+        self._read_only = read_only or snapshot is not None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        pass
+
+    def flush(self):
+        pass
+
+    def _view(self):
+        if self._snapshot is None:
+            return self._data.size, self._data.objects
+        snap = self._data.snaps[self._snapshot]
+        return snap.size, snap.objects
+
+    def _writable(self):
+        if self._read_only:
+            raise ReadOnlyImage("image %s is read only" % self.name)
+
+    def _snap(self, name):
+        snap = self._data.snaps.get(name)
+        if snap is None:
+            raise ImageNotFound("snapshot %s not found" % name)
+        return snap
+
+    def _chunks(self, offset, end):
+        obj = self._data.object_size
+        while offset < end:
+            index, start = divmod(offset, obj)
+            n = min(obj - start, end - offset)
+            yield offset, index, start, n
+            offset += n
+
+    def size(self):
+        return self._view()[0]
+
+    def features(self):
+        return self._data.features
+
+    def stripe_unit(self):
+        return self._data.stripe_unit
+
+    def stripe_count(self):
+        return self._data.stripe_count
+
+    def stat(self):
+        self._link.transfer()
+        size = self._view()[0]
+        obj = self._data.object_size
+        return {'size': size, 'obj_size': obj, 'num_objs': (size + obj - 1) // obj, 'order': self._data.order,
+                'block_name_prefix': 'rbd_data.%x' % id(self._data), 'parent_pool': -1, 'parent_name': ''}
+
+    def read(self, offset, length, fadvise_flags=0):
+        with self._data.lock:
+            size, objects = self._view()
+            if offset > size:
+                raise InvalidArgument("read beyond end of image")
+            end = min(offset + length, size)
+            out = bytearray(end - offset)
+            for pos, index, start, n in self._chunks(offset, end):
+                data = objects.get(index)
+                if data is not None:
+                    out[pos - offset:pos - offset + n] = data[start:start + n]
+        self._link.transfer(len(out))
+        return bytes(out)
+
+    def write(self, data, offset, fadvise_flags=0):
+        self._writable()
+        view = memoryview(data)
+        with self._data.lock:
+            if offset + len(view) > self._data.size:
+                raise InvalidArgument("write beyond end of image")
+            for pos, index, start, n in self._chunks(offset, offset + len(view)):
+                self._data.own(index)[start:start + n] = view[pos - offset:pos - offset + n]
+        self._link.transfer(len(view))
+        return len(view)
+
+    def discard(self, offset, length):
+        self._writable()
+        with self._data.lock:
+            end = min(offset + length, self._data.size)
+            for pos, index, start, n in self._chunks(offset, end):
+                if n == self._data.object_size or (start == 0 and pos + n == self._data.size):
+                    self._data.drop(index)
+                elif index in self._data.objects:
+                    self._data.own(index)[start:start + n] = bytearray(n)
+        self._link.transfer()
+        return 0
+
+    def _aio(self, completion, run):
+        thread = Thread(target=run)
+        thread.daemon = True
+        thread.start()
+        return completion
+
+    def aio_read(self, offset, length, oncomplete, fadvise_flags=0):
+        completion = Completion()
+
+        def run():
+            try:
+                data = self.read(offset, length, fadvise_flags)
+                completion.rv = len(data)
+            except Error:
+                data, completion.rv = None, -errno.EINVAL
+            oncomplete(completion, data)
+            completion._done.set()
+        return self._aio(completion, run)
+
+    def aio_write(self, data, offset, oncomplete, fadvise_flags=0):
+        completion = Completion()
+
+        def run():
+            try:
+                completion.rv = self.write(data, offset, fadvise_flags)
+            except ReadOnlyImage:
+                completion.rv = -errno.EROFS
+            except Error:
+                completion.rv = -errno.EINVAL
+            oncomplete(completion)
+            completion._done.set()
+        return self._aio(completion, run)
+
+    def diff_iterate(self, offset, length, from_snapshot, iterate_cb, include_parent=True, whole_object=False):
+        self._link.transfer()
+        with self._data.lock:
+            size, objects = self._view()
+            base = self._snap(from_snapshot).objects if from_snapshot is not None else None
+            changed = []
+            for pos, index, start, n in self._chunks(offset, min(offset + length, size)):
+                current = objects.get(index)
+                unchanged = current is None if base is None else current is base.get(index)
+                if unchanged:
+                    continue
+                changed.append((pos, n, current is not None))
+        for extent in changed:
+            iterate_cb(*extent)
+        return 0
+
+    def resize(self, size):
+        self._writable()
+        self._link.transfer()
+        with self._data.lock:
+            obj = self._data.object_size
+            if size < self._data.size:
+                for index in list(self._data.objects):
+                    if index * obj >= size:
+                        self._data.drop(index)
+                index, tail = divmod(size, obj)
+                if tail and index in self._data.objects:
+                    self._data.own(index)[tail:] = bytearray(obj - tail)
+            self._data.size = size
+
+    def list_snaps(self):
+        self._link.transfer()
+        with self._data.lock:
+            snaps = [{'id': snap.id, 'size': snap.size, 'name': name} for name, snap in self._data.snaps.items()]
+        return iter(snaps)
+
+    def create_snap(self, name):
+        self._writable()
+        self._link.transfer()
+        with self._data.lock:
+            if name in self._data.snaps:
+                raise ImageExists("snapshot %s already exists" % name)
+            self._data.snaps[name] = _Snapshot(self._data.next_snap_id, self._data.size, dict(self._data.objects))
+            self._data.shared = set(self._data.objects)
+            self._data.next_snap_id += 1
+
+    def remove_snap(self, name):
+        self._link.transfer()
+        with self._data.lock:
+            if self._snap(name).protected:
+                raise ImageBusy("snapshot %s is protected" % name)
+            del self._data.snaps[name]
+
+    def snap_get_id(self, name):
+        return self._snap(name).id
+
+    def protect_snap(self, name):
+        self._link.transfer()
+        self._snap(name).protected = True
+
+    def unprotect_snap(self, name):
+        self._link.transfer()
+        self._snap(name).protected = False
+
+    def is_protected_snap(self, name):
+        return self._snap(name).protected
+
+
+def install(cluster=None):
+    """
+    Make this module serve as both `rados` and `rbd`, including for already imported modules of the package
+    :param cluster: simulated cluster (a new one with 'rbd' pool by default)
+    :type cluster: Cluster
+    :return: the installed cluster
+    :rtype: Cluster
+    """
+    global _cluster
+    _cluster = cluster or Cluster()
+    module = sys.modules[__name__]
+    sys.modules['rados'] = sys.modules['rbd'] = module
+    package = __name__.rpartition('.')[0]
+    for name, loaded in list(sys.modules.items()):
+        if loaded is None or loaded is module or not name.startswith(package + '.'):
+            continue
+        for attr in ('rados', 'rbd'):
+            if isinstance(getattr(loaded, attr, None), ModuleType):
+                setattr(loaded, attr, module)
+        for attr in ('Rados', 'ObjectNotFound'):
+            if hasattr(loaded, attr):
+                setattr(loaded, attr, getattr(module, attr))
+    return _cluster
@@ -0,0 +1,235 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+# Low level file helpers missing in python 2 os module
+from ctypes import *
+import errno
+import os
+
+_libc = CDLL('libc.so.6', use_errno=True)
+
+_pwrite = _libc.pwrite64
+_pwrite.argtypes = [c_int, c_void_p, c_size_t, c_longlong]
+_pwrite.restype = c_ssize_t
+
+
+_pread = _libc.pread64
+_pread.argtypes = [c_int, c_void_p, c_size_t, c_longlong]
+_pread.restype = c_ssize_t
+
+
+def pread(fd, length, offset):
+    """
+    Read :length bytes at :offset of :fd without touching the file position, less at the end of file
+    :param fd: file descriptor
+    :type fd: int
+    :param length: number of bytes to read
+    :type length: int
+    :param offset: position in file
+    :type offset: int
+    :return: read data
+    :rtype: bytes
+    """
+    if hasattr(os, 'pread'):
+        chunks = []
+        got = 0
+        while got < length:
+            chunk = os.pread(fd, length - got, offset + got)
+            if not chunk:
+                break
+            chunks.append(chunk)
+            got += len(chunk)
+        return chunks[0] if len(chunks) == 1 else b''.join(chunks)
+    buf = create_string_buffer(length)
+    got = 0
+    while got < length:
+        rv = _pread(fd, addressof(buf) + got, length - got, offset + got)
+        if rv < 0:
+            raise OSError(get_errno(), 'pread() failed: %s' % os.strerror(get_errno()))
+        if not rv:
+            break
+        got += rv
+    return buf.raw[:got]
+
+
+def pwrite(fd, data, offset, length=None):
+    """
+    Write whole :data (or its first :length bytes) at :offset of :fd without touching the file position
+    :param fd: file descriptor
+    :type fd: int
+    :param data: data to write
+    :type data: str or bytearray or memoryview
+    :param offset: position in file
+    :type offset: int
+    :param length: number of bytes from the beginning of :data to write
+    :type length: int
+    :return: number of written bytes
+    :rtype: int
+    """
+    if length is None:
+        length = len(data)
+    if hasattr(os, 'pwrite'):
+        view = memoryview(data)
+        written = 0
+        while written < length:
+            written += os.pwrite(fd, view[written:length], offset + written)
+        return written
+    if isinstance(data, memoryview):
+        data = data.tobytes()
+    written = 0
+    while written < length:
+        if isinstance(data, bytearray):
+            buf = (c_char * (length - written)).from_buffer(data, written)
+        else:
+            buf = data[written:length] if written or length < len(data) else data
+        rv = _pwrite(fd, buf, length - written, offset + written)
+        if rv < 0:
+            raise OSError(get_errno(), 'pwrite() failed: %s' % os.strerror(get_errno()))
+        written += rv
+    return written
+
+
+SEEK_DATA = getattr(os, 'SEEK_DATA', 3)
+SEEK_HOLE = getattr(os, 'SEEK_HOLE', 4)
+
+
+def data_extents(fd, size):
+    """
+    Regions of file holding data according to SEEK_DATA/SEEK_HOLE,
+    whole file is one region on filesystems without hole reporting
+    :param fd: file descriptor
+    :type fd: int
+    :param size: file size
+    :type size: int
+    :return: generator of (offset, length)
+    :rtype: generator
+    """
+    cur = 0
+    while cur < size:
+        try:
+            start = os.lseek(fd, cur, SEEK_DATA)
+            end = os.lseek(fd, start, SEEK_HOLE)
+        except OSError as e:
+            if e.errno == errno.ENXIO:
+                # No data after cur
+                return
+            if e.errno == errno.EINVAL:
+                yield cur, size - cur
+                return
+            raise
+        end = min(end, size)
+        if start >= end:
+            return
+        yield start, end - start
+        cur = end
+
+
+FICLONE = 0x40049409
+# Errors of filesystems, kernels and file pairs which can't clone or copy in kernel, callers fall back to copying
+_UNSUPPORTED = frozenset((errno.EOPNOTSUPP, errno.ENOTTY, errno.EXDEV, errno.EINVAL, errno.ENOSYS, errno.EBADF))
+
+_copy_file_range = getattr(_libc, 'copy_file_range', None)
+if _copy_file_range is not None:
+    _copy_file_range.argtypes = [c_int, POINTER(c_longlong), c_int, POINTER(c_longlong), c_size_t, c_uint]
+    _copy_file_range.restype = c_ssize_t
+_kernel_copy = [True]
+
+
+def clone_file(src_fd, dst_fd):
+    """
+    Make :dst_fd share all blocks of :src_fd (reflink) on btrfs, XFS and other filesystems supporting FICLONE
+    :param src_fd: file descriptor of source file
+    :type src_fd: int
+    :param dst_fd: file descriptor of destination file opened for writing
+    :type dst_fd: int
+    :return: True if file was cloned, False if filesystem can't do it
+    :rtype: bool
+    """
+    import fcntl
+
+    try:
+        fcntl.ioctl(dst_fd, FICLONE, src_fd)
+        return True
+    except (IOError, OSError) as e:
+        if e.errno in _UNSUPPORTED or e.errno == errno.EPERM:
+            return False
+        raise
+
+
+def _kernel_copy_range(src_fd, src_offset, dst_fd, dst_offset, length):
+    if hasattr(os, 'copy_file_range'):
+        return os.copy_file_range(src_fd, dst_fd, length, src_offset, dst_offset)
+    if _copy_file_range is None:
+        raise OSError(errno.ENOSYS, 'copy_file_range() is not available')
+    src_pos = c_longlong(src_offset)
+    dst_pos = c_longlong(dst_offset)
+    rv = _copy_file_range(src_fd, byref(src_pos), dst_fd, byref(dst_pos), length, 0)
+    if rv < 0:
+        raise OSError(get_errno(), 'copy_file_range() failed: %s' % os.strerror(get_errno()))
+    return rv
+
+
+def copy_file_range(src_fd, src_offset, dst_fd, dst_offset, length, chunk_size=1 << 20):
+    """
+    Copy :length bytes at :src_offset of :src_fd to :dst_offset of :dst_fd without touching file positions.
+    Data stays in kernel (or is shared by the filesystem) where copy_file_range works, pread/pwrite otherwise
+    :param src_fd: file descriptor of source file
+    :type src_fd: int
+    :param src_offset: position in source file
+    :type src_offset: int
+    :param dst_fd: file descriptor of destination file
+    :type dst_fd: int
+    :param dst_offset: position in destination file
+    :type dst_offset: int
+    :param length: number of bytes to copy
+    :type length: int
+    :param chunk_size: size of reads of the fallback copy
+    :type chunk_size: int
+    :return: number of copied bytes, less if source ends earlier
+    :rtype: int
+    """
+    copied = 0
+    while copied < length and _kernel_copy[0]:
+        try:
+            n = _kernel_copy_range(src_fd, src_offset + copied, dst_fd, dst_offset + copied, length - copied)
+        except (IOError, OSError) as e:
+            if e.errno not in _UNSUPPORTED:
+                raise
+            # Not for this filesystem or kernel, no point trying again
+            _kernel_copy[0] = False
+            break
+        if not n:
+            return copied
+        copied += n
+    while copied < length:
+        data = pread(src_fd, min(chunk_size, length - copied), src_offset + copied)
+        if not data:
+            break
+        pwrite(dst_fd, data, dst_offset + copied)
+        copied += len(data)
+    return copied
+
+
+_fallocate = _libc.fallocate64
+_fallocate.argtypes = [c_int, c_int, c_longlong, c_longlong]
+_fallocate.restype = c_int
+
+
+def fallocate(fd, offset, length, mode=0):
+    """
+    Reserve blocks of :fd for the range, so writes into it don't allocate and fragment the file
+    :param fd: file descriptor
+    :type fd: int
+    :param offset: start of the range
+    :type offset: int
+    :param length: length of the range
+    :type length: int
+    :param mode: fallocate flags, file size grows to the end of the range without FALLOC_FL_KEEP_SIZE
+    :type mode: int
+    :return: False if filesystem can't preallocate
+    :rtype: bool
+    """
+    if _fallocate(fd, mode, offset, length):
+        if get_errno() in (errno.EOPNOTSUPP, errno.ENOSYS):
+            return False
+        raise OSError(get_errno(), 'fallocate() failed: %s' % os.strerror(get_errno()))
+    return True
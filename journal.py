@@ -0,0 +1,161 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+# Checkpoint journal of resumable exports
+import os
+import struct
+import zlib
+from time import time
+
+JOURNAL_MAGIC = b'pyceph export journal v2\n'
+JOURNAL_SUFFIX = '.journal'
+DEFAULT_SYNC_BYTES = 256 << 20
+DEFAULT_SYNC_INTERVAL = 10
+_HEADER = struct.Struct('<QQQQ')  # snapshot id, image size, device and inode of output file
+_RECORD = struct.Struct('<QI')  # watermark, crc32 of watermark
+
+
+def _crc(watermark):
+    return zlib.crc32(struct.pack('<Q', watermark)) & 0xffffffff
+
+
+class ExportJournal(object):
+    """
+    Journal of export progress kept next to the output file.
+
+    The export is written in image order, so progress is a single watermark: every byte of the
+    output below it is on disk. Output is fdatasync'ed before a watermark is appended, which happens
+    every :sync_bytes or :sync_interval seconds. Journal of another snapshot or image size is ignored,
+    so is a journal whose output file was removed, replaced (another inode) or is not of image size.
+
+    >>> journal = ExportJournal(fn, snap_id, size, fd)
+    >>> start = journal.open()
+    >>> journal.advance(offset)  # after writing everything below offset
+    >>> journal.complete()
+    """
+
+    def __init__(self, output, snap_id, size, fd=None, sync_bytes=DEFAULT_SYNC_BYTES,
+                 sync_interval=DEFAULT_SYNC_INTERVAL, sync=None):
+        """
+        :param output: path of exported file
+        :type output: str
+        :param snap_id: id of exported snapshot
+        :type snap_id: int
+        :param size: size of exported image
+        :type size: int
+        :param fd: unbuffered descriptor the output is written through, synced before every checkpoint
+        :type fd: int
+        :param sync_bytes: checkpoint after this many bytes of progress
+        :type sync_bytes: int
+        :param sync_interval: checkpoint after this many seconds
+        :type sync_interval: float
+        :param sync: makes output durable instead of fdatasync of :fd, e.g. AioWriter.sync waiting for in-flight writes
+        :type sync: callable
+        """
+        self.output = output
+        self.path = output + JOURNAL_SUFFIX
+        self.fd = fd
+        self.sync = sync
+        self.snap_id = snap_id
+        self.size = size
+        self.sync_bytes = sync_bytes
+        self.sync_interval = sync_interval
+        self.watermark = 0
+        self._synced = 0
+        self._synced_at = time()
+        self._fh = None
+
+    def _output_stat(self):
+        """Stat of output file, None if there is none"""
+        try:
+            return os.fstat(self.fd) if self.fd is not None else os.stat(self.output)
+        except OSError:
+            return None
+
+    def read(self):
+        """
+        Watermark stored in existing journal
+        :return: watermark, None if there is no journal of the same snapshot and image size
+                 or its output file is not the one the journal was written for
+        :rtype: int
+        """
+        try:
+            with open(self.path, 'rb') as fh:
+                data = fh.read()
+        except (IOError, OSError):
+            return None
+        if not data.startswith(JOURNAL_MAGIC) or len(data) < len(JOURNAL_MAGIC) + _HEADER.size:
+            return None
+        st = self._output_stat()
+        if st is None or st.st_size != self.size:
+            return None
+        if _HEADER.unpack_from(data, len(JOURNAL_MAGIC)) != (self.snap_id, self.size, st.st_dev, st.st_ino):
+            return None
+        watermark = 0
+        position = len(JOURNAL_MAGIC) + _HEADER.size
+        # A torn last record fails the checksum or is too short and is ignored
+        while position + _RECORD.size <= len(data):
+            offset, crc = _RECORD.unpack_from(data, position)
+            if crc != _crc(offset) or offset > self.size:
+                break
+            watermark = max(watermark, offset)
+            position += _RECORD.size
+        return watermark
+
+    def open(self, resume=True):
+        """
+        Start journaling
+        :param resume: continue from the watermark of existing journal
+        :type resume: bool
+        :return: offset the export starts from
+        :rtype: int
+        """
+        watermark = self.read() if resume else None
+        if watermark is None:
+            st = self._output_stat()
+            with open(self.path, 'wb') as fh:
+                fh.write(JOURNAL_MAGIC)
+                fh.write(_HEADER.pack(self.snap_id, self.size, st.st_dev if st else 0, st.st_ino if st else 0))
+                fh.flush()
+                os.fsync(fh.fileno())
+            watermark = 0
+        self._fh = open(self.path, 'ab')
+        self.watermark = self._synced = watermark
+        self._synced_at = time()
+        return watermark
+
+    def advance(self, watermark):
+        """Everything below :watermark is written, checkpoint if the batch is full"""
+        self.watermark = watermark
+        if watermark - self._synced >= self.sync_bytes or time() - self._synced_at >= self.sync_interval:
+            self.checkpoint()
+
+    def checkpoint(self):
+        """Sync output and store current watermark"""
+        if self._fh is None or self.watermark == self._synced:
+            return
+        if self.sync:
+            self.sync()
+        else:
+            os.fdatasync(self.fd)
+        self._fh.write(_RECORD.pack(self.watermark, _crc(self.watermark)))
+        self._fh.flush()
+        os.fsync(self._fh.fileno())
+        self._synced = self.watermark
+        self._synced_at = time()
+
+    def close(self):
+        """Checkpoint and keep the journal for the next run"""
+        if self._fh is not None:
+            self.checkpoint()
+            self._fh.close()
+            self._fh = None
+
+    def complete(self):
+        """Export finished, the journal is not needed anymore"""
+        if self._fh is not None:
+            self._fh.close()
+            self._fh = None
+        try:
+            os.unlink(self.path)
+        except OSError:
+            pass
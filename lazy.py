@@ -0,0 +1,43 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+# Native Ceph bindings imported on first use, so file and diff tooling works without them
+import importlib
+import sys
+from types import ModuleType
+
+
+class LazyModule(ModuleType):
+    """
+    Stand-in for a module which is imported on first attribute access.
+    `except (rbd.Error, ...)` clauses resolve the attribute only when an exception is being matched.
+
+    >>> rbd = LazyModule('rbd')
+    >>> rbd.RBD()  # librbd is loaded here
+    """
+
+    def __init__(self, name):
+        super(LazyModule, self).__init__(name)
+        self.__dict__['_module'] = None
+
+    def _load(self):
+        module = self.__dict__['_module']
+        if module is None:
+            module = self.__dict__['_module'] = importlib.import_module(self.__name__)
+        return module
+
+    def __getattr__(self, attr):
+        return getattr(self._load(), attr)
+
+    def __repr__(self):
+        state = 'loaded' if self.__dict__['_module'] is not None else 'not loaded'
+        return '<lazy module %r (%s)>' % (self.__name__, state)
+
+
+def is_loaded(name):
+    """Check if module :name was really imported"""
+    return sys.modules.get(name) is not None
+
+
+rbd = LazyModule('rbd')
+rados = LazyModule('rados')
+pyaio = LazyModule('pyaio')
@@ -0,0 +1,217 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+# Per-block digests of exports computed while streaming and parallel verification against them
+from __future__ import division
+import hashlib
+import os
+import struct
+from collections import namedtuple
+from threading import BoundedSemaphore, Lock
+
+from .queue import extents, is_zero
+
+MANIFEST_MAGIC = b'pyceph manifest v1\n'
+MANIFEST_SUFFIX = '.manifest'
+DEFAULT_ALGORITHM = 'sha256'
+DEFAULT_HASH_WORKERS = 4
+_HEADER = struct.Struct('<QQ16sHQ')  # image size, block size, algorithm, digest size, number of records
+_RECORD = struct.Struct('<QQ?')  # offset, length, zero range flag; followed by digest
+
+# Records are (offset, length, digest), digest is None for ranges of zeros
+Manifest = namedtuple('Manifest', ['size', 'bs', 'algorithm', 'records'])
+
+
+class BlockHasher(object):
+    """
+    Digests of exported blocks computed on a thread pool while the export goes on,
+    hashlib releases the GIL while hashing. Blocks waiting for a worker are bounded by :max_pending.
+
+    >>> hasher = BlockHasher(size, bs)
+    >>> hasher.add(offset, data)
+    >>> hasher.zero(offset, length)
+    >>> write_manifest(path, hasher.finish())
+    """
+
+    def __init__(self, size, bs, algorithm=DEFAULT_ALGORITHM, workers=DEFAULT_HASH_WORKERS, max_pending=None):
+        """
+        :param size: image size
+        :type size: int
+        :param bs: block size of the export
+        :type bs: int
+        :param algorithm: hashlib algorithm name
+        :type algorithm: str
+        :param workers: number of hashing threads
+        :type workers: int
+        :param max_pending: maximum number of blocks waiting to be hashed (twice the workers by default)
+        :type max_pending: int
+        """
+        hashlib.new(algorithm)
+        self.size = size
+        self.bs = bs
+        self.algorithm = algorithm
+        self.records = []
+        from multiprocessing.pool import ThreadPool
+        self._pool = ThreadPool(workers)
+        self._pending = BoundedSemaphore(max_pending or workers * 2)
+        self._error = None
+        self._lock = Lock()
+
+    def _hash(self, offset, data):
+        try:
+            digest = hashlib.new(self.algorithm, data).digest()
+            with self._lock:
+                self.records.append((offset, len(data), digest))
+        except Exception as e:
+            self._error = e
+        finally:
+            self._pending.release()
+
+    def add(self, offset, data):
+        """Hash block of data at :offset"""
+        if self._error is not None:
+            raise self._error
+        self._pending.acquire()
+        self._pool.apply_async(self._hash, (offset, data))
+
+    def zero(self, offset, length):
+        """Record range of zeros (hole) at :offset"""
+        with self._lock:
+            self.records.append((offset, length, None))
+
+    def close(self):
+        self._pool.close()
+        self._pool.join()
+
+    def finish(self, holes=False):
+        """
+        Wait for pending blocks
+        :param holes: ranges of the image neither added nor zeroed are holes of the result file
+        :type holes: bool
+        :rtype: Manifest
+        """
+        self.close()
+        if self._error is not None:
+            raise self._error
+        records = sorted(self.records)
+        if holes:
+            gaps = []
+            cur = 0
+            for offset, length, digest in records + [(self.size, 0, None)]:
+                if offset > cur:
+                    gaps.append((cur, offset - cur, None))
+                cur = max(cur, offset + length)
+            records = sorted(records + gaps)
+        return Manifest(self.size, self.bs, self.algorithm, _merge_zeros(records))
+
+
+def _merge_zeros(records):
+    merged = []
+    for record in records:
+        last = merged[-1] if merged else None
+        if record[2] is None and last and last[2] is None and last[0] + last[1] == record[0]:
+            merged[-1] = (last[0], last[1] + record[1], None)
+        else:
+            merged.append(record)
+    return merged
+
+
+def write_manifest(path, manifest):
+    """
+    Store manifest in binary form
+    :param path: path of manifest file
+    :type path: str
+    :param manifest: manifest to store
+    :type manifest: Manifest
+    """
+    digest_size = hashlib.new(manifest.algorithm).digest_size
+    empty = b'\0' * digest_size
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as fh:
+        fh.write(MANIFEST_MAGIC)
+        fh.write(_HEADER.pack(manifest.size, manifest.bs, manifest.algorithm.encode('ascii'), digest_size,
+                              len(manifest.records)))
+        for offset, length, digest in manifest.records:
+            fh.write(_RECORD.pack(offset, length, digest is None))
+            fh.write(empty if digest is None else digest)
+    os.rename(tmp_path, path)
+
+
+def read_manifest(path):
+    """
+    :param path: path of manifest file
+    :type path: str
+    :rtype: Manifest
+    """
+    with open(path, 'rb') as fh:
+        data = fh.read()
+    if not data.startswith(MANIFEST_MAGIC):
+        raise IOError('Missing manifest magic string')
+    size, bs, algorithm, digest_size, count = _HEADER.unpack_from(data, len(MANIFEST_MAGIC))
+    position = len(MANIFEST_MAGIC) + _HEADER.size
+    if len(data) != position + count * (_RECORD.size + digest_size):
+        raise IOError('Truncated manifest')
+    records = []
+    for _ in range(count):
+        offset, length, zero = _RECORD.unpack_from(data, position)
+        position += _RECORD.size
+        records.append((offset, length, None if zero else data[position:position + digest_size]))
+        position += digest_size
+    return Manifest(size, bs, algorithm.rstrip(b'\0').decode('ascii'), records)
+
+
+def _check(manifest, source, task):
+    offset, length, digest = task
+    data = source.read(offset, length)
+    if digest is None:
+        ok = len(data) == length and is_zero(data)
+    else:
+        ok = len(data) == length and hashlib.new(manifest.algorithm, data).digest() == digest
+    return None if ok else (offset, length)
+
+
+def verify(manifest, source, workers=DEFAULT_HASH_WORKERS):
+    """
+    Compare file or image against manifest with parallel readers
+    :param manifest: manifest or path of manifest file
+    :type manifest: Manifest or str
+    :param source: path of local raw or compressed file or object with read(offset, length),
+        e.g. rbd.Image or diff_index.DiffReader
+    :type source: str or rbd.Image
+    :param workers: number of concurrent readers
+    :type workers: int
+    :return: sorted (offset, length) ranges not matching the manifest, adjacent ranges merged
+    :rtype: list
+    """
+    if not isinstance(manifest, Manifest):
+        manifest = read_manifest(manifest)
+    own_source = not hasattr(source, 'read')
+    if own_source:
+        from .compress import open_image
+        source = open_image(source)
+
+    def tasks():
+        for offset, length, digest in manifest.records:
+            if digest is None:
+                # Zero ranges can be huge, they are checked block by block
+                for block in extents(offset + length, manifest.bs, offset):
+                    yield block[0], block[1], None
+            else:
+                yield offset, length, digest
+
+    from multiprocessing.pool import ThreadPool
+    pool = ThreadPool(workers)
+    try:
+        mismatched = sorted(r for r in pool.imap_unordered(lambda task: _check(manifest, source, task), tasks(),
+                                                           chunksize=16) if r)
+    finally:
+        pool.close()
+        pool.join()
+        if own_source:
+            source.close()
+    merged = []
+    for offset, length in mismatched:
+        if merged and merged[-1][0] + merged[-1][1] == offset:
+            merged[-1] = (merged[-1][0], merged[-1][1] + length)
+        else:
+            merged.append((offset, length))
+    return merged
@@ -0,0 +1,265 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+# Counters, gauges and histograms of the export, import and diff paths
+from __future__ import division
+import os
+from functools import wraps
+from threading import Lock
+from time import time
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Registry(object):
+    """
+    Set of metrics. Updates are dropped while the registry is disabled,
+    every update of enabled registry is also passed to the hooks.
+
+    >>> registry.enable()
+    >>> registry.add_hook(lambda metric, labels, value: statsd.send(metric.name, value))
+    >>> print(registry.expose())
+    """
+
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.metrics = []
+        self.hooks = []
+
+    def enable(self):
+        self.enabled = True
+
+    def disable(self):
+        self.enabled = False
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def add_hook(self, hook):
+        """
+        :param hook: called with (metric, label values, value) on every update
+        :type hook: callable
+        """
+        self.hooks.append(hook)
+
+    def remove_hook(self, hook):
+        self.hooks.remove(hook)
+
+    def reset(self):
+        for metric in self.metrics:
+            metric.reset()
+
+    def expose(self):
+        """
+        Metrics in Prometheus text exposition format
+        :rtype: str
+        """
+        lines = []
+        for metric in self.metrics:
+            lines.append('# HELP %s %s' % (metric.name, metric.help))
+            lines.append('# TYPE %s %s' % (metric.name, metric.kind))
+            for name, labels, value in metric.samples():
+                lines.append('%s%s %s' % (name, _format_labels(labels), _format_value(value)))
+        return '\n'.join(lines) + '\n'
+
+    def write_textfile(self, path):
+        """Atomically write metrics to :path, e.g. for the textfile collector of node_exporter"""
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w') as out:
+            out.write(self.expose())
+        os.rename(tmp_path, path)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (name, _escape(value)) for name, value in labels)
+
+
+def _format_value(value):
+    if not isinstance(value, float):
+        return '%d' % value
+    if value == float('inf'):
+        return '+Inf'
+    if value.is_integer():
+        return '%d' % value
+    return repr(value)
+
+
+class Metric(object):
+    kind = None
+
+    def __init__(self, name, help, labels=(), registry=None):
+        """
+        :param name: metric name
+        :type name: str
+        :param help: description of the metric
+        :type help: str
+        :param labels: names of labels, their values are passed to updates positionally
+        :type labels: tuple
+        :param registry: registry to add the metric to
+        :type registry: Registry
+        """
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.registry = registry if registry is not None else default_registry
+        self._values = {}
+        self._lock = Lock()
+        self.registry.register(self)
+
+    def _notify(self, labels, value):
+        for hook in self.registry.hooks:
+            hook(self, labels, value)
+
+    def reset(self):
+        with self._lock:
+            self._values.clear()
+
+    def get(self, *labels):
+        return self._values.get(labels, 0)
+
+    def samples(self):
+        with self._lock:
+            values = sorted(self._values.items())
+        for labels, value in values:
+            yield self.name, list(zip(self.labels, labels)), value
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, *labels):
+        if not self.registry.enabled:
+            return
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+        if self.registry.hooks:
+            self._notify(labels, amount)
+
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def set(self, value, *labels):
+        if not self.registry.enabled:
+            return
+        with self._lock:
+            self._values[labels] = value
+        if self.registry.hooks:
+            self._notify(labels, value)
+
+    def inc(self, amount=1, *labels):
+        if not self.registry.enabled:
+            return
+        with self._lock:
+            value = self._values[labels] = self._values.get(labels, 0) + amount
+        if self.registry.hooks:
+            self._notify(labels, value)
+
+    def dec(self, amount=1, *labels):
+        self.inc(-amount, *labels)
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS, registry=None):
+        """
+        :param buckets: upper bounds of buckets
+        :type buckets: tuple
+        """
+        super(Histogram, self).__init__(name, help, labels, registry)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, *labels):
+        if not self.registry.enabled:
+            return
+        with self._lock:
+            state = self._values.get(labels)
+            if state is None:
+                # per bucket counts, sum, count
+                state = self._values[labels] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state[0][i] += 1
+                    break
+            state[1] += value
+            state[2] += 1
+        if self.registry.hooks:
+            self._notify(labels, value)
+
+    def get(self, *labels):
+        """:return: (sum, count) of observed values"""
+        state = self._values.get(labels)
+        return (state[1], state[2]) if state else (0.0, 0)
+
+    def samples(self):
+        with self._lock:
+            values = sorted((labels, (list(state[0]), state[1], state[2])) for labels, state in self._values.items())
+        for labels, (counts, total, count) in values:
+            pairs = list(zip(self.labels, labels))
+            cumulative = 0
+            for bound, n in zip(self.buckets, counts):
+                cumulative += n
+                yield self.name + '_bucket', pairs + [('le', bound)], cumulative
+            yield self.name + '_bucket', pairs + [('le', '+Inf')], count
+            yield self.name + '_sum', pairs, total
+            yield self.name + '_count', pairs, count
+
+
+default_registry = Registry()
+
+BYTES = Counter('pyceph_bytes_total', "Bytes read from the cluster, written to the target and skipped as holes",
+                ('op',))
+OP_SECONDS = Histogram('pyceph_op_seconds', "Latency of image reads, writes and cluster opens", ('op',))
+WAIT_SECONDS = Counter('pyceph_wait_seconds_total',
+                       "Time spent waiting: on rate limiter, on reads, on the consumer, for in-flight slots",
+                       ('stage',))
+IN_FLIGHT = Gauge('pyceph_in_flight', "Image operations in progress", ('op',))
+CACHED_IMAGES = Gauge('pyceph_cached_images', "Open image handles kept by image caches")
+OPERATIONS = Counter('pyceph_operations_total', "Finished Ceph operations", ('operation', 'status'))
+OPERATION_SECONDS = Histogram('pyceph_operation_seconds', "Duration of Ceph operations", ('operation',),
+                              buckets=(0.1, 1.0, 10.0, 60.0, 300.0, 900.0, 3600.0, 4 * 3600.0, 12 * 3600.0))
+
+
+def enable():
+    default_registry.enable()
+
+
+def disable():
+    default_registry.disable()
+
+
+def expose():
+    return default_registry.expose()
+
+
+def tracked(operation):
+    """
+    Count calls of Ceph operation by returned status and observe their duration
+    :param operation: name of the operation
+    :type operation: str
+    """
+
+    def decorator(f):
+        @wraps(f)
+        def inner(*args, **kwargs):
+            if not default_registry.enabled:
+                return f(*args, **kwargs)
+            started = time()
+            status = 'error'
+            try:
+                result = f(*args, **kwargs)
+                status = 'failed' if result is False else 'ok'
+                return result
+            finally:
+                OPERATION_SECONDS.observe(time() - started, operation)
+                OPERATIONS.inc(1, operation, status)
+        return inner
+
+    return decorator
@@ -1,91 +1,552 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
-from threading import Thread
-from collections import deque
-# It's faster than straightforward implementation you may found in `Ceph:create_dump_native`
+# Pipelined export engine: concurrent image readers feeding an ordered stream of blocks
+from __future__ import division
+import os
+from functools import partial
+from threading import Thread, Condition
+from time import time
 
-cache_size = 6  # 32mb
-q = deque(maxlen=cache_size)
+from .fileio import pwrite, fallocate
+from .lazy import pyaio
+from .metrics import BYTES, OP_SECONDS, WAIT_SECONDS, IN_FLIGHT
+
+CEPH_OSD_OP_FLAG_FADVISE_SEQUENTIAL = 0x8
+CEPH_OSD_OP_FLAG_FADVISE_NOCACHE = 0x40
+FADVISE_FLAGS = CEPH_OSD_OP_FLAG_FADVISE_SEQUENTIAL | CEPH_OSD_OP_FLAG_FADVISE_NOCACHE
+
+DEFAULT_READERS = 4
+DEFAULT_MAX_MEMORY = 64 << 20  # 64mb of blocks in flight
+DEFAULT_IN_FLIGHT = 16
+DEFAULT_AIO_MEMORY = 64 << 20  # bytes of file writes in flight
+DEFAULT_AIO_SYNC_BYTES = 256 << 20  # bytes written between fdatasync calls
+DIRECT_ALIGNMENT = 4096
+
+
+def extents(total, bs, start=0):
+    """
+    Split image range [start, total) into blocks of at most :bs bytes.
+    Blocks boundaries are aligned to multiples of :bs, so with object sized :bs every block maps to one object.
+    :param total: image size
+    :type total: int
+    :param bs: block size
+    :type bs: int
+    :param start: first offset
+    :type start: int
+    :return: generator of (offset, length)
+    :rtype: generator
+    """
+    cur = start
+    while cur < total:
+        length = min(bs - cur % bs, total - cur)
+        yield cur, length
+        cur += length
+
+
+def diff_extents(image, total, from_snapshot=None, whole_object=False):
+    """
+    Extents of image changed since :from_snapshot (allocated extents if no snapshot given)
+    :param image: opened rbd image (or snapshot)
+    :type image: rbd.Image
+    :param total: image size
+    :type total: int
+    :param from_snapshot: name of the older snapshot
+    :type from_snapshot: str
+    :param whole_object: report whole objects, fast with object map when fast-diff is enabled
+    :type whole_object: bool
+    :return: list of [offset, length, exists] with adjacent extents merged
+    :rtype: list
+    """
+    changed = []
+
+    def iterate_cb(offset, length, exists):
+        exists = bool(exists)
+        if changed and changed[-1][0] + changed[-1][1] == offset and changed[-1][2] == exists:
+            changed[-1][1] += length
+        else:
+            changed.append([offset, length, exists])
+        return 0
+
+    image.diff_iterate(0, total, from_snapshot, iterate_cb, whole_object=whole_object)
+    return changed
+
+
+def allocated_regions(image, total, from_snapshot=None):
+    """
+    Regions of image with allocated data.
+    Uses object map when fast-diff is enabled, otherwise librbd lists objects of the image.
+    :param image: opened rbd image (or snapshot)
+    :type image: rbd.Image
+    :param total: image size
+    :type total: int
+    :param from_snapshot: only regions changed since this snapshot
+    :type from_snapshot: str
+    :return: list of (offset, length)
+    :rtype: list
+    """
+    from .ceph import RBDFeatures
+    whole_object = bool(image.features() & RBDFeatures.RBD_FEATURE_FAST_DIFF)
+    return [(offset, min(offset + length, total) - offset)
+            for offset, length, exists in diff_extents(image, total, from_snapshot, whole_object)
+            if exists and offset < total]
+
+
+def allocated_extents(image, total, bs, from_snapshot=None):
+    """
+    Extents of image with allocated data, split into blocks of at most :bs bytes.
+    :param image: opened rbd image (or snapshot)
+    :type image: rbd.Image
+    :param total: image size
+    :type total: int
+    :param bs: block size
+    :type bs: int
+    :param from_snapshot: only extents changed since this snapshot
+    :type from_snapshot: str
+    :return: list of (offset, length)
+    :rtype: list
+    """
+    result = []
+    for offset, length in allocated_regions(image, total, from_snapshot):
+        result.extend(extents(offset + length, bs, offset))
+    return result
+
+
+def block_alignment(image):
+    """
+    Smallest block size keeping reads aligned to objects: object size, or full stripe with fancy striping
+    :param image: opened rbd image (or snapshot)
+    :type image: rbd.Image
+    :rtype: int
+    """
+    stripe_count = image.stripe_count()
+    if stripe_count > 1:
+        return image.stripe_unit() * stripe_count
+    return 1 << image.stat()['order']
+
+
+def default_block_size(image):
+    """
+    Block size covering one object of every object in the object set
+    :param image: opened rbd image (or snapshot)
+    :type image: rbd.Image
+    :rtype: int
+    """
+    return (1 << image.stat()['order']) * image.stripe_count()
+
+
+_ZEROES = {}
+
+
+def is_zero(data):
+    """Check if block consists of zero bytes only"""
+    zero = _ZEROES.get(len(data))
+    if zero is None:
+        zero = _ZEROES.setdefault(len(data), b'\0' * len(data))
+    return data == zero
 
 
 class Reader(Thread):
-    def __init__(self, image):
+    def __init__(self, engine):
         super(Reader, self).__init__()
+        self.daemon = True
+        self.engine = engine
+
+    def run(self):
+        self.engine.read_loop()
+
+
+class ParallelReader(object):
+    """
+    Read extents of an image with several concurrent readers and yield them in image order.
+
+    Every reader reserves a buffer slot before taking the next extent, so no more than
+    :max_memory bytes are read ahead of the consumer. Slow consumer blocks the readers instead
+    of dropping data.
+
+    >>> for offset, data in ParallelReader(image, extents(size, bs), bs, readers=8):
+    ...     writer.write(offset, data)
+    """
+
+    def __init__(self, image, extents, bs, readers=DEFAULT_READERS, max_memory=DEFAULT_MAX_MEMORY,
+                 flags=FADVISE_FLAGS):
+        """
+        :param image: opened rbd image (or snapshot)
+        :type image: rbd.Image
+        :param extents: iterable of (offset, length) to read
+        :type extents: iterable
+        :param bs: maximum length of single extent
+        :type bs: int
+        :param readers: number of concurrent readers
+        :type readers: int
+        :param max_memory: maximum bytes of read but not yet consumed blocks
+        :type max_memory: int
+        :param flags: fadvise flags passed to image.read
+        :type flags: int
+        """
         self.image = image
+        self.flags = flags
+        self.readers = max(1, int(readers))
+        self.slots = max(1, int(max_memory // bs))
+        self._extents = enumerate(extents)
+        self._cond = Condition()
+        self._free = self.slots
+        self._results = {}
+        self._count = None
+        self._error = None
+        self._stopped = False
+        self.reads = 0
+        self.read_seconds = 0.0
 
-    def read(self):
-        global q
-        CEPH_OSD_OP_FLAG_FADVISE_SEQUENTIAL = 0x8
-        CEPH_OSD_OP_FLAG_FADVISE_NOCACHE = 0x40
-        fadvice_flags = CEPH_OSD_OP_FLAG_FADVISE_SEQUENTIAL | CEPH_OSD_OP_FLAG_FADVISE_NOCACHE
-        bs = 10 * 1024**2
-        total = self.image.stat()['size']
-        cur = 0
-        while cur < total:
+    def _take(self):
+        with self._cond:
+            if not self._free and not self._stopped:
+                started = time()
+                while not self._free and not self._stopped:
+                    self._cond.wait()
+                WAIT_SECONDS.inc(time() - started, 'consume')
+            if self._stopped:
+                return None
             try:
-                data = self.image.read(cur, bs, fadvice_flags)
-            except rbd.InvalidArgument:
-                bs = total % bs
-                data = self.image.read(cur, bs, fadvice_flags)
-            q.append(data)
-            cur += bs
-        q.append("DONE")
-        self.image.close()
-        return
+                item = next(self._extents)
+            except StopIteration:
+                self._stopped = True
+                self._cond.notify_all()
+                return None
+            self._free -= 1
+            self._count = item[0] + 1
+            return item
+
+    def read_loop(self):
+        while True:
+            item = self._take()
+            if item is None:
+                return
+            seq, (offset, length) = item
+            IN_FLIGHT.inc(1, 'read')
+            started = time()
+            try:
+                data = self.image.read(offset, length, self.flags)
+            except Exception as e:
+                with self._cond:
+                    if self._error is None:
+                        self._error = e
+                    self._stopped = True
+                    self._cond.notify_all()
+                return
+            finally:
+                IN_FLIGHT.dec(1, 'read')
+            elapsed = time() - started
+            OP_SECONDS.observe(elapsed, 'read')
+            BYTES.inc(len(data), 'read')
+            with self._cond:
+                self._results[seq] = (offset, data)
+                self.reads += 1
+                self.read_seconds += elapsed
+                self._cond.notify_all()
+
+    def close(self):
+        with self._cond:
+            self._stopped = True
+            self._results.clear()
+            self._cond.notify_all()
+
+    def __iter__(self):
+        threads = [Reader(self) for _ in range(self.readers)]
+        for t in threads:
+            t.start()
+        seq = 0
+        try:
+            while True:
+                with self._cond:
+                    started = None
+                    while seq not in self._results and self._error is None and \
+                            not (self._stopped and (self._count or 0) <= seq):
+                        started = started or time()
+                        self._cond.wait()
+                    if started:
+                        WAIT_SECONDS.inc(time() - started, 'read')
+                    if self._error is not None:
+                        raise self._error
+                    if seq not in self._results:
+                        break
+                    block = self._results.pop(seq)
+                    self._free += 1
+                    self._cond.notify_all()
+                yield block
+                seq += 1
+        finally:
+            self.close()
+            for t in threads:
+                t.join()
 
-    def run(self):
-        self.read()
 
+class Writer(object):
+    """
+    Positional writer of exported blocks, the file offset is never shared between writes
+    """
 
-class Writer(Thread):
     def __init__(self, fn):
-        super(Writer, self).__init__()
-        self.fd = open(fn, 'wb')
-        self.stopped = False
+        self.fd = os.open(fn, os.O_CREAT | os.O_WRONLY)
 
-    def run(self):
-        global q
-        i = 0
-        while True and not self.stopped:
-            data = None
-            try:
-                data = q.popleft()
-            except IndexError:
-                pass
+    def write(self, offset, data):
+        started = time()
+        pwrite(self.fd, data, offset)
+        OP_SECONDS.observe(time() - started, 'write')
+        BYTES.inc(len(data), 'written')
+
+    def truncate(self, size):
+        os.ftruncate(self.fd, size)
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
 
-            if data == "DONE":
-                break
 
-            if data and data != "DONE":
-                self.fd.write(data)
-            if i % 10 == 0:
-                self.fd.flush()
-            i += 1
+class AioWriter(object):
+    """
+    Positional writer of exported blocks on pyaio: at most :max_memory bytes of writes are in flight,
+    the first failed write is raised from the next write(), wait() or close() call.
+    Completed writes are fdatasync'ed every :sync_bytes, so dirty page cache stays bounded on huge exports.
+    With :direct the file is opened with O_DIRECT and blocks are copied into page aligned buffers,
+    which are reused; unaligned blocks are written through the page cache after in-flight writes finish.
+    Only the block ending at the size set by allocate() or truncate() may have an unaligned length.
 
-        print "closing..."
-        self.fd.close()
+    >>> with AioWriter(fn, direct=True) as writer:
+    ...     writer.allocate(size)
+    ...     writer.write(0, data)
+    ...     writer.wait()
+    """
 
-    def stop(self):
-        self.stopped = True
+    def __init__(self, fn, max_memory=DEFAULT_AIO_MEMORY, sync_bytes=DEFAULT_AIO_SYNC_BYTES, direct=False):
+        """
+        :param fn: path of result file
+        :type fn: str
+        :param max_memory: maximum bytes of writes in flight
+        :type max_memory: int
+        :param sync_bytes: fdatasync after this many written bytes, 0 disables periodic syncs
+        :type sync_bytes: int
+        :param direct: bypass page cache with O_DIRECT
+        :type direct: bool
+        """
+        # ImportError before the file is touched if pyaio is not installed
+        self._aio_write = pyaio.aio_write
+        self.fd = os.open(fn, os.O_CREAT | os.O_WRONLY)
+        self._direct_fd = os.open(fn, os.O_WRONLY | os.O_DIRECT) if direct else None
+        self.max_memory = max(1, int(max_memory))
+        self.sync_bytes = sync_bytes
+        self.in_flight = 0
+        self.size = None
+        self._end = 0
+        self._unsynced = 0
+        self._buffers = []
+        self._cond = Condition()
+        self._error = None
 
+    def _check(self):
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
 
-from .ceph import Ceph
+    def _buffer(self, data):
+        """Page aligned copy of :data padded to DIRECT_ALIGNMENT"""
+        import mmap
 
-c = Ceph()
-import rbd
-image = rbd.Image(c.ioctx, "vm-120-disk-1", "nginxsel-vm-120-disk-1-20160525-235912")
-#image = rbd.Image(c.ioctx, "test_diff2", "vm1-test_diff2-20160525-165714")
+        length = -(-len(data) // DIRECT_ALIGNMENT) * DIRECT_ALIGNMENT
+        with self._cond:
+            for i, buf in enumerate(self._buffers):
+                if len(buf) == length:
+                    del self._buffers[i]
+                    break
+            else:
+                buf = mmap.mmap(-1, length)
+        buf[:len(data)] = data
+        if length > len(data):
+            buf[len(data):] = b'\0' * (length - len(data))
+        return buf
 
-r = Reader(image)
-w = Writer("/home/l/diff")
+    def _complete(self, started, length, buf, rt, err):
+        OP_SECONDS.observe(time() - started, 'write')
+        IN_FLIGHT.dec(1, 'aio_write')
+        with self._cond:
+            self.in_flight -= len(buf)
+            if err or rt < 0:
+                if self._error is None:
+                    err = err or -rt
+                    self._error = IOError(err, os.strerror(err))
+            elif rt < len(buf):
+                if self._error is None:
+                    self._error = IOError('Short write: %d of %d bytes' % (rt, len(buf)))
+            else:
+                BYTES.inc(length, 'written')
+                self._unsynced += length
+            if not isinstance(buf, bytes) and len(self._buffers) * len(buf) < self.max_memory:
+                self._buffers.append(buf)
+            self._cond.notify_all()
 
-w.daemon = True
-r.daemon = True
+    def _reserve(self, length):
+        with self._cond:
+            if self.in_flight and self.in_flight + length > self.max_memory and self._error is None:
+                started = time()
+                while self.in_flight and self.in_flight + length > self.max_memory and self._error is None:
+                    self._cond.wait()
+                WAIT_SECONDS.inc(time() - started, 'in_flight')
+            self._check()
+            self.in_flight += length
+
+    def write(self, offset, data):
+        fd = self.fd
+        if self._direct_fd is not None:
+            if offset % DIRECT_ALIGNMENT or (len(data) % DIRECT_ALIGNMENT and offset + len(data) != self.size):
+                # O_DIRECT can't write it, or its padding would overwrite data past the block
+                # unless it is the tail of the file; ordered after everything in flight
+                self.wait()
+                started = time()
+                pwrite(self.fd, data, offset)
+                OP_SECONDS.observe(time() - started, 'write')
+                BYTES.inc(len(data), 'written')
+                self._end = max(self._end, offset + len(data))
+                return
+            fd = self._direct_fd
+            buf = self._buffer(data)
+        else:
+            buf = data if isinstance(data, bytes) else bytes(data)
+        self._reserve(len(buf))
+        self._end = max(self._end, offset + len(data))
+        IN_FLIGHT.inc(1, 'aio_write')
+        try:
+            self._aio_write(fd, buf, offset, partial(self._complete, time(), len(data), buf))
+        except Exception:
+            IN_FLIGHT.dec(1, 'aio_write')
+            with self._cond:
+                self.in_flight -= len(buf)
+            raise
+        if self.sync_bytes and self._unsynced >= self.sync_bytes:
+            self._unsynced = 0
+            started = time()
+            os.fdatasync(self.fd)
+            OP_SECONDS.observe(time() - started, 'sync')
+
+    def wait(self):
+        """Wait for all in-flight writes"""
+        with self._cond:
+            while self.in_flight:
+                self._cond.wait()
+            self._check()
+
+    def sync(self):
+        """Wait for in-flight writes and flush the file to disk"""
+        self.wait()
+        os.fdatasync(self.fd)
+        self._unsynced = 0
+
+    def allocate(self, size):
+        """Preallocate :size bytes, file is exactly :size bytes long afterwards"""
+        self.wait()
+        fallocate(self.fd, 0, size)
+        # fallocate only grows the file, a tail of an older larger one is cut here
+        self.truncate(size)
+
+    def truncate(self, size):
+        self.wait()
+        os.ftruncate(self.fd, size)
+        self.size = size
+        self._end = min(self._end, size)
+
+    def close(self):
+        if self.fd is None:
+            return
+        try:
+            self.wait()
+            if self._direct_fd is not None:
+                # Drop padding of the last block
+                os.ftruncate(self.fd, max(self._end, self.size or 0))
+            os.fdatasync(self.fd)
+        finally:
+            del self._buffers[:]
+            if self._direct_fd is not None:
+                os.close(self._direct_fd)
+                self._direct_fd = None
+            os.close(self.fd)
+            self.fd = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        try:
+            self.close()
+        except (IOError, OSError):
+            if exc_type is None:
+                raise
+
+
+class ImageWriter(object):
+    """
+    Asynchronous writer to rbd image with bounded number of in-flight aio_write operations.
+    First failed write is raised from the next write() or wait() call
+    """
+
+    def __init__(self, image, max_in_flight=DEFAULT_IN_FLIGHT, flags=0):
+        """
+        :param image: opened rbd image
+        :type image: rbd.Image
+        :param max_in_flight: maximum number of concurrent writes
+        :type max_in_flight: int
+        :param flags: fadvise flags passed to image.aio_write
+        :type flags: int
+        """
+        self.image = image
+        self.flags = flags
+        self.max_in_flight = max(1, int(max_in_flight))
+        self.in_flight = 0
+        self._cond = Condition()
+        self._error = None
 
-w.start()
-r.start()
+    def _check(self):
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
 
-w.join()
-r.join()
+    def _complete(self, started, length, completion):
+        rv = completion.get_return_value()
+        OP_SECONDS.observe(time() - started, 'aio_write')
+        IN_FLIGHT.dec(1, 'aio_write')
+        if rv >= 0:
+            BYTES.inc(length, 'written')
+        with self._cond:
+            self.in_flight -= 1
+            if rv < 0 and self._error is None:
+                self._error = IOError(-rv, os.strerror(-rv))
+            self._cond.notify_all()
 
+    def write(self, offset, data):
+        with self._cond:
+            if self.in_flight >= self.max_in_flight and self._error is None:
+                started = time()
+                while self.in_flight >= self.max_in_flight and self._error is None:
+                    self._cond.wait()
+                WAIT_SECONDS.inc(time() - started, 'in_flight')
+            self._check()
+            self.in_flight += 1
+        IN_FLIGHT.inc(1, 'aio_write')
+        try:
+            self.image.aio_write(data, offset, partial(self._complete, time(), len(data)), self.flags)
+        except Exception:
+            IN_FLIGHT.dec(1, 'aio_write')
+            with self._cond:
+                self.in_flight -= 1
+            raise
 
+    def wait(self):
+        """Wait for all in-flight writes"""
+        with self._cond:
+            while self.in_flight:
+                self._cond.wait()
+            self._check()
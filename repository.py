@@ -0,0 +1,482 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+# Deduplicating backup repository: snapshots are lists of content addressed chunks stored once in pack files
+from __future__ import division
+import hashlib
+import os
+import struct
+from threading import BoundedSemaphore, Lock
+
+from .fileio import pread, pwrite
+from .manifest import DEFAULT_HASH_WORKERS
+from .metrics import BYTES
+from .queue import Writer, extents, is_zero
+
+REPOSITORY_MAGIC = b'pyceph repository v1\n'
+SNAPSHOT_MAGIC = b'pyceph snapshot v1\n'
+DEFAULT_CHUNK_SIZE = 1 << 20
+DEFAULT_PACK_SIZE = 1 << 30
+MAX_RESTORE_READ = 16 << 20
+_DIGEST_SIZE = hashlib.sha256().digest_size
+_ZERO_CHUNK = b'\0' * _DIGEST_SIZE  # digest stored for chunks of zeros, they are never packed
+_CONFIG = struct.Struct('<I')  # chunk size
+_INDEX_RECORD = struct.Struct('<%dsIQI' % _DIGEST_SIZE)  # digest, pack number, position in pack, length
+_SNAPSHOT_HEADER = struct.Struct('<QI')  # image size, chunk size
+
+
+def _digest(data):
+    return hashlib.sha256(data).digest()
+
+
+class Repository(object):
+    """
+    Directory with fixed size chunks of image snapshots addressed by their sha256.
+
+    Every unique chunk is appended once to a pack file (packs/NNNNNNNN.pack) and located through
+    the append-only index, a snapshot (snapshots/<name>) is the list of digests of its chunks.
+    Chunks are aligned to image offsets, so unchanged blocks of similar images and of successive
+    snapshots of one image share chunks.
+
+    >>> repository = Repository.init('/backup')
+    >>> writer = repository.writer('vm1@daily', size)
+    >>> writer.write(offset, data)
+    >>> writer.commit()
+    >>> repository.restore('vm1@daily', '/tmp/vm1.raw')
+    """
+
+    def __init__(self, path, pack_size=DEFAULT_PACK_SIZE):
+        """
+        :param path: repository directory created by Repository.init
+        :type path: str
+        :param pack_size: start new pack file after this many bytes
+        :type pack_size: int
+        """
+        self.path = path
+        self.pack_size = pack_size
+        with open(os.path.join(path, 'config'), 'rb') as fh:
+            data = fh.read()
+        if not data.startswith(REPOSITORY_MAGIC):
+            raise IOError('Missing repository magic string')
+        self.chunk_size = _CONFIG.unpack_from(data, len(REPOSITORY_MAGIC))[0]
+        self.index = {}
+        self._lock = Lock()
+        self._readers = {}
+        self._pack = None  # number, descriptor and size of pack being appended
+        self._dirty_packs = set()
+        self._unsynced = []  # index records of chunks in packs not synced yet
+        self._load_index()
+        self._index_fh = open(os.path.join(path, 'index'), 'ab')
+
+    @classmethod
+    def init(cls, path, chunk_size=DEFAULT_CHUNK_SIZE, **kwargs):
+        """
+        Create empty repository
+        :param path: repository directory, created if missing
+        :type path: str
+        :param chunk_size: size of chunks, fixed for the whole repository
+        :type chunk_size: int
+        :rtype: Repository
+        """
+        for directory in (path, os.path.join(path, 'packs'), os.path.join(path, 'snapshots')):
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+        config = os.path.join(path, 'config')
+        if os.path.exists(config):
+            raise IOError('Repository %s already exists' % path)
+        with open(config, 'wb') as fh:
+            fh.write(REPOSITORY_MAGIC)
+            fh.write(_CONFIG.pack(chunk_size))
+        return cls(path, **kwargs)
+
+    def _load_index(self):
+        try:
+            with open(os.path.join(self.path, 'index'), 'rb') as fh:
+                data = fh.read()
+        except IOError:
+            return
+        # A torn last record of interrupted ingest is ignored, its snapshot was not committed
+        for position in range(0, len(data) - _INDEX_RECORD.size + 1, _INDEX_RECORD.size):
+            digest, pack, offset, length = _INDEX_RECORD.unpack_from(data, position)
+            self.index[digest] = (pack, offset, length)
+
+    def _pack_path(self, number):
+        return os.path.join(self.path, 'packs', '%08d.pack' % number)
+
+    def _open_pack(self):
+        packs = [int(fn.split('.')[0]) for fn in os.listdir(os.path.join(self.path, 'packs')) if fn.endswith('.pack')]
+        number = max(packs) + 1 if packs else 0
+        fd = os.open(self._pack_path(number), os.O_CREAT | os.O_WRONLY | os.O_EXCL)
+        self._pack = [number, fd, 0]
+
+    def store(self, digest, data):
+        """
+        Add chunk unless it is stored already, safe to call from many threads
+        :param digest: sha256 of :data
+        :type digest: bytes
+        :param data: chunk data
+        :type data: bytes
+        :return: True if the chunk was new
+        :rtype: bool
+        """
+        with self._lock:
+            if digest in self.index:
+                BYTES.inc(len(data), 'deduplicated')
+                return False
+            if self._pack is None or self._pack[2] >= self.pack_size:
+                self._close_pack()
+                self._open_pack()
+            number, fd, position = self._pack
+            pwrite(fd, data, position)
+            self._pack[2] += len(data)
+            self._dirty_packs.add(number)
+            self._unsynced.append(_INDEX_RECORD.pack(digest, number, position, len(data)))
+            self.index[digest] = (number, position, len(data))
+        BYTES.inc(len(data), 'stored')
+        return True
+
+    def _close_pack(self):
+        if self._pack is not None:
+            os.fdatasync(self._pack[1])
+            os.close(self._pack[1])
+            self._dirty_packs.discard(self._pack[0])
+            self._pack = None
+
+    def flush(self):
+        """Make stored chunks durable: packs are synced before the index referencing them"""
+        with self._lock:
+            if self._pack is not None and self._pack[0] in self._dirty_packs:
+                os.fdatasync(self._pack[1])
+            self._dirty_packs.clear()
+            self._index_fh.write(b''.join(self._unsynced))
+            del self._unsynced[:]
+            self._index_fh.flush()
+            os.fsync(self._index_fh.fileno())
+
+    def close(self):
+        self.flush()
+        with self._lock:
+            self._close_pack()
+            self._index_fh.close()
+            for fd in self._readers.values():
+                os.close(fd)
+            self._readers.clear()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def _reader(self, number):
+        fd = self._readers.get(number)
+        if fd is None:
+            fd = self._readers.setdefault(number, os.open(self._pack_path(number), os.O_RDONLY))
+        return fd
+
+    def read_chunk(self, digest):
+        """
+        :param digest: digest of stored chunk
+        :type digest: bytes
+        :rtype: bytes
+        """
+        number, position, length = self.index[digest]
+        return pread(self._reader(number), length, position)
+
+    def snapshots(self):
+        """:return: sorted names of committed snapshots"""
+        return sorted(fn for fn in os.listdir(os.path.join(self.path, 'snapshots')) if not fn.endswith('.tmp'))
+
+    def chunks(self, name):
+        """
+        :param name: snapshot name
+        :type name: str
+        :return: image size and list of digests of its chunks, None for chunks of zeros
+        :rtype: tuple
+        """
+        with open(os.path.join(self.path, 'snapshots', name), 'rb') as fh:
+            data = fh.read()
+        if not data.startswith(SNAPSHOT_MAGIC):
+            raise IOError('Missing snapshot magic string')
+        size, chunk_size = _SNAPSHOT_HEADER.unpack_from(data, len(SNAPSHOT_MAGIC))
+        if chunk_size != self.chunk_size:
+            raise IOError('Snapshot %s has chunk size %d, repository %d' % (name, chunk_size, self.chunk_size))
+        position = len(SNAPSHOT_MAGIC) + _SNAPSHOT_HEADER.size
+        count = (size + chunk_size - 1) // chunk_size
+        if len(data) != position + count * _DIGEST_SIZE:
+            raise IOError('Truncated snapshot %s' % name)
+        digests = []
+        for i in range(count):
+            digest = data[position + i * _DIGEST_SIZE:position + (i + 1) * _DIGEST_SIZE]
+            digests.append(None if digest == _ZERO_CHUNK else digest)
+        return size, digests
+
+    def _write_snapshot(self, name, size, digests):
+        path = os.path.join(self.path, 'snapshots', name)
+        with open(path + '.tmp', 'wb') as fh:
+            fh.write(SNAPSHOT_MAGIC)
+            fh.write(_SNAPSHOT_HEADER.pack(size, self.chunk_size))
+            fh.write(b''.join(digest or _ZERO_CHUNK for digest in digests))
+            fh.flush()
+            os.fsync(fh.fileno())
+        os.rename(path + '.tmp', path)
+
+    def remove_snapshot(self, name):
+        """Forget snapshot, its chunks stay in the packs"""
+        os.unlink(os.path.join(self.path, 'snapshots', name))
+
+    def writer(self, name, size, parent=None, workers=DEFAULT_HASH_WORKERS, max_pending=None):
+        """
+        :param name: name of new snapshot
+        :type name: str
+        :param size: image size
+        :type size: int
+        :param parent: snapshot providing chunks which are not written, e.g. the older snapshot of a diff
+        :type parent: str
+        :param workers: number of hashing threads
+        :type workers: int
+        :param max_pending: maximum number of chunks waiting to be hashed
+        :type max_pending: int
+        :rtype: SnapshotWriter
+        """
+        return SnapshotWriter(self, name, size, parent, workers, max_pending)
+
+    def ingest_file(self, fn, name, workers=DEFAULT_HASH_WORKERS, cb=None):
+        """
+        Add raw or compressed image file (e.g. result of create_dump_native), holes of the file are not read
+        :param fn: path of image file
+        :type fn: str
+        :param name: name of new snapshot
+        :type name: str
+        :param workers: number of hashing threads
+        :type workers: int
+        :param cb: progress callback, called with (current, total) bytes
+        :type cb: callable
+        :rtype: SnapshotWriter
+        """
+        from .compress import open_image
+
+        with open_image(fn) as source:
+            writer = self.writer(name, source.size, workers=workers)
+            try:
+                for offset, length in source.data_extents():
+                    for block in extents(offset + length, self.chunk_size, offset):
+                        writer.write(block[0], source.read(*block))
+                        if cb:
+                            cb(block[0] + block[1], source.size)
+                writer.commit()
+            finally:
+                writer.close()
+        return writer
+
+    def ingest_diff(self, ifh, name, parent=None, workers=DEFAULT_HASH_WORKERS):
+        """
+        Add snapshot from `rbd export-diff` stream applied on top of :parent
+        :param ifh: input file-like object (.diff), read sequentially
+        :type ifh: file
+        :param name: name of new snapshot
+        :type name: str
+        :param parent: snapshot the diff was taken from, full diff if not specified
+        :type parent: str
+        :param workers: number of hashing threads
+        :type workers: int
+        :rtype: SnapshotWriter
+        """
+        from .export_diff import DIFF_MAGIC, _NAME_RECORD, _SIZE_RECORD, _EXTENT_RECORD, _readinto
+
+        if ifh.read(len(DIFF_MAGIC)) != DIFF_MAGIC:
+            raise IOError('Missing diff magic string')
+        writer = None
+        header = bytearray(_EXTENT_RECORD.size)
+        header_view = memoryview(header)
+        try:
+            while True:
+                _readinto(ifh, header_view[:1])
+                type = bytes(header[:1])
+                if type in (b'f', b't'):
+                    _readinto(ifh, header_view[1:_NAME_RECORD.size])
+                    ifh.read(_NAME_RECORD.unpack_from(header)[1])
+                elif type == b's':
+                    _readinto(ifh, header_view[1:_SIZE_RECORD.size])
+                    writer = self.writer(name, _SIZE_RECORD.unpack_from(header)[1], parent, workers)
+                elif type in (b'w', b'z'):
+                    if writer is None:
+                        raise IOError('Diff record before image size')
+                    _readinto(ifh, header_view[1:])
+                    offset, length = _EXTENT_RECORD.unpack_from(header)[1:]
+                    if type == b'z':
+                        writer.zero(offset, length)
+                        continue
+                    # Large records are read chunk by chunk
+                    for block in extents(offset + length, self.chunk_size, offset):
+                        data = bytearray(block[1])
+                        _readinto(ifh, memoryview(data))
+                        writer.write(block[0], data)
+                elif type == b'e':
+                    break
+                else:
+                    raise ValueError('Unknown record type: %s' % type)
+            if writer is None:
+                raise IOError('Diff without image size')
+            writer.commit()
+        finally:
+            if writer:
+                writer.close()
+        return writer
+
+    def restore(self, name, target):
+        """
+        Write snapshot to file or image writer. Every unique chunk is read once, in the order of
+        the packs, with adjacent chunks coalesced into large reads; chunks of zeros are skipped
+        :param name: snapshot name
+        :type name: str
+        :param target: path of result file (holes are left for zero chunks) or object with write(offset, data)
+            writing to an empty target, e.g. queue.ImageWriter of new image
+        :type target: str or queue.ImageWriter
+        :return: image size
+        :rtype: int
+        """
+        size, digests = self.chunks(name)
+        offsets = {}
+        for i, digest in enumerate(digests):
+            if digest is not None:
+                offsets.setdefault(digest, []).append(i * self.chunk_size)
+        ordered = sorted(offsets, key=self.index.__getitem__)
+        own_target = not hasattr(target, 'write')
+        if own_target:
+            target = Writer(target)
+            target.truncate(0)
+            target.truncate(size)
+        try:
+            i = 0
+            while i < len(ordered):
+                number, start, length = self.index[ordered[i]]
+                j = i + 1
+                end = start + length
+                while j < len(ordered) and end - start < MAX_RESTORE_READ:
+                    next_number, position, next_length = self.index[ordered[j]]
+                    if next_number != number or position != end:
+                        break
+                    end += next_length
+                    j += 1
+                data = memoryview(pread(self._reader(number), end - start, start))
+                for digest in ordered[i:j]:
+                    position, length = self.index[digest][1:]
+                    chunk = data[position - start:position - start + length].tobytes()
+                    for offset in offsets[digest]:
+                        target.write(offset, chunk)
+                i = j
+            if not own_target and hasattr(target, 'wait'):
+                target.wait()
+        finally:
+            if own_target:
+                target.close()
+        return size
+
+
+class SnapshotWriter(object):
+    """
+    Streaming ingest of one snapshot. Blocks written at any offsets are cut into chunks, complete chunks
+    are hashed and stored on a thread pool; partially written chunks are completed from the parent
+    snapshot on commit. Chunks never written keep the parent's content (zeros without parent).
+    Writes must not overlap.
+    """
+
+    def __init__(self, repository, name, size, parent=None, workers=DEFAULT_HASH_WORKERS, max_pending=None):
+        self.repository = repository
+        self.name = name
+        self.size = size
+        self.chunk_size = cs = repository.chunk_size
+        count = (size + cs - 1) // cs
+        parent_size, self._parent = repository.chunks(parent) if parent else (0, [])
+        self.chunks = (self._parent + [None] * count)[:count]
+        self._partial = {}  # chunk number -> [buffer, written (start, length) ranges]
+        if parent:
+            boundary = min(size, parent_size)
+            if size != parent_size and boundary % cs:
+                # The last common chunk changes its length with the resize
+                self._partial[boundary // cs] = [bytearray(self._length(boundary // cs)), []]
+        self.written = 0
+        self.stored = 0
+        from multiprocessing.pool import ThreadPool
+        self._pool = ThreadPool(workers)
+        self._pending = BoundedSemaphore(max_pending or workers * 2)
+        self._error = None
+        self._lock = Lock()
+
+    def _length(self, number):
+        return min(self.chunk_size, self.size - number * self.chunk_size)
+
+    def _store(self, number, data):
+        try:
+            digest = _digest(data)
+            stored = self.repository.store(digest, data)
+            with self._lock:
+                self.chunks[number] = digest
+                if stored:
+                    self.stored += len(data)
+        except Exception as e:
+            self._error = e
+        finally:
+            self._pending.release()
+
+    def _submit(self, number, data):
+        if self._error is not None:
+            raise self._error
+        self.written += len(data)
+        if is_zero(data):
+            self.chunks[number] = None
+            return
+        self._pending.acquire()
+        self._pool.apply_async(self._store, (number, data))
+
+    def _cover(self, number, start, piece):
+        entry = self._partial.get(number)
+        if entry is None:
+            entry = self._partial[number] = [bytearray(self._length(number)), []]
+        entry[0][start:start + len(piece)] = piece
+        entry[1].append((start, len(piece)))
+        if sum(length for start, length in entry[1]) >= len(entry[0]):
+            del self._partial[number]
+            self._submit(number, bytes(entry[0]))
+
+    def write(self, offset, data):
+        """Add block of image data at :offset"""
+        view = memoryview(data)
+        position = 0
+        for start, length in extents(offset + len(data), self.chunk_size, offset):
+            number = start // self.chunk_size
+            piece = view[position:position + length]
+            position += length
+            if length == self._length(number) and number not in self._partial:
+                self._submit(number, piece.tobytes())
+            else:
+                self._cover(number, start % self.chunk_size, piece)
+
+    def zero(self, offset, length):
+        """Mark range of image as zeros"""
+        for start, length in extents(offset + length, self.chunk_size, offset):
+            number = start // self.chunk_size
+            if length == self._length(number) and number not in self._partial:
+                self.chunks[number] = None
+            else:
+                self._cover(number, start % self.chunk_size, b'\0' * length)
+
+    def commit(self):
+        """Complete partial chunks, wait for pending ones and store the snapshot"""
+        for number in sorted(self._partial):
+            buf, written = self._partial.pop(number)
+            parent = self._parent[number] if number < len(self._parent) else None
+            base = bytearray(self.repository.read_chunk(parent)) if parent else bytearray()
+            base = base[:len(buf)] + bytearray(max(0, len(buf) - len(base)))
+            for start, length in written:
+                base[start:start + length] = buf[start:start + length]
+            self._submit(number, bytes(base))
+        self.close()
+        if self._error is not None:
+            raise self._error
+        self.repository.flush()
+        self.repository._write_snapshot(self.name, self.size, self.chunks)
+
+    def close(self):
+        self._pool.close()
+        self._pool.join()
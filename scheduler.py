@@ -0,0 +1,263 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+# Backup pipelines of many images under shared concurrency and bandwidth limits
+from __future__ import division
+import json
+import os
+from collections import namedtuple
+from threading import Condition, Thread
+from time import time, strftime, gmtime
+
+from .ceph import Ceph, logger, make_bucket
+
+DEFAULT_WORKERS = 4
+DEFAULT_INSPECT_WORKERS = 16
+DEFAULT_SNAPSHOT_PREFIX = 'backup-'
+HOST_SAMPLE_OBJECTS = 16
+
+# :mode is 'full' (always dump whole image) or 'diff' (diff since the newest backup snapshot, full if none),
+# :keep is the number of backup snapshots left in cluster, :deadline is unix time the backup is due
+Policy = namedtuple('Policy', ['output', 'mode', 'keep', 'deadline', 'sparse', 'compress', 'speed_limit', 'prefix'])
+Policy.__new__.__defaults__ = ('.', 'diff', 2, None, True, None, None, DEFAULT_SNAPSHOT_PREFIX)
+Job = namedtuple('Job', ['pool', 'image', 'policy'])
+JobResult = namedtuple('JobResult', ['pool', 'image', 'snapshot', 'path', 'ok', 'error', 'seconds'])
+
+
+def _noop_progress(cur, total):
+    pass
+
+
+def host_shares(ceph, image_name, samples=HOST_SAMPLE_OBJECTS, osd_hosts=None):
+    """
+    Share of image objects whose primary OSD lives on each host, from `osd map` of sampled data objects
+    :param ceph: Ceph object of the image pool
+    :type ceph: Ceph
+    :param image_name: name of image in cluster
+    :type image_name: str
+    :param samples: number of objects to locate
+    :type samples: int
+    :param osd_hosts: cache of OSD id -> host name, filled by this call
+    :type osd_hosts: dict
+    :return: host name -> share of objects, empty if placement can not be queried
+    :rtype: dict
+    """
+    osd_hosts = {} if osd_hosts is None else osd_hosts
+
+    def command(**kwargs):
+        kwargs['format'] = 'json'
+        ret, out, errs = ceph.cluster.mon_command(json.dumps(kwargs), b'')
+        if ret:
+            raise IOError(-ret, errs)
+        return json.loads(out.decode('utf-8') if isinstance(out, bytes) else out)
+
+    try:
+        with ceph.images.open(image_name) as image:
+            stat = image.stat()
+        objects = max(1, -(-stat['size'] // stat['obj_size']))
+        step = max(1, objects // samples)
+        shares = {}
+        names = ['%s.%016x' % (stat['block_name_prefix'], number) for number in range(0, objects, step)[:samples]]
+        for name in names:
+            osd = command(prefix='osd map', pool=ceph.pool, object=name)['acting_primary']
+            if osd not in osd_hosts:
+                found = command(prefix='osd find', id=osd)
+                osd_hosts[osd] = found.get('crush_location', {}).get('host') or found.get('host')
+            shares[osd_hosts[osd]] = shares.get(osd_hosts[osd], 0) + 1 / len(names)
+        return shares
+    except Exception:
+        logger.debug("Handled exception", exc_info=True)
+        logger.warn("Placement of %s/%s is unknown, it is not spread across hosts", ceph.pool, image_name)
+        return {}
+
+
+class Scheduler(object):
+    """
+    Runs snapshot -> export or diff -> cleanup pipelines of many images on a pool of threads.
+
+    Jobs are started by earliest deadline, then largest image first. A job starts only while
+    the global, per-pool and per-host limits allow it. Per-host load is the sum of shares of
+    running images' objects with primary OSD on the host, so small images living on few hosts
+    are not exported side by side from the same host. Exports of all jobs draw from a global
+    and per-pool TokenBucket.
+
+    >>> scheduler = Scheduler(workers=8, per_pool=4, bandwidth=200 << 20)
+    >>> results = scheduler.run([Job('rbd', 'vm-1', Policy('/backup'))])
+    """
+
+    def __init__(self, conffile='/etc/ceph/ceph.conf', cluster='ceph', workers=DEFAULT_WORKERS, per_pool=None,
+                 per_host=None, bandwidth=None, pool_bandwidth=None, inspect_workers=DEFAULT_INSPECT_WORKERS):
+        """
+        :param conffile: Path to ceph.conf file
+        :type conffile: str
+        :param cluster: Ceph cluster name
+        :type cluster: str
+        :param workers: maximum number of jobs running at once
+        :type workers: int
+        :param per_pool: maximum number of running jobs of one pool
+        :type per_pool: int
+        :param per_host: maximum load of one OSD host, in images (an image on a single host counts 1)
+        :type per_host: float
+        :param bandwidth: bytes per second of all exports together
+        :type bandwidth: int
+        :param pool_bandwidth: pool name -> bytes per second of its exports
+        :type pool_bandwidth: dict
+        :param inspect_workers: number of jobs whose size and placement are queried at once before the run
+        :type inspect_workers: int
+        """
+        self.conffile = conffile
+        self.cluster = cluster
+        self.workers = max(1, int(workers))
+        self.per_pool = per_pool
+        self.per_host = per_host
+        self.bucket = make_bucket(bandwidth)
+        self.pool_bandwidth = pool_bandwidth or {}
+        self.inspect_workers = max(1, int(inspect_workers))
+        self._pool_buckets = {}
+        self._osd_hosts = {}
+        self._cond = Condition()
+        self._running_pools = {}
+        self._host_load = {}
+
+    def ceph(self, pool):
+        return Ceph(pool, self.conffile, self.cluster, shared=True)
+
+    def pool_bucket(self, pool):
+        """Rate limiter shared by exports of :pool, chained to the global one"""
+        if pool not in self._pool_buckets:
+            self._pool_buckets[pool] = make_bucket(self.pool_bandwidth.get(pool), self.bucket)
+        return self._pool_buckets[pool]
+
+    def inspect(self, job):
+        """
+        :return: image size and host shares of :job
+        :rtype: tuple
+        """
+        try:
+            with self.ceph(job.pool) as ceph:
+                with ceph.images.open(job.image) as image:
+                    size = image.size()
+                shares = host_shares(ceph, job.image, osd_hosts=self._osd_hosts) if self.per_host else {}
+            return size, shares
+        except Exception:
+            logger.debug("Handled exception", exc_info=True)
+            return 0, {}
+
+    @staticmethod
+    def priority(job, size):
+        """Sort key of jobs: earliest deadline (jobs without one last), then larger images first"""
+        deadline = job.policy.deadline
+        return deadline is None, deadline or 0, -size
+
+    def _fits(self, job, shares):
+        if not self._running_pools:
+            # Nothing running, a job above the limits would never start otherwise
+            return True
+        if sum(self._running_pools.values()) >= self.workers:
+            return False
+        if self.per_pool and self._running_pools.get(job.pool, 0) >= self.per_pool:
+            return False
+        if self.per_host:
+            for host, share in shares.items():
+                if self._host_load.get(host, 0) + share > self.per_host + 1e-9:
+                    return False
+        return True
+
+    def _reserve(self, job, shares, sign):
+        self._running_pools[job.pool] = self._running_pools.get(job.pool, 0) + sign
+        if not self._running_pools[job.pool]:
+            del self._running_pools[job.pool]
+        for host, share in shares.items():
+            self._host_load[host] = self._host_load.get(host, 0) + sign * share
+
+    def run(self, jobs):
+        """
+        Run all jobs
+        :param jobs: list of Job
+        :type jobs: list
+        :return: JobResult of every job, in order of :jobs
+        :rtype: list
+        """
+        from multiprocessing.pool import ThreadPool
+
+        # Every inspection is an image open and up to HOST_SAMPLE_OBJECTS mon commands, they overlap
+        pool = ThreadPool(max(1, min(self.inspect_workers, len(jobs))))
+        try:
+            inspected = [(i, job) + found for i, (job, found) in
+                         enumerate(zip(jobs, pool.map(self.inspect, jobs)))]
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
+        pending = sorted(inspected, key=lambda item: self.priority(item[1], item[2]))
+        results = [None] * len(jobs)
+        threads = []
+
+        def worker(i, job, shares):
+            try:
+                results[i] = self.run_job(job)
+            finally:
+                with self._cond:
+                    self._reserve(job, shares, -1)
+                    self._cond.notify_all()
+
+        with self._cond:
+            while pending:
+                for item in pending:
+                    if self._fits(item[1], item[3]):
+                        break
+                else:
+                    self._cond.wait()
+                    continue
+                pending.remove(item)
+                i, job, size, shares = item
+                self._reserve(job, shares, 1)
+                thread = Thread(target=worker, args=(i, job, shares))
+                thread.daemon = True
+                thread.start()
+                threads.append(thread)
+        for thread in threads:
+            thread.join()
+        return results
+
+    def run_job(self, job):
+        """
+        Snapshot image, export it (or its diff since the previous backup snapshot) and remove old snapshots
+        :type job: Job
+        :rtype: JobResult
+        """
+        policy = job.policy
+        started = time()
+        snap_name = path = None
+        try:
+            with self.ceph(job.pool) as ceph:
+                previous = [snap['name'] for snap in ceph.list_snapshots(job.image)
+                            if snap['name'].startswith(policy.prefix)]
+                snap_name = policy.prefix + strftime('%Y%m%dT%H%M%S', gmtime(started))
+                if snap_name in previous or not ceph.create_snapshot(job.image, snap_name):
+                    return JobResult(job.pool, job.image, snap_name, None, False, 'snapshot failed',
+                                     time() - started)
+                directory = os.path.join(policy.output, job.pool, job.image)
+                if not os.path.isdir(directory):
+                    os.makedirs(directory)
+                bucket = make_bucket(policy.speed_limit, self.pool_bucket(job.pool))
+                from_snap = previous[-1] if policy.mode == 'diff' and previous else None
+                if from_snap:
+                    path = os.path.join(directory, snap_name + '.diff')
+                    with open(path, 'wb') as ofh:
+                        ok = ceph.create_diff_native(job.image, snap_name, ofh, from_snap=from_snap, bucket=bucket,
+                                                     compress=policy.compress, cb=_noop_progress)
+                else:
+                    path = os.path.join(directory, snap_name + '.raw')
+                    ok = ceph.create_dump_native(job.image, snap_name, path, sparse=policy.sparse, bucket=bucket,
+                                                 compress=policy.compress, cb=_noop_progress)
+                if not ok:
+                    # The newest kept snapshot stays the base of the next diff
+                    ceph.remove_snapshot(job.image, snap_name)
+                    return JobResult(job.pool, job.image, snap_name, path, False, 'export failed', time() - started)
+                for old in (previous + [snap_name])[:-max(1, policy.keep)]:
+                    ceph.remove_snapshot(job.image, old)
+                logger.info("Backed up %s/%s@%s to %s", job.pool, job.image, snap_name, path)
+                return JobResult(job.pool, job.image, snap_name, path, True, None, time() - started)
+        except Exception as e:
+            logger.exception("Backup of %s/%s failed", job.pool, job.image)
+            return JobResult(job.pool, job.image, snap_name, path, False, str(e), time() - started)
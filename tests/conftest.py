@@ -0,0 +1,28 @@
+# -*- coding: utf-8 -*-
+# The repository root is the pyceph package, it is imported under that name without installation
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def _load_package():
+    if 'pyceph' in sys.modules:
+        return
+    try:
+        import importlib.util
+    except ImportError:
+        # python 2
+        import imp
+        imp.load_module('pyceph', None, ROOT, ('', '', imp.PKG_DIRECTORY))
+        return
+    spec = importlib.util.spec_from_file_location('pyceph', os.path.join(ROOT, '__init__.py'),
+                                                  submodule_search_locations=[ROOT])
+    module = importlib.util.module_from_spec(spec)
+    sys.modules['pyceph'] = module
+    spec.loader.exec_module(module)
+
+
+# Modules of the package (queue.py, ...) must not shadow the standard library when run as `python -m pytest`
+sys.path[:] = [path for path in sys.path if os.path.abspath(path or os.curdir) != ROOT]
+_load_package()
@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+# Shared setup of tests running against the in-memory cluster
+import os
+import shutil
+import tempfile
+import unittest
+
+from pyceph import fakerbd
+from pyceph.ceph import Ceph
+
+MB = 1 << 20
+
+
+def noop(cur, total):
+    pass
+
+
+class ClusterTestCase(unittest.TestCase):
+    """Fresh fake cluster with pool 'rbd', a Ceph object on it and a temporary directory"""
+
+    def setUp(self):
+        self.cluster = fakerbd.install(fakerbd.Cluster(pools=('rbd',)))
+        self.ceph = Ceph('rbd')
+        self.tmp = tempfile.mkdtemp()
+
+    def tearDown(self):
+        from pyceph.connection import connections
+
+        self.ceph.__exit__(None, None, None)
+        # Shared connections belong to the cluster of this test
+        connections.shutdown()
+        shutil.rmtree(self.tmp)
+
+    def path(self, name):
+        return os.path.join(self.tmp, name)
+
+    def make_image(self, name, size, order=20, snapshot='s1', zero=None):
+        """
+        Image of random data with a snapshot
+        :param zero: (offset, length) range left zero
+        :return: content of the snapshot
+        :rtype: bytes
+        """
+        fakerbd.RBD().create(self.ceph.ioctx, name, size, order=order)
+        data = bytearray(os.urandom(size))
+        if zero:
+            data[zero[0]:zero[0] + zero[1]] = bytearray(zero[1])
+        data = bytes(data)
+        with fakerbd.Image(self.ceph.ioctx, name) as image:
+            image.write(data, 0)
+            if snapshot:
+                image.create_snap(snapshot)
+        self.ceph.snapshots.invalidate(name)
+        return data
+
+    def read_file(self, name):
+        with open(self.path(name), 'rb') as fh:
+            return fh.read()
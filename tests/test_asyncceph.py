@@ -0,0 +1,34 @@
+# -*- coding: utf-8 -*-
+import sys
+import unittest
+
+from helpers import ClusterTestCase, MB, noop
+
+
+@unittest.skipIf(sys.version_info < (3, 5), "asyncio API")
+class AsyncDumpTest(ClusterTestCase):
+
+    def dump(self, name):
+        import asyncio
+        from pyceph.asyncceph import AsyncCeph
+
+        async def run():
+            aceph = AsyncCeph(ceph=self.ceph)
+            try:
+                return await aceph.create_dump('img', 's1', self.path(name), in_flight=4, cb=noop)
+            finally:
+                await aceph.close()
+
+        return asyncio.run(run())
+
+    def test_dump(self):
+        data = self.make_image('img', 10 * MB + 123)
+        self.assertTrue(self.dump('img.raw'))
+        self.assertEqual(self.read_file('img.raw'), data)
+
+    def test_dump_over_larger_file(self):
+        data = self.make_image('img', 10 * MB + 123)
+        with open(self.path('img.raw'), 'wb') as fh:
+            fh.write(b'x' * 20 * MB)
+        self.assertTrue(self.dump('img.raw'))
+        self.assertEqual(self.read_file('img.raw'), data)
@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+import unittest
+
+from helpers import ClusterTestCase, MB
+from pyceph.cache import ImageCache
+
+
+class _Handle(object):
+    """Image proxy recording if its close ran under the cache lock"""
+
+    def __init__(self, cache, image):
+        self.cache = cache
+        self.image = image
+
+    def __getattr__(self, attr):
+        return getattr(self.image, attr)
+
+    def close(self):
+        self.cache.closed.append(self.cache._lock.locked())
+        self.image.close()
+
+
+class ImageCacheTest(ClusterTestCase):
+    def setUp(self):
+        super(ImageCacheTest, self).setUp()
+        for name in ('a', 'b', 'c'):
+            self.make_image(name, MB, snapshot=None)
+        self.cache = ImageCache(self.ceph.ioctx, max_size=2, wrapper=lambda image: _Handle(self.cache, image))
+        self.cache.closed = []
+
+    def test_evicted_outside_lock(self):
+        for name in ('a', 'b', 'c'):
+            with self.cache.open(name) as image:
+                image.size()
+        self.assertEqual(len(self.cache), 2)
+        self.assertEqual(self.cache.closed, [False])
+
+    def test_released_outside_lock(self):
+        with self.cache.open('a'):
+            self.cache.invalidate('a')
+            self.assertEqual(self.cache.closed, [])
+        self.assertEqual(self.cache.closed, [False])
+
+    def test_close_outside_lock(self):
+        for name in ('a', 'b'):
+            with self.cache.open(name):
+                pass
+        self.cache.close()
+        self.assertEqual(len(self.cache), 0)
+        self.assertEqual(self.cache.closed, [False, False])
+
+
+if __name__ == '__main__':
+    unittest.main()
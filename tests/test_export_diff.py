@@ -0,0 +1,188 @@
+# -*- coding: utf-8 -*-
+import os
+import random
+import shutil
+import tempfile
+import unittest
+
+from pyceph.export_diff import ExtentMap, apply_diff, merge_diff_native, scan_diff, DIFF_MAGIC, \
+    _NAME_RECORD, _SIZE_RECORD, _EXTENT_RECORD
+
+KB = 1 << 10
+
+
+def write_diff(path, size, records, from_snap=None, to_snap=None):
+    """
+    Write rbd diff v1
+    :param records: sorted non-overlapping (offset, data) records, data None for zero records of length offset
+    """
+    with open(path, 'wb') as ofh:
+        ofh.write(DIFF_MAGIC)
+        for tag, name in ((b'f', from_snap), (b't', to_snap)):
+            if name:
+                ofh.write(_NAME_RECORD.pack(tag, len(name)))
+                ofh.write(name)
+        ofh.write(_SIZE_RECORD.pack(b's', size))
+        for offset, length, data in records:
+            if data is None:
+                ofh.write(_EXTENT_RECORD.pack(b'z', offset, length))
+            else:
+                ofh.write(_EXTENT_RECORD.pack(b'w', offset, length))
+                ofh.write(data)
+        ofh.write(b'e')
+
+
+class ExtentMapTest(unittest.TestCase):
+    """ExtentMap against a map holding the source of every byte"""
+
+    def setUp(self):
+        self.random = random.Random(1)
+
+    def check(self, extent_map, model):
+        resolved = [None] * len(model)
+        for offset, length, source, position in extent_map:
+            for i in range(length):
+                resolved[offset + i] = (source, position + i) if position is not None else (None, None)
+        self.assertEqual(resolved, model)
+        ends = [offset + length for offset, length, _, _ in extent_map]
+        self.assertTrue(all(end <= offset for end, (offset, _, _, _) in zip(ends, list(extent_map)[1:])))
+
+    def test_overlay(self):
+        size = 4 * KB
+        extent_map = ExtentMap()
+        model = [None] * size
+        for source in range(30):
+            extents = []
+            # Unsorted and overlapping extents are allowed, later ones win
+            for _ in range(self.random.randint(1, 8)):
+                offset = self.random.randrange(size)
+                length = self.random.randint(0, size - offset)
+                position = self.random.choice((None, self.random.randrange(1 << 20)))
+                extents.append((offset, length, source if position is not None else None, position))
+                for i in range(length):
+                    model[offset + i] = (source, position + i) if position is not None else (None, None)
+            extent_map.overlay(extents)
+            self.check(extent_map, model)
+
+    def test_truncate(self):
+        extent_map = ExtentMap()
+        extent_map.overlay([(0, 100, 0, 0), (200, 100, None, None)])
+        extent_map.truncate(250)
+        self.assertEqual(list(extent_map), [(0, 100, 0, 0), (200, 50, None, None)])
+        extent_map.truncate(50)
+        self.assertEqual(list(extent_map), [(0, 50, 0, 0)])
+
+
+class DiffChainTest(unittest.TestCase):
+    """apply_diff and merge_diff_native against an in-memory image the same diffs are applied to"""
+
+    def setUp(self):
+        self.random = random.Random(2)
+        self.tmp = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def path(self, name):
+        return os.path.join(self.tmp, name)
+
+    def random_records(self, size):
+        cuts = sorted(set(self.random.randrange(size) for _ in range(self.random.randint(1, 12))) | {size})
+        records = []
+        start = 0
+        for end in cuts:
+            kind = self.random.choice('wzs')
+            if end > start and kind != 's':
+                records.append((start, end - start, os.urandom(end - start) if kind == 'w' else None))
+            start = end
+        return records
+
+    def make_chain(self, count=6):
+        """
+        :return: base image, diffs and image after every diff
+        """
+        size = self.random.randint(16, 64) * KB
+        base = os.urandom(size)
+        image = bytearray(base)
+        diffs = []
+        states = []
+        for i in range(count):
+            if i:
+                # Shrinks, grows and shrunk and grown again images
+                size = self.random.randint(8, 64) * KB + self.random.randrange(KB)
+            records = self.random_records(size)
+            path = self.path('%d.diff' % i)
+            write_diff(path, size, records, b'snap%d' % i if i else None, b'snap%d' % (i + 1))
+            del image[size:]
+            image.extend(bytearray(size - len(image)))
+            for offset, length, data in records:
+                image[offset:offset + length] = data if data is not None else bytearray(length)
+            diffs.append(path)
+            states.append(bytes(image))
+        return base, diffs, states
+
+    def apply(self, base, diffs):
+        target = self.path('image')
+        with open(target, 'wb') as fh:
+            fh.write(base)
+        with open(target, 'r+b') as ofh:
+            for path in diffs:
+                with open(path, 'rb') as ifh:
+                    apply_diff(ifh, ofh, verbose=False)
+        with open(target, 'rb') as fh:
+            return fh.read()
+
+    def merge(self, diffs):
+        merged = self.path('merged.diff')
+        ifhs = [open(path, 'rb') for path in diffs]
+        try:
+            with open(merged, 'wb') as ofh:
+                merge_diff_native(ifhs, ofh)
+        finally:
+            for ifh in ifhs:
+                ifh.close()
+        return merged
+
+    def test_apply(self):
+        for _ in range(5):
+            base, diffs, states = self.make_chain()
+            for i in range(len(diffs)):
+                self.assertEqual(self.apply(base, diffs[:i + 1]), states[i])
+
+    def test_merge(self):
+        for _ in range(5):
+            base, diffs, states = self.make_chain()
+            merged = self.merge(diffs)
+            self.assertEqual(self.apply(base, [merged]), states[-1])
+            with open(merged, 'rb') as fh:
+                info = scan_diff(fh)
+            self.assertEqual((info.from_snap, info.to_snap, info.size), (None, b'snap6', len(states[-1])))
+
+    def test_extent_map(self):
+        base, diffs, states = self.make_chain()
+        extent_map = ExtentMap()
+        sources = []
+        size = len(base)
+        for index, path in enumerate(diffs):
+            with open(path, 'rb') as fh:
+                info = scan_diff(fh)
+                fh.seek(0)
+                sources.append(fh.read())
+            extent_map.add_diff(index, info, size)
+            size = info.size
+        image = bytearray(base[:size])
+        image.extend(bytearray(size - len(image)))
+        for offset, length, source, position in extent_map:
+            if position is None:
+                image[offset:offset + length] = bytearray(length)
+            else:
+                image[offset:offset + length] = sources[source][position:position + length]
+        self.assertEqual(bytes(image), states[-1])
+
+    def test_merge_not_consecutive(self):
+        _, diffs, _ = self.make_chain(3)
+        self.assertRaises(ValueError, self.merge, [diffs[0], diffs[2]])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+import os
+import shutil
+
+from helpers import ClusterTestCase, MB
+from pyceph import fakerbd
+
+
+class Interrupted(IOError):
+    pass
+
+
+class ResumeTest(ClusterTestCase):
+    """Resumed exports continue only into the output file their journal was written for"""
+
+    def setUp(self):
+        super(ResumeTest, self).setUp()
+        self.data = self.make_image('img', 8 * MB + 4321)
+        self.out = self.path('img.raw')
+
+    def export(self, stop_at=None):
+        progress = []
+
+        def cb(cur, total):
+            progress.append(cur)
+            if stop_at is not None and cur >= stop_at:
+                raise Interrupted('interrupted')
+
+        ok = self.ceph.create_dump_native('img', 's1', self.out, cb=cb, readers=1, resume=True)
+        return ok, progress
+
+    def interrupt(self):
+        ok, progress = self.export(stop_at=4 * MB)
+        self.assertFalse(ok)
+        self.assertTrue(os.path.exists(self.out + '.journal'))
+
+    def assert_complete(self):
+        self.assertEqual(self.read_file('img.raw'), self.data)
+        self.assertFalse(os.path.exists(self.out + '.journal'))
+
+    def test_resume_continues(self):
+        self.interrupt()
+        ok, progress = self.export()
+        self.assertTrue(ok)
+        self.assertGreater(progress[0], 4 * MB)
+        self.assert_complete()
+
+    def test_resume_after_output_removed(self):
+        self.interrupt()
+        os.unlink(self.out)
+        ok, progress = self.export()
+        self.assertTrue(ok)
+        self.assertLessEqual(progress[0], MB)
+        self.assert_complete()
+
+    def test_resume_after_output_replaced(self):
+        self.interrupt()
+        shutil.copy(self.out, self.out + '.copy')
+        os.rename(self.out + '.copy', self.out)
+        ok, progress = self.export()
+        self.assertTrue(ok)
+        self.assertLessEqual(progress[0], MB)
+        self.assert_complete()
+
+    def test_resume_after_output_truncated(self):
+        self.interrupt()
+        with open(self.out, 'r+b') as fh:
+            fh.truncate(MB)
+        ok, progress = self.export()
+        self.assertTrue(ok)
+        self.assertLessEqual(progress[0], MB)
+        self.assert_complete()
+
+    def test_resume_reopens_recreated_snapshot(self):
+        self.interrupt()
+        with self.ceph.images.open('img', 's1') as stale:
+            pass
+        with fakerbd.Image(self.ceph.ioctx, 'img') as image:
+            image.remove_snap('s1')
+            image.create_snap('s1')
+        ok, progress = self.export()
+        self.assertTrue(ok)
+        self.assertLessEqual(progress[0], MB)
+        with self.ceph.images.open('img', 's1') as image:
+            self.assertIsNot(image, stale)
+        self.assert_complete()
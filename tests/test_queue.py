@@ -0,0 +1,206 @@
+# -*- coding: utf-8 -*-
+import errno
+import os
+import random
+import shutil
+import tempfile
+import unittest
+from threading import Lock, Thread
+from time import sleep
+
+from pyceph import queue
+from pyceph.fileio import pwrite
+from pyceph.queue import ParallelReader, AioWriter, extents, DIRECT_ALIGNMENT
+
+
+class SlowImage(object):
+    """Image whose reads complete in random order, tracking blocks read ahead of the consumer"""
+
+    def __init__(self, data, seed=0):
+        self.data = data
+        self.random = random.Random(seed)
+        self.lock = Lock()
+        self.ahead = 0
+        self.max_ahead = 0
+        self.fail_at = None
+
+    def read(self, offset, length, flags=0):
+        with self.lock:
+            delay = self.random.random() * 0.005
+            self.ahead += 1
+            self.max_ahead = max(self.max_ahead, self.ahead)
+        sleep(delay)
+        if offset == self.fail_at:
+            raise IOError("read of %d failed" % offset)
+        return self.data[offset:offset + length]
+
+    def consumed(self):
+        with self.lock:
+            self.ahead -= 1
+
+
+class ParallelReaderTest(unittest.TestCase):
+    def setUp(self):
+        self.bs = 4096
+        self.data = os.urandom(self.bs * 64 + 123)
+        self.image = SlowImage(self.data)
+
+    def test_ordered(self):
+        offsets = []
+        chunks = []
+        for offset, data in ParallelReader(self.image, extents(len(self.data), self.bs), self.bs, readers=8):
+            offsets.append(offset)
+            chunks.append(data)
+            self.image.consumed()
+        self.assertEqual(offsets, [offset for offset, _ in extents(len(self.data), self.bs)])
+        self.assertEqual(b''.join(chunks), self.data)
+
+    def test_bounded_read_ahead(self):
+        reader = ParallelReader(self.image, extents(len(self.data), self.bs), self.bs, readers=8,
+                                max_memory=4 * self.bs)
+        for _ in reader:
+            sleep(0.001)
+            self.image.consumed()
+        # Slot of the block being consumed is free already
+        self.assertLessEqual(self.image.max_ahead, 4 + 1)
+
+    def test_error(self):
+        self.image.fail_at = self.bs * 10
+        offsets = []
+
+        def consume():
+            for offset, _ in ParallelReader(self.image, extents(len(self.data), self.bs), self.bs, readers=4):
+                offsets.append(offset)
+
+        self.assertRaises(IOError, consume)
+        self.assertEqual(offsets, [self.bs * i for i in range(len(offsets))])
+        self.assertLess(len(offsets), 10 + 1)
+
+
+class FakeAio(object):
+    """pyaio.aio_write completing every write in its own thread, writes at or past :fail_at fail"""
+
+    def __init__(self):
+        self.lock = Lock()
+        self.threads = []
+        self.calls = []
+        self.fail_at = None
+        self.short = False
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    def aio_write(self, fd, buf, offset, cb):
+        with self.lock:
+            self.calls.append((fd, offset, len(buf)))
+            self.in_flight += len(buf)
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        thread = Thread(target=self._run, args=(fd, buf, offset, cb))
+        self.threads.append(thread)
+        thread.start()
+
+    def _run(self, fd, buf, offset, cb):
+        sleep(0.001)
+        with self.lock:
+            self.in_flight -= len(buf)
+        if self.fail_at is not None and offset >= self.fail_at:
+            cb(-1, errno.ENOSPC)
+        elif self.short:
+            cb(pwrite(fd, buf, offset, len(buf) // 2), 0)
+        else:
+            cb(pwrite(fd, buf, offset), 0)
+
+    def join(self):
+        for thread in self.threads:
+            thread.join()
+
+
+class AioWriterTest(unittest.TestCase):
+    def setUp(self):
+        self.aio = FakeAio()
+        self.addCleanup(setattr, queue, 'pyaio', queue.pyaio)
+        queue.pyaio = self.aio
+        self.tmp = tempfile.mkdtemp(dir=os.path.dirname(os.path.abspath(__file__)))
+        self.addCleanup(shutil.rmtree, self.tmp)
+        self.addCleanup(self.aio.join)
+        self.fn = os.path.join(self.tmp, 'out')
+        self.bs = DIRECT_ALIGNMENT * 4
+
+    def need_direct(self):
+        try:
+            os.close(os.open(self.fn, os.O_CREAT | os.O_WRONLY | os.O_DIRECT))
+        except OSError:
+            raise unittest.SkipTest("no O_DIRECT support")
+
+    def read(self):
+        with open(self.fn, 'rb') as fh:
+            return fh.read()
+
+    def test_write(self):
+        data = os.urandom(self.bs * 16)
+        with AioWriter(self.fn, max_memory=self.bs * 3) as writer:
+            for offset, length in reversed(list(extents(len(data), self.bs))):
+                writer.write(offset, data[offset:offset + length])
+            writer.wait()
+        self.assertEqual(self.read(), data)
+        self.assertLessEqual(self.aio.max_in_flight, self.bs * 3)
+
+    def test_error_raised(self):
+        self.aio.fail_at = self.bs * 4
+        writer = AioWriter(self.fn, max_memory=self.bs * 2)
+
+        def export():
+            with writer:
+                for offset in range(0, self.bs * 16, self.bs):
+                    writer.write(offset, b'x' * self.bs)
+                writer.wait()
+
+        with self.assertRaises(IOError) as raised:
+            export()
+        self.assertEqual(raised.exception.errno, errno.ENOSPC)
+        self.assertIsNone(writer.fd)
+        # Writer stops taking blocks soon after the first failure
+        self.assertLess(len(self.aio.calls), 16)
+
+    def test_error_from_wait(self):
+        self.aio.fail_at = 0
+        with AioWriter(self.fn) as writer:
+            writer.write(0, b'x' * self.bs)
+            self.assertRaises(IOError, writer.wait)
+            # Reported once
+            writer.wait()
+
+    def test_short_write(self):
+        self.aio.short = True
+        with AioWriter(self.fn) as writer:
+            writer.write(0, b'x' * self.bs)
+            self.assertRaises(IOError, writer.wait)
+
+    def test_direct_unaligned_tail(self):
+        self.need_direct()
+        size = self.bs * 3 + 1234
+        data = os.urandom(size)
+        with AioWriter(self.fn, direct=True) as writer:
+            writer.allocate(size)
+            writer.write(0, data[:self.bs])
+            # Unaligned offset goes through the page cache after the aligned writes
+            writer.write(self.bs + 10, data[self.bs + 10:self.bs * 2])
+            writer.write(self.bs, data[self.bs:self.bs + 10])
+            # Unaligned tail is padded in the O_DIRECT buffer
+            writer.write(self.bs * 2, data[self.bs * 2:])
+            writer.wait()
+        self.assertEqual(self.read(), data)
+        self.assertEqual(sorted(offset for _, offset, _ in self.aio.calls), [0, self.bs * 2])
+        self.assertTrue(all(length % DIRECT_ALIGNMENT == 0 for _, _, length in self.aio.calls))
+
+    def test_direct_grows_to_tail(self):
+        self.need_direct()
+        data = os.urandom(self.bs + 100)
+        with AioWriter(self.fn, direct=True) as writer:
+            writer.write(0, data)
+        # Size is unknown without allocate(), padding could overwrite later blocks
+        self.assertEqual(self.aio.calls, [])
+        self.assertEqual(self.read(), data)
+
+
+if __name__ == '__main__':
+    unittest.main()
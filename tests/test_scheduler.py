@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+import os
+from threading import Lock
+from time import sleep
+
+from helpers import ClusterTestCase, MB
+
+from pyceph.scheduler import Scheduler, Job, Policy
+
+
+class SlowInspectScheduler(Scheduler):
+    """Counts inspections running at once"""
+
+    def __init__(self, *args, **kwargs):
+        super(SlowInspectScheduler, self).__init__(*args, **kwargs)
+        self.lock = Lock()
+        self.running = 0
+        self.most = 0
+
+    def inspect(self, job):
+        with self.lock:
+            self.running += 1
+            self.most = max(self.most, self.running)
+        sleep(0.05)
+        try:
+            return super(SlowInspectScheduler, self).inspect(job)
+        finally:
+            with self.lock:
+                self.running -= 1
+
+
+class SchedulerTest(ClusterTestCase):
+
+    def setUp(self):
+        super(SchedulerTest, self).setUp()
+        self.data = dict((name, self.make_image(name, (i + 1) * MB, snapshot=None))
+                         for i, name in enumerate(['vm-%d' % i for i in range(6)]))
+        self.policy = Policy(self.tmp, mode='full', keep=1)
+
+    def test_inspections_overlap(self):
+        scheduler = SlowInspectScheduler(workers=2, inspect_workers=4, per_host=1.5)
+        results = scheduler.run([Job('rbd', name, self.policy) for name in sorted(self.data)])
+        self.assertEqual(scheduler.most, 4)
+        self.assertTrue(all(result.ok for result in results))
+        for result in results:
+            with open(result.path, 'rb') as fh:
+                self.assertEqual(fh.read(), self.data[result.image])
+
+    def test_results_in_job_order(self):
+        names = sorted(self.data, reverse=True)
+        results = Scheduler(workers=3).run([Job('rbd', name, self.policy) for name in names])
+        self.assertEqual([result.image for result in results], names)
+        self.assertTrue(all(os.path.exists(result.path) for result in results))
@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+import doctest
+import unittest
+
+from pyceph import tokenbucket
+from pyceph.tokenbucket import TokenBucket
+
+
+class TokenBucketTest(unittest.TestCase):
+    def test_docstring(self):
+        failed, _ = doctest.testmod(tokenbucket)
+        self.assertEqual(failed, 0)
+
+    def test_fill_rate_positive(self):
+        for rate in (0, -1):
+            self.assertRaises(ValueError, TokenBucket, 10, rate)
+
+    def test_acquire_timeout(self):
+        bucket = TokenBucket(80, 0.5)
+        self.assertTrue(bucket.consume(70))
+        self.assertFalse(bucket.acquire(20, timeout=0))
+        self.assertTrue(bucket.acquire(10, timeout=0))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,42 +1,105 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 from __future__ import division
-from time import time
+from threading import Lock
+from time import time, sleep
+
+try:
+    from .metrics import WAIT_SECONDS
+except (ImportError, ValueError):
+    # Run as a script
+    WAIT_SECONDS = None
 
 
 class TokenBucket(object):
     """An implementation of the token bucket algorithm.
 
+    Thread-safe; buckets may be chained with :parent, so tokens are taken from the bucket
+    and from all of its ancestors (e.g. per-export -> per-pool -> global limit).
+
     >>> bucket = TokenBucket(80, 0.5)
-    >>> print bucket.consume(10)
+    >>> print(bucket.consume(10))
     True
-    >>> print bucket.consume(90)
+    >>> print(bucket.consume(90))
+    False
+    >>> print(bucket.acquire(90, timeout=0))  # 10 missing tokens take 20 seconds
     False
+    >>> print(bucket.acquire(70, timeout=0))
+    True
     """
-    def __init__(self, tokens, fill_rate):
+    def __init__(self, tokens, fill_rate, parent=None):
         """tokens is the total tokens in the bucket. fill_rate is the
-        rate in tokens/second that the bucket will be refilled."""
+        rate in tokens/second that the bucket will be refilled.
+        parent is the bucket tokens are taken from as well."""
+        if fill_rate <= 0:
+            raise ValueError("fill_rate must be positive, got %r" % (fill_rate,))
         self.capacity = float(tokens)
         self._tokens = float(tokens)
         self.fill_rate = float(fill_rate)
+        self.parent = parent
         self.timestamp = time()
+        self.waited = 0.0
+        self._lock = Lock()
+
+    def _refill(self):
+        now = time()
+        if self._tokens < self.capacity:
+            delta = self.fill_rate * (now - self.timestamp)
+            self._tokens = min(self.capacity, self._tokens + delta)
+        self.timestamp = now
+
+    def _refund(self, tokens):
+        with self._lock:
+            self._refill()
+            self._tokens = min(self.capacity, self._tokens + tokens)
 
     def consume(self, tokens):
         """Consume tokens from the bucket. Returns True if there were
         sufficient tokens otherwise False."""
-        if tokens <= self.tokens:
-            self._tokens -= tokens
-        else:
+        with self._lock:
+            self._refill()
+            if tokens <= self._tokens:
+                self._tokens -= tokens
+            else:
+                return False
+        if self.parent is not None and not self.parent.consume(tokens):
+            self._refund(tokens)
             return False
         return True
 
+    def acquire(self, tokens, timeout=None):
+        """Take tokens from the bucket, sleeping exactly as long as the refill takes.
+        Requests larger than capacity wait for a full bucket and leave it in debt,
+        so the average rate is kept. Returns False if tokens were not available
+        within timeout seconds."""
+        deadline = None if timeout is None else time() + timeout
+        started = time()
+        while True:
+            with self._lock:
+                self._refill()
+                needed = min(tokens, self.capacity)
+                if self._tokens >= needed:
+                    self._tokens -= tokens
+                    break
+                delay = (needed - self._tokens) / self.fill_rate
+            if deadline is not None and time() + delay > deadline:
+                self.waited += time() - started
+                return False
+            sleep(delay)
+        waited = time() - started
+        self.waited += waited
+        if WAIT_SECONDS is not None:
+            WAIT_SECONDS.inc(waited, 'ratelimit')
+        if self.parent is not None:
+            if not self.parent.acquire(tokens, None if deadline is None else max(0, deadline - time())):
+                self._refund(tokens)
+                return False
+        return True
+
     def get_tokens(self):
-        now = time()
-        if self._tokens < self.capacity:
-            delta = self.fill_rate * (now - self.timestamp)
-            self._tokens = min(self.capacity, self._tokens + delta)
-        self.timestamp = now
-        return self._tokens
+        with self._lock:
+            self._refill()
+            return self._tokens
     tokens = property(get_tokens)
 
 
@@ -59,7 +122,6 @@ if __name__ == '__main__':
             sys.stdout.write("\rProgress: %d%%...done.\n" % progress)
         sys.stdout.flush()
 
-    from time import sleep
     bs = 4096
     total = bs * 60
     limit = bs * 4  # 16kbps
@@ -74,12 +136,9 @@ if __name__ == '__main__':
             # or can rely on os functions
             sleeping = time()
             f.flush()
-        if bucket.consume(bs):
-            # actual bs
-            f.write(b"0" * bs)
-            print_progress()
-            cur += bs
-        else:
-            sleep(1)
+        bucket.acquire(bs)
+        # actual bs
+        f.write(b"0" * bs)
+        print_progress()
+        cur += bs
     f.close()
-